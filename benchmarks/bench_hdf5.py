@@ -0,0 +1,68 @@
+"""Read throughput of hdf5_help.get_data on files in the ScannerBit hdf5
+   printer layout, from 1e4 to 1e7 points.
+
+   Run via asv:  asv run --bench bench_hdf5
+"""
+
+import os
+import tempfile
+import numpy as np
+import h5py
+from pyscannerbit.hdf5_help import get_data, DataPair
+
+SIZES = [10**4, 10**5, 10**6, 10**7]
+NAMES = ["LogLike", "default::x", "default::y", "default::z"]
+
+def write_printer_file(filename, n, seed=0):
+    """Write n points in the layout of the ScannerBit hdf5 printer, with ~10% invalid"""
+    rng = np.random.RandomState(seed)
+    with h5py.File(filename, "w") as f:
+        for name in NAMES:
+            f.create_dataset(name, data=rng.normal(size=n))
+            f.create_dataset(name + "_isvalid", data=(rng.uniform(size=n) > 0.1/len(NAMES)).astype(np.int8))
+        f.create_dataset("MPIrank", data=np.zeros(n, dtype=np.int32))
+        f.create_dataset("MPIrank_isvalid", data=np.ones(n, dtype=np.int8))
+        f.create_dataset("pointID", data=np.arange(n, dtype=np.int64))
+        f.create_dataset("pointID_isvalid", data=np.ones(n, dtype=np.int8))
+
+class GetData:
+    """asv: get_data for all columns of a file, with and without the common validity mask"""
+    params = SIZES
+    param_names = ["npoints"]
+    timeout = 600
+
+    def setup_cache(self):
+        tmpdir = tempfile.mkdtemp(prefix="pyscannerbit_bench_")
+        for n in SIZES:
+            write_printer_file(os.path.join(tmpdir, "{0}.hdf5".format(n)), n)
+        return tmpdir
+
+    def setup(self, tmpdir, n):
+        self.f = h5py.File(os.path.join(tmpdir, "{0}.hdf5".format(n)), "r")
+
+    def teardown(self, tmpdir, n):
+        self.f.close()
+
+    def time_masked(self, tmpdir, n):
+        get_data(self.f, NAMES)
+
+    def time_masked_threads(self, tmpdir, n):
+        get_data(self.f, NAMES, threads=4)
+
+    def time_masked_point_selection(self, tmpdir, n):
+        # The approach get_data used before read_masked: masking the h5py datasets directly
+        pairs = [DataPair(self.f, name) for name in NAMES]
+        m = pairs[0].valid()
+        for d in pairs[1:]:
+            m = m & d.valid()
+        [d.data()[m] for d in pairs]
+
+    def time_unmasked(self, tmpdir, n):
+        [pair.data()[:] for pair in get_data(self.f, NAMES, apply_common_mask=False)]
+
+    def track_masked_mb_per_s(self, tmpdir, n):
+        import time
+        t0 = time.perf_counter()
+        get_data(self.f, NAMES)
+        return n * len(NAMES) * 9 / 1e6 / (time.perf_counter() - t0) # 8 bytes data + 1 byte flag
+    track_masked_mb_per_s.unit = "MB/s"
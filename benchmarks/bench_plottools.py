@@ -0,0 +1,57 @@
+"""Binning and plotting speed of plottools, from 1e4 to 1e7 points.
+
+   Run via asv:  asv run --bench bench_plottools
+"""
+
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import pyscannerbit.plottools as pt
+
+SIZES = [10**4, 10**5, 10**6, 10**7]
+
+def chi2_data(n, seed=0):
+    """x, y, chi^2 columns of a 2D Gaussian"""
+    rng = np.random.RandomState(seed)
+    x = rng.uniform(-5, 5, size=n)
+    y = rng.uniform(-5, 5, size=n)
+    return np.vstack((x, y, x**2 + y**2)).T
+
+def posterior_data(n, seed=0):
+    """x, y, posterior weight columns"""
+    data = chi2_data(n, seed)
+    data[:,2] = np.exp(-0.5*data[:,2])
+    data[:,2] /= data[:,2].sum()
+    return data
+
+class Bin2d:
+    params = [SIZES, ["min", "sum"]]
+    param_names = ["npoints", "binop"]
+    timeout = 1200
+
+    def setup(self, n, binop):
+        self.data = chi2_data(n) if binop == "min" else posterior_data(n)
+
+    def time_bin2d(self, n, binop):
+        pt.bin2d(self.data, 100, 100, binop=binop)
+
+class Plots:
+    params = SIZES
+    param_names = ["npoints"]
+    timeout = 1200
+
+    def setup(self, n):
+        self.chi2 = chi2_data(n)
+        self.post = posterior_data(n)
+        self.fig = plt.figure()
+        self.ax = self.fig.add_subplot(111)
+
+    def teardown(self, n):
+        plt.close(self.fig)
+
+    def time_profplot(self, n):
+        pt.profplot(self.ax, self.chi2, nxbins=50, nybins=50)
+
+    def time_margplot(self, n):
+        pt.margplot(self.ax, self.post, nxbins=50, nybins=50)
@@ -0,0 +1,37 @@
+"""Start-up latency of the scan subprocess: a fresh fork per call, compared
+   with taking a pre-started worker from a WorkerPool.
+
+   Run via asv:  asv run --bench bench_processify
+"""
+
+from pyscannerbit.processify import processify, WorkerPool
+
+@processify
+def _noop(x):
+    return x
+
+def _init_numpy():
+    import numpy
+
+class Processify:
+    """asv: round trip of a trivial processify'd call"""
+    number = 1
+    repeat = 20
+    warmup_time = 0
+
+    def setup(self):
+        self.pool = WorkerPool(size=2, prefetch=1, initializer=_init_numpy)
+        self.pool.fill()
+
+    def teardown(self):
+        self.pool.close()
+        _noop.pool = None
+
+    def time_fork(self):
+        _noop.pool = None
+        _noop(1)
+
+    def time_pool(self):
+        _noop.pool = self.pool
+        _noop(1)
+        _noop.pool = None
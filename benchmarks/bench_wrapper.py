@@ -0,0 +1,163 @@
+"""Per-call overhead of the likelihood adapter in Scan, compared with the
+   raw ext.sb interface (where ScannerBit hands the parameter dictionary
+   straight to the user function).
+
+   Run directly:  python benchmarks/bench_wrapper.py
+   or via asv:    asv run --bench bench_wrapper
+"""
+
+import timeit
+import pyscannerbit.scan as sb
+from pyscannerbit.processify import processify
+
+NDIM = 5
+NAMES = ["p{0}".format(i) for i in range(NDIM)]
+PAR_DICT = {"default::{0}".format(n): 0.1*i for i, n in enumerate(NAMES)}
+
+def raw_like(m):
+    """What a user of the raw ext.sb interface would write"""
+    return -(m["default::p0"] + m["default::p1"] + m["default::p2"] + m["default::p3"] + m["default::p4"])
+
+def like_args(scan, p0, p1, p2, p3, p4):
+    return -(p0 + p1 + p2 + p3 + p4)
+
+def like_tuple(scan, p):
+    return -(p[0] + p[1] + p[2] + p[3] + p[4])
+
+def like_array(scan, p):
+    return -(p[0] + p[1] + p[2] + p[3] + p[4])
+
+def legacy_wrapper(function, model_name, argument_names, kwargs=None):
+    """The per-point wrapper used by Scan before the compiled adapter"""
+    def wrapped_function(scan,par_dict):
+        arguments = [par_dict["{0}::{1}".format(model_name, n)]
+          for n in argument_names]
+        return function(scan, *arguments, **(kwargs or {}))
+    return wrapped_function
+
+def adapters():
+    keys = list(PAR_DICT.keys())
+    return {
+        "legacy": legacy_wrapper(like_args, "default", NAMES),
+        "args": sb._CallAdapter(like_args, keys).compile(),
+        "tuple": sb._CallAdapter(like_tuple, keys, par_format="tuple").compile(),
+        "array": sb._CallAdapter(like_array, keys, par_format="array").compile(),
+    }
+
+class CallAdapter:
+    """asv: one call of the likelihood adapter"""
+    params = ["raw", "legacy", "args", "tuple", "array"]
+    param_names = ["format"]
+
+    def setup(self, fmt):
+        if fmt == "raw":
+            self.call = lambda: raw_like(PAR_DICT)
+        else:
+            f = adapters()[fmt]
+            self.call = lambda: f(None, PAR_DICT)
+
+    def time_call(self, fmt):
+        self.call()
+
+class _FakeScan:
+    def ensure_size(self, vec, size):
+        pass
+
+def prior_dict(vec, map):
+    for i, n in enumerate(NAMES):
+        map[n] = 10*vec[i] - 5
+
+def prior_array(vec, out):
+    out[:] = 10*vec - 5
+
+class PriorAdapter:
+    """asv: one call of the prior adapter, with sanity checks on every call or only the first"""
+    params = [["dict", "array"], [None, 1]]
+    param_names = ["format", "checks"]
+
+    def setup(self, fmt, checks):
+        func = prior_dict if fmt == "dict" else prior_array
+        self.prior = sb._PriorAdapter(func, "default", NAMES, checks, fmt).compile()
+        self.scan = _FakeScan()
+        self.vec = [0.1*i for i in range(NDIM)]
+        self.map = {}
+        self.prior(self.scan, self.vec, self.map) # use up the checked call
+
+    def time_call(self, fmt, checks):
+        self.prior(self.scan, self.vec, self.map)
+
+GAUSSIAN_POINTS = 20000
+
+def gaussian_like(scan, p0, p1, p2, p3, p4):
+    return -0.5*(p0*p0 + p1*p1 + p2*p2 + p3*p3 + p4*p4)
+
+def raw_gaussian_like(m):
+    """The same Gaussian, written for the raw ext.sb interface"""
+    return -0.5*(m["default::p0"]**2 + m["default::p1"]**2 + m["default::p2"]**2
+                 + m["default::p3"]**2 + m["default::p4"]**2)
+
+@processify
+def _native_gaussian_scan(settings):
+    from pyscannerbit import ext_module as ext
+    ext.sb.scan(False).run(inifile=settings, restart=True)
+
+@processify
+def _raw_gaussian_scan(settings):
+    from pyscannerbit import ext_module as ext
+    ext.sb.scan(False).run(inifile=settings, lnlike={"LogLike": raw_gaussian_like}, prior=None, restart=True)
+
+class NativeObjective:
+    """asv: a 'random' scan of a 5D Gaussian, with the likelihood either the native
+       'gaussian' objective plugin of ScannerBit, the same function in Python handed
+       straight to the ext.sb callback interface, or called through Scan's adapters.
+       native -> raw is the cost of the callback itself, raw -> python that of the adapters."""
+    timeout = 600
+    number = 1
+    repeat = 3
+
+    def setup(self):
+        try:
+            from pyscannerbit import ext_module
+        except ImportError:
+            raise NotImplementedError("ScannerBit extension not available")
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp(prefix="pyscannerbit_bench_")
+
+    def time_native(self):
+        settings = sb._add_default_options({
+          "Scanner": {
+            "use_scanner": "random",
+            "scanners": {"random": {"point_number": GAUSSIAN_POINTS}},
+            "objectives": {
+              "gaussian": {"plugin": "gaussian", "purpose": "LogLike",
+                           "parameters": {"param...{0}".format(NDIM): None, "range": [-5, 5]}}
+              },
+            },
+          })
+        settings["KeyValues"]["default_output_path"] = self.tmpdir + "/native"
+        _native_gaussian_scan(settings)
+
+    def _scan(self, name):
+        return sb.Scan(gaussian_like, bounds=[(-5, 5)]*NDIM, scanner="random",
+          scanner_options={"point_number": GAUSSIAN_POINTS}, output_path=self.tmpdir + "/" + name)
+
+    def time_raw(self):
+        _raw_gaussian_scan(self._scan("raw").settings)
+
+    def time_python(self):
+        self._scan("python").scan()
+
+def ns_per_call(f, *args, number=200000, repeat=5):
+    t = min(timeit.repeat(lambda: f(*args), number=number, repeat=repeat))
+    return 1e9 * t / number
+
+def main():
+    raw = ns_per_call(raw_like, PAR_DICT)
+    print("{0:>8s} {1:>12s} {2:>14s}".format("format", "ns/call", "overhead (ns)"))
+    print("{0:>8s} {1:12.1f} {2:14s}".format("raw", raw, "-"))
+    for name, f in adapters().items():
+        t = ns_per_call(f, None, PAR_DICT)
+        print("{0:>8s} {1:12.1f} {2:14.1f}".format(name, t, t - raw))
+
+if __name__ == "__main__":
+    main()
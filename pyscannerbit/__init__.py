@@ -1,3 +1,6 @@
 import os
 
+# Environment before MPI gets initialised, used when launching mpiexec ourselves
+_initial_environ = dict(os.environ)
+
 os.environ["GAMBIT_RUN_DIR"] = os.path.dirname(__file__)
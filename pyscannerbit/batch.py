@@ -0,0 +1,260 @@
+"""Pure-Python batch samplers for vectorized likelihood functions
+
+   These run without ScannerBit. Points are drawn from the unit hypercube
+   in large batches, stretched into parameter space, and handed to the
+   user likelihood as whole arrays. Output is written in the same HDF5
+   layout as the ScannerBit hdf5 printer, so that Scan.get_hdf5() and
+   hdf5_help.HDF5 work unchanged.
+"""
+
+import os
+import time
+import numpy as np
+
+from .metrics import write_attributes
+
+class BatchScanInterface:
+    """Stand-in for the ScannerBit object that is passed as the 'scan'
+       argument of vectorized likelihood functions.
+    """
+    def __init__(self):
+        self._printed = {}
+
+    def print(self, name, values):
+        """Send an extra column of results (one value per point in the
+           current batch) to the output file"""
+        self._printed[name] = np.asarray(values, dtype=np.float64)
+
+    def _pop_printed(self):
+        printed = self._printed
+        self._printed = {}
+        return printed
+
+def _primes(n):
+    """First n prime numbers"""
+    primes = []
+    candidate = 2
+    while len(primes) < n:
+        if all(candidate % p != 0 for p in primes):
+            primes.append(candidate)
+        candidate += 1
+    return primes
+
+def _halton(start, stop, ndim):
+    """Points start..stop-1 of the Halton sequence in ndim dimensions"""
+    out = np.empty((stop - start, ndim))
+    for j, base in enumerate(_primes(ndim)):
+        i = np.arange(start + 1, stop + 1) # index 0 is the origin for every base, skip it
+        f = 1.
+        r = np.zeros(stop - start)
+        while np.any(i > 0):
+            f /= base
+            r += f * (i % base)
+            i //= base
+        out[:,j] = r
+    return out
+
+def random_batches(ndim, options):
+    """Uniform pseudo-random points in the unit hypercube"""
+    rng = np.random.default_rng(options["seed"])
+    remaining = options["point_number"]
+    while remaining > 0:
+        n = min(options["batch_size"], remaining)
+        yield rng.random((n, ndim))
+        remaining -= n
+
+def grid_batches(ndim, options):
+    """Regular grid over the unit hypercube, including the edges"""
+    grid_pts = options["grid_pts"]
+    if np.ndim(grid_pts) == 0:
+        grid_pts = [grid_pts] * ndim
+    if len(grid_pts) != ndim:
+        msg = "'grid_pts' option of the grid scanner has {0} entries, however the parameter space has {1} dimensions!".format(len(grid_pts), ndim)
+        raise ValueError(msg)
+    shape = tuple(int(n) for n in grid_pts)
+    total = int(np.prod(shape))
+    for start in range(0, total, options["batch_size"]):
+        stop = min(start + options["batch_size"], total)
+        index = np.unravel_index(np.arange(start, stop), shape)
+        u = np.empty((stop - start, ndim))
+        for j, n in enumerate(shape):
+            u[:,j] = index[j] / (n - 1) if n > 1 else 0.5
+        yield u
+
+def halton_batches(ndim, options):
+    """Halton low-discrepancy (quasi-random) sequence in the unit hypercube"""
+    start = options["skip"]
+    end = start + options["point_number"]
+    while start < end:
+        stop = min(start + options["batch_size"], end)
+        yield _halton(start, stop, ndim)
+        start = stop
+
+_batch_samplers = {
+    "random": random_batches,
+    "grid": grid_batches,
+    "halton": halton_batches,
+}
+
+def transform_unit(u, bounds, prior_types):
+    """Stretch unit hypercube samples u (shape (N, ndim)) into parameter space,
+       using the simplified 'bounds'/'prior_types' prior description of Scan"""
+    out = np.empty_like(u)
+    for j, (b, t) in enumerate(zip(bounds, prior_types)):
+        if t == 'flat':
+            out[:,j] = b[0] + (b[1] - b[0]) * u[:,j]
+        elif t == 'log':
+            if b[0] <= 0:
+                raise ValueError("Range of 'log' prior must be strictly positive! Found {0}".format(b))
+            out[:,j] = np.exp(np.log(b[0]) + (np.log(b[1]) - np.log(b[0])) * u[:,j])
+        elif t == 'gaussian':
+            from scipy.special import ndtri
+            out[:,j] = b[0] + np.sqrt(b[1]) * ndtri(u[:,j]) # b[1] is the VARIANCE, as in Scan._process_settings
+        elif t == 'cauchy':
+            out[:,j] = b[0] + np.sqrt(b[1]) * np.tan(np.pi * (u[:,j] - 0.5))
+        else:
+            msg = "Prior type '{0}' is not supported by the batch samplers! Please use one of 'flat', 'log', 'gaussian' or 'cauchy', or supply your own vectorized prior function.".format(t)
+            raise ValueError(msg)
+    return out
+
+class BatchWriter:
+    """Appends batches of points to a HDF5 group using the layout of the
+       ScannerBit hdf5 printer, i.e. one 1D dataset per output quantity,
+       each accompanied by a '<name>_isvalid' dataset.
+
+       With swmr=True the file is switched to HDF5 single-writer/multiple-reader
+       mode after the first batch, so that it can be read while it grows (see
+       pyscannerbit.tail). No new columns can be added after that.
+    """
+    def __init__(self, filename, group, overwrite=True, swmr=False):
+        dirname = os.path.dirname(filename)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        import h5py
+        from . import h5pool
+        h5pool.evict(filename)
+        self.f = h5py.File(filename, 'w' if overwrite else 'a', libver='latest' if swmr else None)
+        self.g = self.f.require_group(group)
+        self.nrows = 0
+        self.names = []
+        self.swmr = swmr
+
+    def _create(self, name, dtype):
+        for n in [name, "{0}_isvalid".format(name)]:
+            if n in self.g:
+                del self.g[n]
+        self.g.create_dataset(name, shape=(self.nrows,), maxshape=(None,), dtype=dtype, chunks=True)
+        self.g.create_dataset("{0}_isvalid".format(name), shape=(self.nrows,), maxshape=(None,), dtype=np.int8, chunks=True)
+        self.names.append(name)
+
+    def append(self, columns):
+        """Append one batch. 'columns' maps dataset names to (values, valid) pairs,
+           all of the same length. Columns missing from this batch (but present in
+           earlier ones) are padded with invalid entries, and vice versa."""
+        n = len(next(iter(columns.values()))[0])
+        for name, (values, valid) in columns.items():
+            if name not in self.names:
+                if self.f.swmr_mode:
+                    raise ValueError("Cannot add the new column '{0}' to {1}, since it is already being written in SWMR mode! All columns must be present in the first batch.".format(name, self.f.filename))
+                self._create(name, np.asarray(values).dtype)
+        start, stop = self.nrows, self.nrows + n
+        # Values first, then validity flags, so that readers of a growing (SWMR)
+        # file, which go by the length of the '_isvalid' datasets, never see
+        # rows whose values are not written yet
+        for name in self.names:
+            d = self.g[name]
+            d.resize((stop,))
+            if name in columns:
+                d[start:stop] = columns[name][0]
+            d.flush()
+        for name in self.names:
+            v = self.g["{0}_isvalid".format(name)]
+            v.resize((stop,))
+            v[start:stop] = columns[name][1] if name in columns else 0
+            v.flush()
+        self.nrows = stop
+        if self.swmr and not self.f.swmr_mode:
+            self.f.swmr_mode = True
+
+    def close(self):
+        self.f.close()
+
+def run_batch_scan(settings, function, prior_func, argument_names, model_name, bounds, prior_types, kwargs=None, par_format="args", stream=None, metrics=None):
+    """Run one of the batch samplers over a vectorized likelihood function
+
+       function - Called as function(scan, *columns, **kwargs), with one 1D array
+                  per parameter, and must return an array of log-likelihood values.
+                  With par_format='tuple' the columns are passed as a single tuple,
+                  and with par_format='array' as a single (N, ndim) array.
+       prior_func - Optional vectorized prior, called as prior_func(vec, out) with
+                  unit hypercube samples 'vec' and an output array 'out' (both of
+                  shape (N, ndim), columns in the order of 'argument_names') to fill
+       stream - Optional stream.SampleRing that every batch is also pushed into
+       metrics - Optional metrics.ScanMetrics, which times each batch (prior,
+                 likelihood, and 'sampler' for drawing points and writing output)
+    """
+    scanner = settings["Scanner"]["use_scanner"]
+    options = settings["Scanner"]["scanners"][scanner]
+    printer = settings["Printer"]["options"]
+    fullpath = "{}/samples/{}".format(settings["KeyValues"]["default_output_path"], printer["output_file"])
+    threshold = settings["KeyValues"]["likelihood"]["model_invalid_for_lnlike_below"]
+    ndim = len(argument_names)
+    par_keys = ["{0}::{1}".format(model_name, n) for n in argument_names]
+    scan = BatchScanInterface()
+    kwargs = kwargs or {}
+
+    clock = time.perf_counter_ns
+    if metrics is not None:
+        metrics.start()
+    writer = BatchWriter(fullpath, printer["group"], overwrite=printer["delete_file_on_restart"], swmr=printer.get("swmr", False))
+    try:
+        npoints = 0
+        t0 = clock()
+        for u in _batch_samplers[scanner](ndim, options):
+            t1 = clock()
+            if prior_func is not None:
+                x = np.empty_like(u)
+                prior_func(u, x)
+            else:
+                x = transform_unit(u, bounds, prior_types)
+            t2 = clock()
+            if par_format == "array":
+                loglike = function(scan, x, **kwargs)
+            elif par_format == "tuple":
+                loglike = function(scan, tuple(x.T), **kwargs)
+            else:
+                loglike = function(scan, *x.T, **kwargs)
+            t3 = clock()
+            loglike = np.asarray(loglike, dtype=np.float64)
+            if loglike.shape != (len(x),):
+                msg = "Vectorized likelihood function returned an array of shape {0}, however it was given a batch of {1} points! It should return one log-likelihood value per point.".format(loglike.shape, len(x))
+                raise ValueError(msg)
+            n = len(x)
+            columns = {
+                "MPIrank": (np.zeros(n, dtype=np.int32), 1),
+                "pointID": (np.arange(npoints, npoints + n, dtype=np.int64), 1),
+                "LogLike": (loglike, np.isfinite(loglike) & (loglike >= threshold)),
+                }
+            for j, key in enumerate(par_keys):
+                columns[key] = (x[:,j], 1)
+            for name, values in scan._pop_printed().items():
+                columns[name] = (values, np.isfinite(values))
+            writer.append(columns)
+            if stream is not None:
+                stream.push_many(x, loglike, columns["LogLike"][1])
+            npoints += n
+            t4 = clock()
+            if metrics is not None:
+                metrics.record("prior", t2 - t1)
+                metrics.record("likelihood", t3 - t2)
+                metrics.record("sampler", (t1 - t0) + (t4 - t3), now=t4)
+            t0 = t4
+    finally:
+        writer.close()
+    if metrics is not None:
+        # After closing, since attributes cannot be written to a file in SWMR mode
+        import h5py
+        metrics.flush()
+        with h5py.File(fullpath, 'a') as f:
+            write_attributes(f[printer["group"]], [metrics.summary()])
+    return npoints
@@ -0,0 +1,223 @@
+"""Memoization of likelihood values across points, scans and restarts"""
+
+import os
+import time
+import struct
+import pickle
+import sqlite3
+import hashlib
+import functools
+import types
+from collections import OrderedDict
+
+def function_identity(function, kwargs=None):
+    """Key identifying a likelihood function and its fixed keyword arguments.
+       Besides the function's name and byte code, this covers everything it
+       takes its values from: default arguments, closure variables (so that
+       functions made by one factory with different parameters differ), the
+       global variables it reads, and the function and arguments of a
+       functools.partial. Editing the function invalidates its cached values.
+
+       Raises ValueError if any of these cannot be pickled; give the scan an
+       explicit 'cache_key' in that case."""
+    h = hashlib.sha1()
+    _hash_value(h, function, set())
+    _hash_value(h, sorted((kwargs or {}).items()), set())
+    return h.hexdigest()
+
+def _hash_value(h, value, seen):
+    if isinstance(value, functools.partial):
+        h.update(b"partial")
+        _hash_value(h, value.func, seen)
+        _hash_value(h, value.args, seen)
+        _hash_value(h, sorted(value.keywords.items()), seen)
+    elif isinstance(value, types.FunctionType):
+        _hash_function(h, value, seen)
+    elif isinstance(value, types.MethodType):
+        _hash_value(h, value.__func__, seen)
+        _hash_value(h, value.__self__, seen)
+    elif isinstance(value, types.ModuleType):
+        h.update("module {0}".format(value.__name__).encode())
+    elif isinstance(value, (type, types.BuiltinFunctionType)):
+        h.update("{0}.{1}".format(value.__module__, value.__qualname__).encode())
+    elif isinstance(value, (tuple, list)):
+        h.update("{0} {1}".format(type(value).__name__, len(value)).encode())
+        for v in value:
+            _hash_value(h, v, seen)
+    else:
+        try:
+            h.update(pickle.dumps(value, protocol=4))
+        except Exception as err:
+            msg = "Cannot derive a likelihood cache key from {0!r} ({1}). Please pass an explicit 'cache_key' to Scan.".format(value, err)
+            raise ValueError(msg)
+
+def _hash_function(h, function, seen):
+    h.update("{0}.{1}".format(function.__module__, function.__qualname__).encode())
+    if id(function) in seen:
+        return # recursion
+    seen.add(id(function))
+    code = function.__code__
+    _hash_code(h, code)
+    _hash_value(h, function.__defaults__, seen)
+    _hash_value(h, sorted((function.__kwdefaults__ or {}).items()), seen)
+    for cell in function.__closure__ or ():
+        try:
+            contents = cell.cell_contents
+        except ValueError:
+            contents = None # not assigned yet
+        _hash_value(h, contents, seen)
+    for name in sorted(_global_names(code)):
+        if name in function.__globals__:
+            h.update(name.encode())
+            _hash_value(h, function.__globals__[name], seen)
+
+def _hash_code(h, code):
+    """Hash byte code and constants, recursing into nested code objects (comprehensions,
+       lambdas, inner functions), whose repr contains their memory address"""
+    h.update(code.co_code)
+    for c in code.co_consts:
+        if hasattr(c, "co_code"):
+            _hash_code(h, c)
+        else:
+            h.update(repr(c).encode())
+
+def _global_names(code):
+    """Names that the code (or code nested in it) may look up as globals"""
+    names = set(code.co_names)
+    for c in code.co_consts:
+        if hasattr(c, "co_code"):
+            names |= _global_names(c)
+    return names
+
+class LikelihoodCache:
+    """Two-tier (memory LRU + on-disk sqlite) cache of likelihood values.
+
+    path - sqlite file for the disk tier (None for memory only)
+    maxsize - number of entries kept in the in-memory LRU tier
+    disk_maxsize - number of entries kept on disk. Beyond this the least recently used are
+                   evicted, down to 90% of disk_maxsize so that eviction runs only now and then.
+    quantize - if given, parameter values are rounded to multiples of this step before
+               lookup, so that nearly identical points share a cache entry
+    flush_every - number of new entries buffered before they are written to disk
+
+    The cache is consulted inside the scan subprocess. Cached points skip the call to the
+    likelihood function entirely, so any extra output it would send via scan.print is not
+    produced for them.
+    """
+    def __init__(self, path=None, maxsize=100000, disk_maxsize=10000000, quantize=None, flush_every=1000):
+        self.path = path
+        self.maxsize = maxsize
+        self.disk_maxsize = disk_maxsize
+        self.quantize = quantize
+        self.flush_every = flush_every
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._pending = []
+        self._db = None
+        self._rows = 0 # upper bound on the number of entries on disk
+
+    def __getstate__(self):
+        # sqlite connections cannot be pickled (or shared with forked processes)
+        state = self.__dict__.copy()
+        state["_db"] = None
+        state["_pending"] = []
+        return state
+
+    def _connect(self):
+        if self._db is None and self.path is not None:
+            dirname = os.path.dirname(self.path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            self._db = sqlite3.connect(self.path, timeout=60)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS loglike"
+              " (ns TEXT, key BLOB, value REAL, atime REAL, PRIMARY KEY (ns, key))")
+            self._db.execute("CREATE INDEX IF NOT EXISTS loglike_atime ON loglike (atime)")
+            self._rows = self._db.execute("SELECT COUNT(*) FROM loglike").fetchone()[0]
+        return self._db
+
+    def _key(self, params):
+        if self.quantize is None:
+            return struct.pack("{0}d".format(len(params)), *params)
+        q = self.quantize
+        return struct.pack("{0}q".format(len(params)), *[int(round(p / q)) for p in params])
+
+    def get(self, ns, params):
+        """Cached value for a parameter tuple, or None"""
+        key = (ns, self._key(params))
+        value = self._memory.get(key)
+        if value is not None:
+            self._memory.move_to_end(key)
+            self.hits_memory += 1
+            return value
+        db = self._connect()
+        if db is not None:
+            row = db.execute("SELECT value FROM loglike WHERE ns=? AND key=?", key).fetchone()
+            if row is not None:
+                self.hits_disk += 1
+                self._remember(key, row[0])
+                self._pending.append(key + (row[0], time.time())) # refresh access time
+                return row[0]
+        self.misses += 1
+        return None
+
+    def put(self, ns, params, value):
+        key = (ns, self._key(params))
+        self._remember(key, value)
+        if self.path is not None:
+            self._pending.append(key + (float(value), time.time())) # sqlite cannot bind numpy scalars
+            if len(self._pending) >= self.flush_every:
+                self.flush()
+
+    def _remember(self, key, value):
+        self._memory[key] = value
+        if len(self._memory) > self.maxsize:
+            self._memory.popitem(last=False)
+
+    def flush(self):
+        """Write buffered entries to disk, evicting the oldest beyond disk_maxsize"""
+        db = self._connect()
+        if db is None or not self._pending:
+            return
+        db.executemany("INSERT OR REPLACE INTO loglike VALUES (?,?,?,?)", self._pending)
+        # Replaced entries are counted too, so only count the table when the bound is exceeded
+        self._rows += len(self._pending)
+        self._pending = []
+        if self._rows > self.disk_maxsize:
+            n = db.execute("SELECT COUNT(*) FROM loglike").fetchone()[0]
+            if n > self.disk_maxsize:
+                keep = int(0.9 * self.disk_maxsize)
+                db.execute("DELETE FROM loglike WHERE rowid IN"
+                  " (SELECT rowid FROM loglike ORDER BY atime LIMIT ?)", (n - keep,))
+                n = keep
+            self._rows = n
+        db.commit()
+
+    def close(self):
+        self.flush()
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def memoize(self, call, ns):
+        """Wrap call(scan, params) so that values are looked up by the 'params' tuple"""
+        get, put = self.get, self.put
+        def cached_call(scan, params):
+            value = get(ns, params)
+            if value is None:
+                value = call(scan, params)
+                put(ns, params, value)
+            return value
+        return cached_call
+
+    def stats(self):
+        """Hit/miss counters"""
+        return {"hits_memory": self.hits_memory, "hits_disk": self.hits_disk, "misses": self.misses}
+
+    def add_stats(self, stats):
+        """Accumulate counters reported back from a scan subprocess"""
+        self.hits_memory += stats["hits_memory"]
+        self.hits_disk += stats["hits_disk"]
+        self.misses += stats["misses"]
@@ -0,0 +1,158 @@
+"""Run many independent scans concurrently on the local machine
+
+   Each scan runs in its own subprocess, exactly as Scan.scan() would run it
+   (see processify), so scanner plugins are freshly loaded for every scan.
+"""
+
+import os
+import time
+import numpy as np
+
+from .scan import Scan, _mpi, _run_in_subprocess
+
+def _available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def _available_memory():
+    """Memory (in bytes) available for new processes without swapping, or None if unknown"""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+class ScanCampaign:
+    """Run a list of independent scans concurrently, each in its own subprocess.
+
+    scans - list of Scan objects, or of dicts of keyword arguments for Scan
+    max_workers - maximum number of scans running at once (default: number of usable cores)
+    mem_per_scan - expected peak memory of one scan in bytes. If given, new scans are only
+                   started while at least this much memory (plus 'reserve_mem') is available.
+                   Scans started less than 'mem_settle_time' seconds ago are assumed not
+                   to have allocated their memory yet, and are charged 'mem_per_scan' each.
+    reserve_mem - memory in bytes to always leave free for the rest of the system
+    fail_fast - if True, the first failed scan cancels all running and queued scans
+    names - optional list of labels for the summary table
+    """
+    def __init__(self, scans, max_workers=None, mem_per_scan=None, reserve_mem=0,
+      fail_fast=False, names=None, poll_interval=0.1, mem_settle_time=30.):
+        if _mpi().COMM_WORLD.Get_size() > 1:
+            raise RuntimeError("ScanCampaign runs its scans on the local machine, please do not launch it with mpiexec!")
+        self.scans = [s if isinstance(s, Scan) else Scan(**s) for s in scans]
+        self.max_workers = max_workers if max_workers else _available_cores()
+        self.mem_per_scan = mem_per_scan
+        self.reserve_mem = reserve_mem
+        self.mem_settle_time = mem_settle_time
+        self.fail_fast = fail_fast
+        self.poll_interval = poll_interval
+        if names is None:
+            names = ["{0}:{1}".format(i, s.scanner) for i, s in enumerate(self.scans)]
+        self.names = list(names)
+        self.results = None
+        self._check_outputs()
+
+    def _check_outputs(self):
+        """Concurrent scans writing to the same file would clobber each other"""
+        seen = {}
+        for name, s in zip(self.names, self.scans):
+            path = os.path.abspath(s.output_file())
+            if path in seen:
+                msg = "Scans '{0}' and '{1}' would both write to {2}! Please give each scan its own 'output_path'.".format(seen[path], name, path)
+                raise ValueError(msg)
+            seen[path] = name
+
+    def _can_start(self, running):
+        """running - {index: (handle, start time)} of the scans started so far"""
+        if len(running) >= self.max_workers:
+            return False
+        if self.mem_per_scan is None or len(running) == 0:
+            return True # Always allow one scan, otherwise we could never make progress
+        available = _available_memory()
+        if available is None:
+            return True
+        now = time.time()
+        unmeasured = sum(1 for handle, start in running.values() if now - start < self.mem_settle_time)
+        return available - self.reserve_mem >= self.mem_per_scan * (unmeasured + 1)
+
+    def _summarise(self, i, status, runtime, error=None, info=None):
+        s = self.scans[i]
+        s._collect_run_info(info)
+        row = {"name": self.names[i], "scanner": s.scanner, "status": status,
+               "runtime": runtime, "evaluations": None, "best_loglike": None,
+               "output": s.output_file(), "error": error}
+        if status == "ok":
+            s._scanned = True
+            try:
+                h = s.get_hdf5()
+                try:
+                    row["evaluations"] = h[h.loglike].shape[0]
+                    loglike = h.get_loglike()
+                    row["best_loglike"] = float(np.max(loglike)) if len(loglike) > 0 else None
+                finally:
+                    h.close()
+            except IOError as err:
+                row["error"] = str(err)
+        return row
+
+    def run(self):
+        """Run all scans, and return the list of summary rows (one dict per scan, in input order)"""
+        queued = list(range(len(self.scans)))
+        running = {} # index -> (handle, start time)
+        results = [None] * len(self.scans)
+        try:
+            while queued or running:
+                while queued and self._can_start(running):
+                    i = queued.pop(0)
+                    target, args = self.scans[i]._scan_target()
+                    running[i] = (_run_in_subprocess.submit(target, args), time.time())
+                for i, (handle, start) in list(running.items()):
+                    if not handle.done():
+                        continue
+                    del running[i]
+                    runtime = time.time() - start
+                    try:
+                        info = handle.result()
+                    except Exception as err:
+                        results[i] = self._summarise(i, "failed", runtime, error=str(err))
+                        if self.fail_fast:
+                            self._cancel(running, queued, results)
+                    else:
+                        results[i] = self._summarise(i, "ok", runtime, info=info)
+                time.sleep(self.poll_interval)
+        except KeyboardInterrupt:
+            print("CTRL-C detected, cancelling all scans of the campaign...")
+            self._cancel(running, queued, results)
+            raise
+        self.results = results
+        return results
+
+    def _cancel(self, running, queued, results):
+        for i, (handle, start) in list(running.items()):
+            handle.cancel()
+            results[i] = self._summarise(i, "cancelled", time.time() - start)
+        running.clear()
+        for i in queued:
+            results[i] = self._summarise(i, "cancelled", 0.)
+        del queued[:]
+
+    def summary(self):
+        """Summary table of the last run() as a string"""
+        if self.results is None:
+            raise RuntimeError("ScanCampaign has not been run yet!")
+        fmt = "{0:<20s} {1:<10s} {2:<10s} {3:>10s} {4:>12s} {5:>14s}"
+        lines = [fmt.format("name", "scanner", "status", "runtime/s", "evaluations", "best LogLike")]
+        for r in self.results:
+            lines.append(fmt.format(r["name"], str(r["scanner"]), r["status"],
+              "{0:.2f}".format(r["runtime"]),
+              "-" if r["evaluations"] is None else str(r["evaluations"]),
+              "-" if r["best_loglike"] is None else "{0:.6g}".format(r["best_loglike"])))
+        return "\n".join(lines)
@@ -65,3 +65,22 @@ _default_options = {
   }
 }
 
+
+# Options for the pure-Python batch samplers used when Scan(..., vectorized=True).
+# These never reach ScannerBit; they are interpreted by pyscannerbit.batch.
+_default_batch_options = {
+  "random": {
+    "point_number": 10000,
+    "batch_size": 1000,
+    "seed": None,
+    },
+  "grid": {
+    "grid_pts": 10, # Points per dimension (int, or list with one entry per parameter)
+    "batch_size": 1000,
+    },
+  "halton": {
+    "point_number": 10000,
+    "batch_size": 1000,
+    "skip": 0, # Number of initial points of the sequence to discard
+    },
+}
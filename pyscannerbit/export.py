@@ -0,0 +1,147 @@
+"""Export ScannerBit HDF5 output to a compact columnar file
+
+   Only the points valid in all exported columns are written, without the
+   '_isvalid' datasets, so that the result can be loaded back with one call
+   (see load). Supported formats, chosen by file extension:
+
+     .npz              - numpy, each column compressed separately
+     .parquet          - Apache Parquet (needs pyarrow)
+     .arrow, .feather  - Arrow IPC file (needs pyarrow)
+
+   The model name and the names of the LogLike/Posterior columns are stored
+   with the data.
+
+   Command line:
+
+     python -m pyscannerbit.export results.hdf5 results.parquet [--group /] [--float32] [--columns a b ...]
+"""
+
+import os
+import json
+import argparse
+import numpy as np
+
+formats = {".npz": "npz", ".parquet": "parquet", ".arrow": "arrow", ".feather": "arrow"}
+
+_META_KEY = "__pyscannerbit_meta__"
+
+def _format(path, format):
+    if format is None:
+        format = formats.get(os.path.splitext(path)[1].lower())
+        if format is None:
+            raise ValueError("Cannot tell the export format from the file name '{0}'! Please use one of the extensions {1}, or give 'format'.".format(path, list(formats.keys())))
+    if format not in formats.values():
+        raise ValueError("Unknown export format '{0}'! Please choose one of {1}".format(format, sorted(set(formats.values()))))
+    return format
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        import pyarrow.ipc
+    except ImportError:
+        raise ImportError("Exporting to Parquet/Arrow requires the 'pyarrow' package. Please install it, or export to '.npz' instead.")
+    return pyarrow
+
+def default_columns(h5):
+    """All datasets of a results group that have an '_isvalid' twin"""
+    keys = set(h5.keys())
+    return sorted(k for k in keys if not k.endswith("_isvalid") and "{}_isvalid".format(k) in keys)
+
+def _convert(values, float32):
+    if float32 and values.dtype == np.float64:
+        return values.astype(np.float32)
+    return values
+
+def _chunks(h5, columns, chunk_rows):
+    """iter_chunks, or a single empty chunk if the group has no rows (so that the schema is written)"""
+    empty = True
+    for chunk in h5.iter_chunks(columns, chunk_rows):
+        empty = False
+        yield chunk
+    if empty:
+        yield {c: h5[h5._resolve(c)][0:0] for c in columns}
+
+def export(h5, path, columns=None, format=None, float32=False, compression="zstd", chunk_rows=2**20):
+    """Write the valid rows of 'columns' (default: all) of an HDF5 results object to 'path'.
+
+       float32 - store float64 columns as float32
+       compression - codec for Parquet/Arrow columns. For npz any codec means zip deflate,
+                     and None stores the columns uncompressed (faster to load, larger)
+       chunk_rows - Parquet/Arrow output is written in row groups/batches of this size,
+                    so memory use stays bounded; npz needs all the columns in memory.
+       A group without (valid) rows gives a file with the columns and no rows.
+    """
+    format = _format(path, format)
+    columns = default_columns(h5) if columns is None else list(columns)
+    meta = {"model": h5.model, "loglike": h5.loglike, "posterior": h5.posterior,
+            "source": h5.file.filename, "group": h5.name, "columns": columns}
+    if format == "npz":
+        arrays = {c: _convert(v, float32) for c, v in zip(columns, h5.get_params(columns))}
+        arrays[_META_KEY] = np.array(json.dumps(meta))
+        with open(path, "wb") as f:
+            (np.savez_compressed if compression else np.savez)(f, **arrays)
+        return path
+
+    pa = _pyarrow()
+    writer = None
+    try:
+        for chunk in _chunks(h5, columns, chunk_rows):
+            table = pa.table({c: _convert(chunk[c], float32) for c in columns})
+            if writer is None:
+                schema = table.schema.with_metadata({_META_KEY: json.dumps(meta)})
+                if format == "parquet":
+                    writer = pa.parquet.ParquetWriter(path, schema, compression=compression)
+                else:
+                    writer = pa.ipc.new_file(path, schema,
+                      options=pa.ipc.IpcWriteOptions(compression=compression))
+            table = table.replace_schema_metadata(schema.metadata)
+            if format == "parquet":
+                writer.write_table(table)
+            else:
+                writer.write(table)
+    finally:
+        if writer is not None:
+            writer.close()
+    return path
+
+def load(path, format=None):
+    """Load an exported file. Returns ({column: array}, metadata)."""
+    format = _format(path, format)
+    if format == "npz":
+        with np.load(path, allow_pickle=False) as f:
+            meta = json.loads(str(f[_META_KEY]))
+            return {c: f[c] for c in meta["columns"]}, meta
+    pa = _pyarrow()
+    if format == "parquet":
+        table = pa.parquet.read_table(path)
+    else:
+        with pa.memory_map(path) as source:
+            table = pa.ipc.open_file(source).read_all()
+    meta = json.loads(table.schema.metadata[_META_KEY.encode()].decode())
+    return {c: table.column(c).to_numpy() for c in meta["columns"]}, meta
+
+def main(argv=None):
+    from .hdf5_help import HDF5
+    parser = argparse.ArgumentParser(prog="python -m pyscannerbit.export",
+      description="Export the valid points of ScannerBit HDF5 output to a columnar file (.npz, .parquet, .arrow)")
+    parser.add_argument("input", help="ScannerBit HDF5 output file")
+    parser.add_argument("output", help="output file; the format follows from its extension")
+    parser.add_argument("--group", default="/", help="group in the HDF5 file holding the results (default: /)")
+    parser.add_argument("--model", default=None, help="model name (default: inferred from the dataset names)")
+    parser.add_argument("--loglike", default="LogLike")
+    parser.add_argument("--posterior", default="Posterior")
+    parser.add_argument("--columns", nargs="+", default=None, help="columns to export (default: all)")
+    parser.add_argument("--format", default=None, choices=sorted(set(formats.values())))
+    parser.add_argument("--float32", action="store_true", help="store float64 columns as float32")
+    parser.add_argument("--compression", default="zstd", help="Parquet/Arrow compression codec (default: zstd); 'none' to disable")
+    args = parser.parse_args(argv)
+
+    h5 = HDF5.fromFile(args.input, args.group, model=args.model, loglike=args.loglike, posterior=args.posterior)
+    try:
+        export(h5, args.output, columns=args.columns, format=args.format, float32=args.float32, compression=None if args.compression == "none" else args.compression)
+    finally:
+        h5.close()
+
+if __name__ == "__main__":
+    main()
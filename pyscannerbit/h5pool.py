@@ -0,0 +1,134 @@
+"""Process-wide pool of open h5py file handles
+
+   Opening a HDF5 file (and parsing its metadata) is not free, and handles
+   that are never closed leak file descriptors. Handles handed out by the
+   pool are shared between all users of the same (path, mode), and reference
+   counted: acquire() and release() (or the opened() context manager) bracket
+   each use. Released handles stay open while idle, so that the next acquire()
+   is free, up to 'max_idle' of them; beyond that the least recently used
+   ones are closed.
+
+   A read-only handle is not handed out again once its file has been modified
+   or replaced on disk (e.g. by a new scan); a fresh handle is opened instead,
+   and the old one is closed as soon as its last user releases it.
+
+   Pooled handles must not be closed directly; use release(). Code that is
+   about to write a file should call evict(path) first, since HDF5 does not
+   allow a file to be opened for writing while it is open elsewhere.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+class _Entry:
+    def __init__(self, f, stamp):
+        self.f = f
+        self.stamp = stamp
+        self.refs = 0
+
+def _stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+class HandlePool:
+    """Reference-counted h5py.File handles, keyed on (absolute path, mode)"""
+    def __init__(self, max_idle=8):
+        self.max_idle = max_idle
+        self._entries = {} # (path, mode) -> current _Entry
+        self._retired = [] # replaced entries still in use
+        self._idle = OrderedDict() # (path, mode) -> None, least recently released first
+        self._lock = threading.RLock()
+
+    def acquire(self, path, mode="r"):
+        """Open h5py.File for 'path', shared with other users. Pair with release()."""
+        import h5py
+        key = (os.path.abspath(path), mode)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (not entry.f.id.valid or (mode == "r" and entry.stamp != _stamp(key[0]))):
+                self._retire(key)
+                entry = None
+            if entry is None:
+                entry = _Entry(h5py.File(key[0], mode), _stamp(key[0]))
+                self._entries[key] = entry
+            entry.refs += 1
+            self._idle.pop(key, None)
+            return entry.f
+
+    def _retire(self, key):
+        entry = self._entries.pop(key)
+        self._idle.pop(key, None)
+        if entry.refs > 0:
+            self._retired.append(entry)
+        else:
+            self._close(entry)
+
+    def _close(self, entry):
+        if entry.f.id.valid:
+            entry.f.close()
+
+    def release(self, f):
+        """Give back the handle returned by acquire(). Handles are matched by object
+           identity: HDF5 ids compare equal for every handle open on the same file."""
+        with self._lock:
+            for key, entry in self._entries.items():
+                if entry.f is f and entry.refs > 0:
+                    entry.refs -= 1
+                    if entry.refs == 0:
+                        self._idle[key] = None
+                        self._trim()
+                    return
+            for entry in self._retired:
+                if entry.f is f:
+                    entry.refs -= 1
+                    if entry.refs == 0:
+                        self._retired.remove(entry)
+                        self._close(entry)
+                    return
+
+    def _trim(self):
+        while len(self._idle) > self.max_idle:
+            key, _ = self._idle.popitem(last=False)
+            self._close(self._entries.pop(key))
+
+    @contextmanager
+    def opened(self, path, mode="r"):
+        """Context manager around acquire() and release()"""
+        f = self.acquire(path, mode)
+        try:
+            yield f
+        finally:
+            self.release(f)
+
+    def evict(self, path):
+        """Close the idle handles of 'path' (handles in use are closed once released)"""
+        path = os.path.abspath(path)
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == path]:
+                self._retire(key)
+
+    def close_idle(self):
+        with self._lock:
+            for key in list(self._idle):
+                self._retire(key)
+
+    def stats(self):
+        """{(path, mode): number of users} of the open handles"""
+        with self._lock:
+            out = {key: e.refs for key, e in self._entries.items()}
+            for e in self._retired:
+                out[(e.f.filename, e.f.mode)] = out.get((e.f.filename, e.f.mode), 0) + e.refs
+            return out
+
+pool = HandlePool()
+
+acquire = pool.acquire
+release = pool.release
+opened = pool.opened
+evict = pool.evict
+close_idle = pool.close_idle
@@ -1,9 +1,13 @@
 """Helper routines for accessing HDF5 output of ScannerBit"""
 
+import os
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import h5py
-import matplotlib.pyplot as plt
 import numpy as np
-import pyscannerbit.plottools as pt
+
+from . import h5pool
 
 # Helper class to manage data/is_valid HDF5 dataset pairs 
 class DataPair:
@@ -22,10 +26,43 @@ class DataPair:
      return np.array(self._valid, dtype=np.bool_)
 
   def validdata(self):
-     return self.data()[self.valid()]
+     return read_masked(self.data(), self.valid())
+
+
+# Rows read per hyperslab by read_masked (rounded to whole chunks)
+READ_BLOCK_ROWS = 2**20
 
+def _block_rows(dset):
+  if dset.chunks:
+     c = dset.chunks[0]
+     return max(c, (READ_BLOCK_ROWS // c) * c)
+  return READ_BLOCK_ROWS
 
-def get_data(in_group, hdf5_dataset_names, apply_common_mask=True, model=None):
+def read_masked(dset, mask, block_rows=None):
+  """Same as dset[mask] for a boolean mask along the first axis, but much faster
+     for large datasets: h5py turns dset[mask] into a point selection, whereas
+     this reads contiguous blocks (skipping those without selected rows) and
+     applies the mask in memory"""
+  if len(mask) != dset.shape[0]:
+     return dset[mask] # let h5py deal with (or complain about) it
+  block = block_rows or _block_rows(dset)
+  out = np.empty((int(np.count_nonzero(mask)),) + dset.shape[1:], dtype=dset.dtype)
+  pos = 0
+  for start in range(0, len(mask), block):
+     m = mask[start:start+block]
+     sel = np.flatnonzero(m)
+     if len(sel) == 0:
+        continue
+     lo, hi = sel[0], sel[-1] + 1 # only read the span of selected rows
+     out[pos:pos+len(sel)] = dset[start+lo:start+hi][m[lo:hi]]
+     pos += len(sel)
+  return out
+
+def get_data(in_group, hdf5_dataset_names, apply_common_mask=True, model=None, threads=1):
+  """Read datasets (each with its '_isvalid' twin) from a group. With apply_common_mask,
+     returns the arrays restricted to the points valid in all of them, otherwise the
+     DataPair objects. 'threads' > 1 reads the columns concurrently; h5py serialises
+     calls into the HDF5 library, so this mostly overlaps the in-memory masking."""
   datapairs = []
   for name in hdf5_dataset_names:
     datapairs += [ DataPair(in_group,name,model) ]
@@ -34,40 +71,216 @@ def get_data(in_group, hdf5_dataset_names, apply_common_mask=True, model=None):
      m = datapairs[0].valid()
      for d in datapairs[1:]:
         m = m & d.valid()
-     for d in datapairs:
-        output += [d.data()[m]]
+     if threads > 1 and len(datapairs) > 1:
+        with ThreadPoolExecutor(min(threads, len(datapairs))) as pool:
+           output = list(pool.map(lambda d: read_masked(d.data(), m), datapairs))
+     else:
+        for d in datapairs:
+           output += [read_masked(d.data(), m)]
   else:
      output = datapairs
   return output
 
 
+def memmap_dataset(dset):
+  """Read-only numpy.memmap over the on-disk storage of a dataset, or None if its
+     layout does not allow it (chunked or compressed, not yet allocated, external
+     storage, or a file driver other than a plain file)"""
+  if dset.chunks is not None or dset.external is not None or dset.dtype.hasobject \
+     or dset.file.driver not in ("sec2", "stdio") or dset.size == 0:
+     return None
+  offset = dset.id.get_offset()
+  if offset is None:
+     return None
+  return np.memmap(dset.file.filename, dtype=dset.dtype, mode="r", offset=offset, shape=dset.shape)
+
+class MappedColumns:
+  """Zero-copy views of the columns of a ScannerBit HDF5 results group.
+
+     Columns are memory-mapped where their layout allows it (see memmap_dataset),
+     so that several processes on one node share the same page cache rather than
+     each holding a private copy. Other columns are read into memory instead.
+     Values are returned for all rows, valid or not; see valid().
+  """
+  def __init__(self, group, model=None):
+     self.group = group
+     self.model = model
+     self._views = {}
+
+  def _name(self, name):
+     if name in self.group or self.model is None:
+        return name
+     return "{}::{}".format(self.model, name)
+
+  def _view(self, full_name):
+     view = self._views.get(full_name)
+     if view is None:
+        dset = self.group[full_name]
+        view = memmap_dataset(dset)
+        if view is None:
+           view = dset[()]
+        self._views[full_name] = view
+     return view
+
+  def __getitem__(self, name):
+     return self._view(self._name(name))
+
+  def valid(self, name):
+     """Validity flags of a column, as a boolean view of the '_isvalid' dataset"""
+     flags = self._view("{}_isvalid".format(self._name(name)))
+     return flags.view(np.bool_) if flags.dtype.itemsize == 1 else flags.astype(np.bool_)
+
+  def is_mapped(self, name):
+     return isinstance(self[name], np.memmap)
+
+class ColumnCache:
+  """Least-recently-used cache of arrays, bounded by their total size in bytes"""
+  def __init__(self, max_bytes):
+     self.max_bytes = max_bytes
+     self.nbytes = 0
+     self._items = OrderedDict()
+
+  def get(self, key):
+     value = self._items.get(key)
+     if value is not None:
+        self._items.move_to_end(key)
+     return value
+
+  def put(self, key, value):
+     size = getattr(value, "nbytes", 0)
+     if size > self.max_bytes:
+        return # would evict everything else, and still not fit
+     old = self._items.pop(key, None)
+     if old is not None:
+        self.nbytes -= getattr(old, "nbytes", 0)
+     self._items[key] = value
+     self.nbytes += size
+     while self.nbytes > self.max_bytes:
+        _, evicted = self._items.popitem(last=False)
+        self.nbytes -= getattr(evicted, "nbytes", 0)
+
+  def clear(self):
+     self._items.clear()
+     self.nbytes = 0
+
+
 class HDF5(h5py.Group):
     """
     Class representing HDF5 results from ScannerBit
     ===============================================
+
+    Columns read from the file are kept in memory (decoded, together with
+    their validity flags and the combined validity masks), up to 'cache_bytes'
+    in total, so that repeated queries do not re-read the file. The cache is
+    dropped whenever the modification time of the file changes.
+
+    Objects made by fromFile (or Scan.get_hdf5) use a shared handle from
+    pyscannerbit.h5pool, which is given back by close(), at the end of a
+    'with' block, or when the object is garbage collected.
     """
-    def __init__(self, group, model=None, loglike="LogLike", posterior="Posterior", h5file=None):
+    def __init__(self, group, model=None, loglike="LogLike", posterior="Posterior", h5file=None, cache_bytes=512*2**20):
         """Wrap a group in a HDF5 file
         """
         self.loglike = loglike
         self.posterior = posterior
         self.h5file = h5file
         super(HDF5,self).__init__(group)
+        self._release = weakref.finalize(self, h5pool.release, h5file) if h5file is not None else None
+        self._cache = ColumnCache(cache_bytes)
+        self._mtime = None
+        self._keys = None
+        self._mapped = None
+        self._point_index = None
+        self._zonemap = None
         self.model = model if model else self.get_model_name()
 
     @classmethod
-    def fromFile(clsobj, h5filename, group, model=None, loglike="LogLike", posterior="Posterior"):
+    def fromFile(clsobj, h5filename, group, model=None, loglike="LogLike", posterior="Posterior", cache_bytes=512*2**20):
         """Alternate constructor to wrap a group directly from a file, rather than having to
            open the file before constructing this object.
         """
-        f = h5py.File(h5filename,'r')
-        g = f[group] 
-        return clsobj(g,model,loglike,posterior,h5file=f)
+        f = h5pool.acquire(h5filename,'r')
+        try:
+            g = f[group]
+        except KeyError:
+            h5pool.release(f)
+            raise
+        return clsobj(g.id,model,loglike,posterior,h5file=f,cache_bytes=cache_bytes)
+
+    def close(self):
+        """Give back the pooled file handle (see h5pool). The object cannot be used afterwards."""
+        if self._release is not None:
+            self._release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _check_cache(self):
+        """Drop cached data if the file was modified since it was read"""
+        try:
+            mtime = os.stat(self.file.filename).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime != self._mtime:
+            self.clear_cache()
+            self._mtime = mtime
+
+    def clear_cache(self):
+        self._cache.clear()
+        self._keys = None
+        self._mapped = None
+        self._point_index = None
+
+    def _key_index(self):
+        """Set of dataset names in the group"""
+        self._check_cache()
+        if self._keys is None:
+            self._keys = frozenset(self.keys())
+        return self._keys
+
+    def _resolve(self, name):
+        """Full dataset name for 'name', which may lack the model prefix"""
+        keys = self._key_index()
+        if "{}_isvalid".format(name) in keys:
+            return name
+        full = "{}::{}".format(self.model, name)
+        if "{}_isvalid".format(full) in keys:
+            return full
+        raise KeyError("No dataset '{0}' (or '{1}') with validity flags found in {2}".format(name, full, self.name))
+
+    def _cached(self, key, read):
+        value = self._cache.get(key)
+        if value is None:
+            value = read()
+            self._cache.put(key, value)
+        return value
+
+    def _column(self, full_name):
+        return self._cached(("data", full_name), lambda: self[full_name][()])
+
+    def _valid(self, full_name):
+        return self._cached(("valid", full_name),
+          lambda: np.array(self["{}_isvalid".format(full_name)], dtype=np.bool_))
+
+    def _mask(self, full_names):
+        """Combined validity mask of several columns"""
+        full_names = tuple(sorted(set(full_names)))
+        if len(full_names) == 1:
+            return self._valid(full_names[0])
+        def combine():
+            m = self._valid(full_names[0]).copy()
+            for n in full_names[1:]:
+                m &= self._valid(n)
+            return m
+        return self._cached(("mask", full_names), combine)
 
     def get_model_name(self):
         """Attempt to infer model name from parameter dataset label
         """
-        for k in self.keys():
+        for k in sorted(self._key_index()):
             if "::" in k:
                 return k.split("::")[0]
 
@@ -76,14 +289,64 @@ class HDF5(h5py.Group):
         """
         prefix = "{}::".format(self.model)
         suffix = "_isvalid"
-        return [k[len(prefix):] for k in self.keys()
+        return [k[len(prefix):] for k in sorted(self._key_index())
             if k.startswith(prefix) and not k.endswith(suffix)]
 
-    def get_params(self, names):
-        return get_data(self, names, model=self.model, apply_common_mask=True)
+    def get_params(self, names, mmap=False):
+        """Columns 'names', restricted to the points valid in all of them
+           (as get_data with apply_common_mask=True).
+
+           With mmap=True, columns stored contiguously and uncompressed are read
+           through a memory map (see MappedColumns) instead of the cache. If all
+           points are valid the numpy.memmap itself is returned, without copying.
+           Other columns are read as usual."""
+        self._check_cache()
+        full_names = [self._resolve(n) for n in names]
+        m = self._mask(full_names)
+        if not mmap:
+            return [self._column(n)[m] for n in full_names]
+        mapped = self.mapped()
+        out = []
+        all_valid = m.all()
+        for n in full_names:
+            if mapped.is_mapped(n):
+                out += [mapped[n] if all_valid else mapped[n][m]]
+            else:
+                out += [self._column(n)[m]]
+        return out
+
+    def get_param(self, name, mmap=False):
+        return self.get_params([name], mmap=mmap)[0]
+
+    def mapped(self):
+        """MappedColumns view of this group (shared between calls, until the file changes)"""
+        self._check_cache()
+        if self._mapped is None:
+            self._mapped = MappedColumns(self, self.model)
+        return self._mapped
 
-    def get_param(self, name):
-        return get_data(self, [name], model=self.model, apply_common_mask=True)[0]
+    def point_index(self):
+        """Sorted (MPIrank, pointID) index of the rows (see pyscannerbit.merge.PointIndex).
+           Read from the file if stored there by merge(), else built once and kept."""
+        from .merge import PointIndex
+        self._check_cache()
+        if self._point_index is None:
+            self._point_index = PointIndex.load(self) or PointIndex.build(self)
+        return self._point_index
+
+    def get_point(self, mpirank, pointid, columns=None):
+        """Values of 'columns' (default: all) at the point (mpirank, pointid), as a
+           dict {name: value}, with None where the value is flagged invalid"""
+        from .export import default_columns
+        row = int(self.point_index().find(mpirank, pointid))
+        if row < 0:
+            raise KeyError("No point with MPIrank={0}, pointID={1} in {2}".format(mpirank, pointid, self.name))
+        columns = default_columns(self) if columns is None else columns
+        out = {}
+        for c in columns:
+            n = self._resolve(c)
+            out[c] = self[n][row] if self["{}_isvalid".format(n)][row] else None
+        return out
 
     def get_loglike(self):
         """
@@ -95,21 +358,143 @@ class HDF5(h5py.Group):
         """
         return self.get_param(self.posterior)
 
-    def get_best_fit(self, name):
+    def iter_chunks(self, columns, chunk_rows=2**20, apply_common_mask=True):
+        """Iterate over 'columns' in blocks of 'chunk_rows' rows, so that outputs
+           larger than memory can be processed. Yields {name: array} restricted to
+           the rows valid in all columns, or with apply_common_mask=False
+           {name: (values, valid)} for every row.
+        """
+        self._check_cache()
+        dsets = [(self[n], self["{}_isvalid".format(n)]) for n in
+                 [self._resolve(c) for c in columns]]
+        nrows = min(d.shape[0] for d, v in dsets)
+        for start in range(0, nrows, chunk_rows):
+            stop = min(start + chunk_rows, nrows)
+            chunk = {c: (d[start:stop], np.array(v[start:stop], dtype=np.bool_))
+                     for c, (d, v) in zip(columns, dsets)}
+            if apply_common_mask:
+                m = np.logical_and.reduce([valid for values, valid in chunk.values()])
+                yield {c: values[m] for c, (values, valid) in chunk.items()}
+            else:
+                yield chunk
+
+    def reduce(self, *reducers, chunk_rows=2**20):
+        """Stream the columns needed by 'reducers' (see pyscannerbit.reducers)
+           through them, chunk by chunk, and return the list of their results
         """
+        columns = sorted(set(c for r in reducers for c in r.columns))
+        for chunk in self.iter_chunks(columns, chunk_rows, apply_common_mask=False):
+            for r in reducers:
+                r.update(chunk)
+        return [r.result() for r in reducers]
+
+    def export(self, path, columns=None, **kwargs):
+        """Write the valid points to a columnar file (.npz, .parquet or .arrow);
+           see pyscannerbit.export.export for the options, and export.load to read it back
         """
-        loglike = self.get_loglike()
-        index = np.argmax(loglike)
-        return self.get_param(name)[index]
+        from .export import export
+        return export(self, path, columns, **kwargs)
 
-    def get_min_chi_squared(self):
+    def query(self, expr, columns, params=None, zone_rows=None):
+        """Rows of 'columns' where the numpy expression 'expr' holds, e.g.
+           query("LogLike > max(LogLike) - 5 and 0 < z < 2", ["x", "y"]). Returns {column: array}.
+           Blocks of rows that cannot match are skipped using per-block min/max values
+           (zone maps), which are kept in '<file>.zonemap'; see pyscannerbit.query.
         """
+        from .query import query, ZoneMap, ZONE_ROWS
+        zone_rows = ZONE_ROWS if zone_rows is None else zone_rows
+        if self._zonemap is None or self._zonemap.zone_rows != zone_rows:
+            self._zonemap = ZoneMap(self, zone_rows)
+        return query(self, expr, columns, params, zonemap=self._zonemap)
+
+    def get_best_fit(self, name, chunk_rows=None):
+        """Value of 'name' at the point of highest LogLike (among points where
+           both are valid). With chunk_rows, the file is streamed in chunks of
+           that many rows rather than read (and cached) whole. Raises ValueError
+           if there is no such point.
         """
-        return -2. * self.get_loglike().max()
+        if chunk_rows is not None:
+            from .reducers import ArgMax
+            loglike, at = self.reduce(ArgMax(self.loglike, carry=[name]), chunk_rows=chunk_rows)[0]
+            if loglike is None:
+                raise ValueError(self._no_valid_points([self.loglike, name]))
+            return at.get(name, loglike)
+        loglike, values = self.get_params([self.loglike, name])
+        if len(loglike) == 0:
+            raise ValueError(self._no_valid_points([self.loglike, name]))
+        return values[np.argmax(loglike)]
+
+    def get_best_fit_point(self, k=1, columns=None, chunk_rows=2**20, as_records=False):
+        """The k points of highest valid LogLike, with all parameters (or 'columns') at each.
+
+           LogLike is streamed once, keeping the top k of every chunk (np.argpartition),
+           and then only those k rows are read from each column. Returns a dict
+           {name: value} for k=1, or {name: array} with the points in order of
+           decreasing LogLike; with as_records=True a numpy record array. Values that
+           are flagged invalid are NaN. Fewer than k points are returned if there are
+           not enough valid ones.
+        """
+        if k < 1:
+            raise ValueError("get_best_fit_point needs k >= 1 (got k={0})".format(k))
+        self._check_cache()
+        if columns is None:
+            columns = self.get_param_names()
+        columns = [self.loglike] + [c for c in columns if c != self.loglike]
+        d = self[self._resolve(self.loglike)]
+        v = self["{}_isvalid".format(self._resolve(self.loglike))]
+        best = np.empty(0)
+        rows = np.empty(0, dtype=np.int64)
+        for start in range(0, d.shape[0], chunk_rows):
+            stop = min(start + chunk_rows, d.shape[0])
+            values = d[start:stop]
+            candidates = np.flatnonzero(np.array(v[start:stop], dtype=np.bool_) & ~np.isnan(values))
+            if len(candidates) > k:
+                candidates = candidates[np.argpartition(values[candidates], -k)[-k:]]
+            best = np.concatenate([best, values[candidates]])
+            rows = np.concatenate([rows, start + candidates])
+            if len(best) > k:
+                keep = np.argpartition(best, -k)[-k:]
+                best, rows = best[keep], rows[keep]
+        order = np.argsort(-best, kind="stable")
+        rows = rows[order]
+        # h5py reads point selections in increasing order
+        read_order = np.argsort(rows)
+        unsort = np.argsort(read_order)
+        out = OrderedDict()
+        for c in columns:
+            n = self._resolve(c)
+            values = self[n][rows[read_order]][unsort] if len(rows) else self[n][0:0]
+            valid = np.array(self["{}_isvalid".format(n)][rows[read_order]], dtype=np.bool_)[unsort] if len(rows) else np.ones(0, dtype=bool)
+            if not valid.all():
+                values = np.where(valid, values, np.nan)
+            out[c] = values
+        if as_records:
+            return np.rec.fromarrays(list(out.values()), names=list(out.keys()))
+        if k == 1 and len(rows) == 1:
+            return OrderedDict((c, values[0]) for c, values in out.items())
+        return out
+
+    def get_min_chi_squared(self, chunk_rows=None):
+        """-2 times the highest valid LogLike. With chunk_rows, streamed as in get_best_fit.
+           Raises ValueError if no LogLike value is valid.
+        """
+        if chunk_rows is not None:
+            from .reducers import Max
+            loglike = self.reduce(Max(self.loglike), chunk_rows=chunk_rows)[0]
+        else:
+            values = self.get_loglike()
+            loglike = values.max() if len(values) else None
+        if loglike is None:
+            raise ValueError(self._no_valid_points([self.loglike]))
+        return -2. * loglike
+
+    def _no_valid_points(self, names):
+        return "No point in {0} where {1} {2} valid".format(self.name, " and ".join(names), "is" if len(names) == 1 else "are")
 
     def make_plot(self, name_x, name_y):
         """
         """
+        import matplotlib.pyplot as plt
         fig = plt.figure(figsize=(8, 6))
         ax = fig.add_subplot(111)
 
@@ -124,18 +509,20 @@ class HDF5(h5py.Group):
         plt.show()
 
     def plot_profile_likelihood(self,ax,xpar,ypar,use_default_model_name=True,nxbins=50,nybins=50):
+        from . import plottools as pt
         if(use_default_model_name):
            xpar = "{0}::{1}".format(self.model,xpar)
            ypar = "{0}::{1}".format(self.model,ypar)
-        logl,x,y = get_data(self,[self.loglike,xpar,ypar])
+        logl,x,y = self.get_params([self.loglike,xpar,ypar])
         data = np.vstack((x,y,-2*logl)).T
         pt.profplot(ax,data,title=None,labels=[xpar,ypar],nxbins=nxbins,nybins=nybins)
 
     def plot_marginal_posterior(self,ax,xpar,ypar,use_default_model_name=True,nxbins=100,nybins=100):
+        from . import plottools as pt
         if(use_default_model_name):
            xpar = "{0}::{1}".format(self.model,xpar)
            ypar = "{0}::{1}".format(self.model,ypar)
-        p,x,y = get_data(self,[self.posterior,xpar,ypar])
+        p,x,y = self.get_params([self.posterior,xpar,ypar])
         data = np.vstack((x,y,p)).T
         pt.margplot(ax,data,title=None,labels=[xpar,ypar],nxbins=nxbins,nybins=nybins)
 
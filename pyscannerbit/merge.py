@@ -0,0 +1,183 @@
+"""Merging of ScannerBit outputs, and lookup of points by (MPIrank, pointID)
+
+   ScannerBit labels every point with the MPI rank that evaluated it and a
+   per-rank counter, pointID. PointIndex packs the pair into one sortable
+   64 bit key, and keeps the keys sorted together with the row each one
+   came from, so that points are found by binary search.
+
+   merge() concatenates several result groups (e.g. of restarted or sharded
+   runs) into one, dropping duplicate points. It streams the data through in
+   chunks, so besides one chunk only the keys are held in memory (a few
+   tens of bytes per point). The index of the merged output is stored next to it, in the
+   datasets '_pointindex_keys' and '_pointindex_rows'.
+"""
+
+import numpy as np
+
+from .hdf5_help import HDF5
+from .export import default_columns
+
+_PID_BITS = 40 # pointIDs up to ~1e12, MPI ranks up to ~8e6
+
+def point_keys(mpirank, pointid):
+    """Pack (MPIrank, pointID) pairs into sortable int64 keys"""
+    mpirank = np.asarray(mpirank, dtype=np.int64)
+    pointid = np.asarray(pointid, dtype=np.int64)
+    if np.any(pointid >= 2**_PID_BITS) or np.any(pointid < 0) or np.any(mpirank >= 2**(63 - _PID_BITS)) or np.any(mpirank < 0):
+        raise ValueError("(MPIrank, pointID) pair out of the range supported by the point index!")
+    return (mpirank << _PID_BITS) | pointid
+
+def _read_keys(h5, chunk_rows):
+    """Keys of all rows of a results group, read chunk by chunk"""
+    n = h5["pointID"].shape[0]
+    keys = np.empty(n, dtype=np.int64)
+    for start in range(0, n, chunk_rows):
+        stop = min(start + chunk_rows, n)
+        keys[start:stop] = point_keys(h5["MPIrank"][start:stop], h5["pointID"][start:stop])
+    return keys
+
+class PointIndex:
+    """Sorted (MPIrank, pointID) index of the rows of a results group"""
+    def __init__(self, keys, rows):
+        self.keys = keys # sorted
+        self.rows = rows # row of each key in the group
+
+    @classmethod
+    def build(cls, h5, chunk_rows=2**20):
+        keys = _read_keys(h5, chunk_rows)
+        order = np.argsort(keys, kind="stable")
+        return cls(keys[order], order)
+
+    @classmethod
+    def load(cls, h5):
+        """Index stored with the group (by merge or save), or None"""
+        if "_pointindex_keys" not in h5 or h5["_pointindex_keys"].shape[0] != h5["pointID"].shape[0]:
+            return None
+        return cls(h5["_pointindex_keys"][()], h5["_pointindex_rows"][()])
+
+    def save(self, group):
+        for name, data in [("_pointindex_keys", self.keys), ("_pointindex_rows", self.rows)]:
+            if name in group:
+                del group[name]
+            group.create_dataset(name, data=data)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def find(self, mpirank, pointid):
+        """Rows of the given points (arrays or scalars), -1 where absent. O(log N) per point."""
+        keys = point_keys(mpirank, pointid)
+        if len(self.keys) == 0:
+            return np.full(np.shape(keys), -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return np.where(self.keys[pos] == keys, self.rows[pos], -1)
+
+def _open(source):
+    """HDF5 object for 'source', and whether it was opened here (and must be closed)"""
+    if isinstance(source, HDF5):
+        return source, False
+    if isinstance(source, str):
+        return HDF5.fromFile(source, "/"), True
+    filename, group = source
+    return HDF5.fromFile(filename, group), True
+
+def merge(sources, output, group="/", keep="last", chunk_rows=2**20):
+    """Merge result groups into one new file, keeping each (MPIrank, pointID) once.
+
+       sources - HDF5 objects, file names (group '/'), or (file name, group) pairs
+       keep - which copy of a duplicated point to keep: the 'first' or 'last' one in
+              the order of 'sources' (e.g. 'last' for the run that was restarted)
+       Columns missing from some sources are marked invalid for their points.
+       Returns the merged group as an HDF5 object.
+    """
+    if keep not in ["first", "last"]:
+        raise ValueError("Unknown value keep='{0}'! Please choose 'first' or 'last'.".format(keep))
+    groups = []
+    opened = []
+    try:
+        for s in sources:
+            g, close = _open(s)
+            groups.append(g)
+            if close:
+                opened.append(g)
+        attrs = _merge(groups, output, group, keep, chunk_rows)
+    finally:
+        for g in opened:
+            g.close()
+    return HDF5.fromFile(output, group, attrs["model"], attrs["loglike"], attrs["posterior"])
+
+def _merge(groups, output, group, keep, chunk_rows):
+    """Write the merged output of open groups; returns the attributes to reopen it with"""
+    from .batch import BatchWriter
+    keys = [_read_keys(g, chunk_rows) for g in groups]
+    sizes = [len(k) for k in keys]
+    allkeys = np.concatenate(keys)
+    del keys
+
+    # Rows to keep: one per key, the first or last in concatenation order
+    order = np.argsort(allkeys, kind="stable")
+    sorted_keys = allkeys[order]
+    del allkeys
+    if keep == "first":
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    else:
+        first = np.ones(len(order), dtype=bool)
+        first[:-1] = sorted_keys[1:] != sorted_keys[:-1]
+    kept = np.zeros(len(order), dtype=bool)
+    kept[order[first]] = True
+    index_keys = sorted_keys[first]
+    del sorted_keys
+    # Output row of each kept point = number of kept points before it
+    out_rows = np.cumsum(kept) - 1
+    index_rows = out_rows[order[first]]
+    del order, first, out_rows
+
+    writer = BatchWriter(output, group, overwrite=True)
+    try:
+        offset = 0
+        for g, n in zip(groups, sizes):
+            names = default_columns(g)
+            for start in range(0, n, chunk_rows):
+                stop = min(start + chunk_rows, n)
+                k = kept[offset + start:offset + stop]
+                if not k.any():
+                    continue
+                writer.append({name: (g[name][start:stop][k], g["{}_isvalid".format(name)][start:stop][k])
+                               for name in names})
+            offset += n
+        PointIndex(index_keys, index_rows).save(writer.g)
+        attrs = {"model": groups[0].model, "loglike": groups[0].loglike, "posterior": groups[0].posterior}
+    finally:
+        writer.close()
+    return attrs
+
+def join(left, right, columns, chunk_rows=2**20):
+    """Values of 'columns' of 'right' for each row of 'left', matched on (MPIrank, pointID).
+       Returns {column: (values, valid)} aligned with the rows of 'left'; 'valid' is False
+       where the point is missing from 'right' or the value there is invalid. 'right' is
+       read once, 'chunk_rows' rows at a time."""
+    index = right.point_index()
+    rows = np.empty(left["pointID"].shape[0], dtype=np.int64)
+    for start in range(0, len(rows), chunk_rows):
+        stop = min(start + chunk_rows, len(rows))
+        rows[start:stop] = index.find(left["MPIrank"][start:stop], left["pointID"][start:stop])
+    # Stream 'right' once, chunk by chunk, filling the rows of 'left' that point into each chunk
+    order = np.argsort(rows, kind="stable")
+    sorted_rows = rows[order]
+    first = np.searchsorted(sorted_rows, 0)
+    names = [right._resolve(c) for c in columns]
+    out = {c: (np.zeros(len(rows), dtype=right[name].dtype), np.zeros(len(rows), dtype=bool))
+           for c, name in zip(columns, names)}
+    nright = min(right[name].shape[0] for name in names) if names else 0
+    for start in range(0, nright, chunk_rows):
+        stop = min(start + chunk_rows, nright)
+        lo, hi = np.searchsorted(sorted_rows[first:], [start, stop]) + first
+        if lo == hi:
+            continue
+        at, src = order[lo:hi], sorted_rows[lo:hi] - start
+        for c, name in zip(columns, names):
+            values, valid = out[c]
+            values[at] = right[name][start:stop][src]
+            valid[at] = np.array(right["{}_isvalid".format(name)][start:stop], dtype=np.bool_)[src]
+    return out
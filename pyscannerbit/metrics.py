@@ -0,0 +1,155 @@
+"""Low-overhead timing of the stages of a scan
+
+   Stages:
+     likelihood    - the user likelihood function
+     wrapper       - pyscannerbit's likelihood adapter, excluding the user function
+     prior         - the user prior function
+     prior_wrapper - pyscannerbit's prior adapter, excluding the user function
+     sampler       - everything outside the Python callbacks, i.e. the scanner
+                     itself (plus printing to the output file)
+"""
+
+import os
+import math
+import json
+import time
+
+STAGES = ["likelihood", "wrapper", "prior", "prior_wrapper", "sampler"]
+
+class LatencyHistogram:
+    """Histogram of durations in nanoseconds, with logarithmic buckets
+       ('per_decade' per factor of 10, from 1 ns up to ~3 hours)"""
+    def __init__(self, per_decade=20, decades=13):
+        self.per_decade = per_decade
+        self.counts = [0] * (per_decade * decades)
+        self.count = 0
+        self.total_ns = 0
+
+    def add(self, ns):
+        b = int(math.log10(ns) * self.per_decade) if ns > 1 else 0
+        if b >= len(self.counts):
+            b = len(self.counts) - 1
+        self.counts[b] += 1
+        self.count += 1
+        self.total_ns += ns
+
+    def merge(self, other):
+        for i, c in enumerate(other.counts):
+            self.counts[i] += c
+        self.count += other.count
+        self.total_ns += other.total_ns
+
+    def percentile(self, q):
+        """Approximate q-th percentile (0 < q < 100), in ns (centre of the bucket)"""
+        if self.count == 0:
+            return None
+        target = q / 100. * self.count
+        cumulative = 0
+        for b, c in enumerate(self.counts):
+            cumulative += c
+            if cumulative >= target:
+                return 10 ** ((b + 0.5) / self.per_decade)
+
+    def summary(self, wall_s=None):
+        out = {"count": self.count, "total_s": self.total_ns * 1e-9,
+               "mean_ns": self.total_ns / self.count if self.count else None,
+               "p50_ns": self.percentile(50), "p90_ns": self.percentile(90), "p99_ns": self.percentile(99)}
+        if wall_s:
+            out["calls_per_s"] = self.count / wall_s
+        return out
+
+class ScanMetrics:
+    """Per-rank stage timers for one scan.
+
+    path - directory to which 'metrics_rank<r>.json' is written every
+           'flush_interval' seconds during the scan, and at its end (None to disable)
+    """
+    def __init__(self, path=None, flush_interval=10.):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.hists = {s: LatencyHistogram() for s in STAGES}
+        self.rank = 0
+        self._start = None
+        self._next_flush = float("inf") # no periodic flushes before start()
+        self._last_exit = None # end of the previous Python callback
+        self._inner = 0 # time spent in the user function during the current callback
+
+    def start(self, rank=0):
+        """Reset the timers and start the clock. Called in the process that runs the scan,
+           before the callbacks are wrapped."""
+        self.rank = rank
+        self.hists = {s: LatencyHistogram() for s in STAGES}
+        self._last_exit = None
+        self._start = time.perf_counter_ns()
+        self._next_flush = self._start + int(self.flush_interval * 1e9)
+
+    def timed_user(self, function, stage):
+        """Wrap a user function so that its duration is recorded under 'stage'"""
+        hist = self.hists[stage]
+        clock = time.perf_counter_ns
+        def timed(*args, **kwargs):
+            t0 = clock()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                dt = clock() - t0
+                hist.add(dt)
+                self._inner += dt
+        return timed
+
+    def timed_callback(self, callback, stage):
+        """Wrap a callback made by the scanner. Its own time (minus that of the wrapped
+           user function) goes to 'stage', and the time since the previous callback to 'sampler'."""
+        hist = self.hists[stage]
+        sampler = self.hists["sampler"]
+        clock = time.perf_counter_ns
+        def timed(*args):
+            t0 = clock()
+            if self._last_exit is not None:
+                sampler.add(t0 - self._last_exit)
+            self._inner = 0
+            try:
+                return callback(*args)
+            finally:
+                t1 = clock()
+                hist.add(t1 - t0 - self._inner)
+                self._last_exit = t1
+                if t1 >= self._next_flush:
+                    self._flush_at(t1)
+        return timed
+
+    def record(self, stage, ns, now=None):
+        """Add a duration measured by the caller (e.g. for a whole batch of points)"""
+        self.hists[stage].add(ns)
+        if now is not None and now >= self._next_flush:
+            self._flush_at(now)
+
+    def _flush_at(self, now):
+        self._next_flush = now + int(self.flush_interval * 1e9)
+        self.flush()
+
+    def summary(self):
+        wall_s = (time.perf_counter_ns() - self._start) * 1e-9 if self._start else None
+        return {"rank": self.rank, "wall_s": wall_s,
+                "stages": {s: h.summary(wall_s) for s, h in self.hists.items()}}
+
+    def flush(self):
+        """Write the current summary to <path>/metrics_rank<r>.json (atomically)"""
+        if self.path is None:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        fname = os.path.join(self.path, "metrics_rank{0}.json".format(self.rank))
+        out = self.summary()
+        out["time"] = time.time()
+        with open(fname + ".tmp", "w") as f:
+            json.dump(out, f, indent=1)
+        os.replace(fname + ".tmp", fname)
+
+def write_attributes(group, summaries):
+    """Store per-rank summaries as attributes 'metrics_rank<r>_<stage>_<statistic>' of a HDF5 group"""
+    for summary in summaries:
+        prefix = "metrics_rank{0}".format(summary["rank"])
+        group.attrs[prefix + "_wall_s"] = summary["wall_s"] if summary["wall_s"] is not None else float("nan")
+        for stage, stats in summary["stages"].items():
+            for stat, value in stats.items():
+                group.attrs["{0}_{1}_{2}".format(prefix, stage, stat)] = value if value is not None else float("nan")
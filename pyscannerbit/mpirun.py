@@ -0,0 +1,102 @@
+"""Run a scan under several local MPI processes, launched from Python
+
+   Scan.scan(nprocs=N) pickles the scan, and starts
+
+       mpiexec -n N python -m pyscannerbit.mpirun <payload> <result prefix>
+
+   Every rank is a fresh process, so (as with processify) the scanner plugins
+   are loaded exactly once per process. Each rank writes its (result, error)
+   pair to '<result prefix>.<rank>', which the caller collects afterwards.
+
+   Like the 'spawn' start method of multiprocessing, functions defined in the
+   caller's main script are found by re-importing that script (as __mp_main__)
+   in every rank, so it must protect its own scan code with
+   'if __name__ == "__main__":'. Install 'cloudpickle' to also run functions
+   defined interactively, e.g. in notebooks.
+"""
+
+import os
+import sys
+import shlex
+import shutil
+import pickle
+import tempfile
+import traceback
+import subprocess
+import multiprocessing.spawn
+
+def mpiexec_command():
+    """Command used to launch MPI jobs. Override with the PYSCANNERBIT_MPIEXEC environment variable."""
+    return shlex.split(os.environ.get("PYSCANNERBIT_MPIEXEC", "mpiexec"))
+
+def _clean_env():
+    """Environment for mpiexec, without the variables left behind by MPI initialisation in this
+       (singleton) process, which would otherwise confuse the launcher"""
+    from . import _initial_environ
+    return {k: v for k, v in os.environ.items()
+            if k in _initial_environ or not k.startswith(("OMPI_", "PMIX_", "PMI_"))}
+
+def launch(nprocs, *args):
+    """Run _run_scan(*args) on 'nprocs' local MPI processes, and return the list of
+       per-rank results. Raises RuntimeError if any rank failed."""
+    from .processify import _task_pickle, _reraise
+    tmpdir = tempfile.mkdtemp(prefix="pyscannerbit_mpirun_")
+    try:
+        payload_path = os.path.join(tmpdir, "payload.pkl")
+        result_prefix = os.path.join(tmpdir, "result")
+        preparation = multiprocessing.spawn.get_preparation_data("pyscannerbit_mpirun")
+        preparation.pop("authkey", None) # Not picklable, and not needed since the ranks don't talk back via multiprocessing
+        with open(payload_path, "wb") as f:
+            pickle.dump(preparation, f)
+            f.write(_task_pickle.dumps(args))
+
+        cmd = mpiexec_command() + ["-n", str(nprocs), sys.executable, "-m", "pyscannerbit.mpirun",
+                                   payload_path, result_prefix]
+        p = subprocess.Popen(cmd, env=_clean_env())
+        try:
+            returncode = p.wait()
+        except KeyboardInterrupt:
+            print("CTRL-C detected, killing MPI scan processes...")
+            p.kill()
+            p.wait()
+            raise
+
+        results = []
+        for rank in range(nprocs):
+            try:
+                with open("{0}.{1}".format(result_prefix, rank), "rb") as f:
+                    results.append(pickle.load(f))
+            except (IOError, EOFError, pickle.UnpicklingError):
+                results.append(None) # the rank died before (or while) writing its result
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    for r in results:
+        if r is not None:
+            _reraise(r[1])
+    if returncode != 0 or None in results:
+        msg = "MPI scan launched with '{0}' failed with exit code {1}".format(" ".join(cmd), returncode)
+        raise RuntimeError(msg)
+    return [r[0] for r in results]
+
+def main(payload_path, result_prefix):
+    from mpi4py import MPI
+    rank = MPI.COMM_WORLD.Get_rank()
+    try:
+        with open(payload_path, "rb") as f:
+            multiprocessing.spawn.prepare(pickle.load(f))
+            args = pickle.load(f)
+        from .scan import _run_scan
+        result = (_run_scan.__wrapped__(*args), None)
+    except Exception:
+        ex_type, ex_value, tb = sys.exc_info()
+        result = (None, (ex_type, ex_value, ''.join(traceback.format_tb(tb))))
+    with open("{0}.{1}".format(result_prefix, rank), "wb") as f:
+        try:
+            pickle.dump(result, f)
+        except Exception:
+            # e.g. exception types that cannot be pickled
+            pickle.dump((None, (RuntimeError, RuntimeError(repr(result[1][1])), result[1][2] if result[1] else '')), f)
+
+if __name__ == "__main__":
+    main(*sys.argv[1:3])
@@ -1,6 +1,5 @@
 
 import numpy as np
-import h5py
 import time
 import csv
 import os
@@ -11,25 +10,22 @@ import unicodedata
 import operator
 import shlex
 
-import matplotlib.pyplot as plt
-import matplotlib.axes as axes
-import matplotlib.cm as cm
-import matplotlib.colors as colors
-import matplotlib.colorbar as colorbar
-import matplotlib as mpl
+# matplotlib and scipy are slow to import, so they (and everything built from
+# them: 'font' settings, colormaps, contour levels) are only set up once a
+# plotting function is used. See _init_plotting().
+_lazy = ["plt", "axes", "cm", "colors", "colorbar", "mpl", "sps", "rellevels", "chi2cmap", "margcmap"]
 
-import scipy.stats as sps
-
-from itertools import groupby
-from operator import itemgetter
+def __getattr__(name):
+    if name in _lazy:
+        _init_plotting()
+        return globals()[name]
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
 
 #global options that may be desired to be tweaked
 font = {'family' : 'serif',
         'weight' : 'normal',  #'bold'
         'size'   : 16,
         }
-mpl.rc('font', **font)
-#mpl.rc('text', usetex=True)
 
 #========Side tools===============================
 #mangle unicode strings into ascii strings
@@ -106,7 +102,6 @@ def un2str(x, xe, precision=2):
 #compute delta chi^2 for 68 and 95% 2D confidence regions 
 CLs = [0.68,0.95]
 df = 2  #two degrees of freedom in 2D profile likelihood plot
-rellevels = [sps.chi2.isf(1-CL,df) for CL in CLs]   #isf = inverse survival function (inverse of 1-cdf). returns chi2 value at boundary of specified confidence region
 
 #Define colormap for chi^2 plots
 #scaled colors go from 0 to 1, so we need to set a max value (chi^2=25 sounds good)
@@ -129,10 +124,6 @@ cdict = {
 'blue' :  ((s0, 0., 0.), (s1, 0., 0.), (s2, 0., 0.), (s3, 0., 0.), (s4, 0., 0.), (s5, 0., 0.))
 }
 
-#generate the colormap with 1024 interpolated values
-chi2cmap = colors.LinearSegmentedColormap('chi2_colormap', cdict, 1024)
-chi2cmap.set_bad('w',1.)    #set color (and alpha) for bad ('masked') values
-
 #cutsom colormap for marginalised posterior plots
 
 cdict2 = {
@@ -153,10 +144,35 @@ cdict4 = {
 'blue' :  ((0., 1., 1.), (.01, .3, .3), (.05, .1, .1), (1., 1., 1.))
 }
 
-#generate the colormap with 1024 interpolated values
-margcmap = colors.LinearSegmentedColormap('marg_colormap', cdict4, 1024)
 margconts = [0.68,0.95]
 
+def _init_plotting():
+    """Import matplotlib and scipy, apply 'font', and build the colormaps and
+       contour levels. Only does anything on the first call."""
+    global plt, axes, cm, colors, colorbar, mpl, sps, rellevels, chi2cmap, margcmap
+    if "mpl" in globals():
+        return
+    import matplotlib.pyplot as plt
+    import matplotlib.axes as axes
+    import matplotlib.cm as cm
+    import matplotlib.colors as colors
+    import matplotlib.colorbar as colorbar
+    import scipy.stats as sps
+
+    rellevels = [sps.chi2.isf(1-CL,df) for CL in CLs]   #isf = inverse survival function (inverse of 1-cdf). returns chi2 value at boundary of specified confidence region
+
+    #generate the colormap with 1024 interpolated values
+    chi2cmap = colors.LinearSegmentedColormap('chi2_colormap', cdict, 1024)
+    chi2cmap.set_bad('w',1.)    #set color (and alpha) for bad ('masked') values
+
+    #generate the colormap with 1024 interpolated values
+    margcmap = colors.LinearSegmentedColormap('marg_colormap', cdict4, 1024)
+
+    import matplotlib
+    matplotlib.rc('font', **font)
+    #matplotlib.rc('text', usetex=True)
+    mpl = matplotlib # set last: marks the set-up as done
+
 def getcols(structarr,colnames):
     """"helper function to retrieve a normal, unstructured numpy array from the
     structured array that the dataset returns
@@ -191,6 +207,93 @@ function on row {0}, dumping row...'.format(i))
     print('NaN count: ',len(data) - len(dataout))
     return dataout
 
+available_binops = ['min','max','sum','mean','count','argmin']
+
+def bin_index2d(x,y,nxbins,nybins):
+    """Flat bin index (x bin * nybins + y bin) of every point, for nxbins*nybins
+    equal bins spanning the range of the data. An axis on which all values are
+    equal (zero range) gets all points in its first bin. x and y must not contain NaNs.
+    """
+    eps = 1e-10     #shift for bin edge computation
+    index = np.zeros(len(x), dtype=np.int64)
+    for v, nbins, scale in [(x, nxbins, nybins), (y, nybins, 1)]:
+        vmin, vmax = v.min(), v.max()
+        if vmax > vmin:
+            index += scale*np.floor((1-eps)*(nbins)*(v-vmin)/(vmax-vmin)).astype(np.int64)
+    return index
+
+def binstat2d(x,y,z,nxbins,nybins,binops=('min',)):
+    """Vectorized 2d binning: reduce the z values of the points in each (x,y) bin.
+    Returns {binop: (nxbins, nybins) array} for each of 'binops':
+        'min', 'max', 'sum', 'mean' - of the z values in each bin
+        'count' - number of points in each bin
+        'argmin' - index (into x, y, z) of the point with the smallest z in each bin,
+                   the first one in case of ties
+    Bins are laid out as in bin2d. Points with NaN x or y are ignored, and so
+    are NaN z values (except for 'count'). Empty bins are NaN for 'min' and
+    'mean', 0 for 'max', 'sum' and 'count', and -1 for 'argmin'.
+    """
+    nxbins, nybins = int(nxbins), int(nybins)
+    for op in binops:
+        if op not in available_binops:
+            raise ValueError('Invalid binop value ({0}) supplied to bin2d'.format(op))
+    x, y, z = np.asarray(x), np.asarray(y), np.asarray(z, dtype=np.float64)
+    rows = np.flatnonzero(~(np.isnan(x) | np.isnan(y)))
+    nbins = nxbins*nybins
+    out = {}
+    if len(rows) == 0:
+        flat = np.zeros(0, dtype=np.int64)
+    else:
+        flat = bin_index2d(x[rows],y[rows],nxbins,nybins)
+    if 'count' in binops:
+        out['count'] = np.bincount(flat, minlength=nbins).reshape(nxbins,nybins)
+    good = ~np.isnan(z[rows])
+    rows, flat = rows[good], flat[good]
+    zs = z[rows]
+    occupied = np.bincount(flat, minlength=nbins) > 0
+    if 'min' in binops or 'argmin' in binops:
+        zmin = np.full(nbins, np.inf)
+        np.minimum.at(zmin, flat, zs)
+        if 'min' in binops:
+            out['min'] = np.where(occupied, zmin, np.nan)
+        if 'argmin' in binops:
+            # First point (lowest index) in each bin that attains the minimum
+            hit = zs == zmin[flat]
+            first = np.full(nbins, len(z), dtype=np.int64)
+            np.minimum.at(first, flat[hit], rows[hit])
+            out['argmin'] = np.where(occupied, first, -1)
+    if 'max' in binops:
+        zmax = np.full(nbins, -np.inf)
+        np.maximum.at(zmax, flat, zs)
+        out['max'] = np.where(occupied, zmax, 0.)
+    if 'sum' in binops or 'mean' in binops:
+        # np.bincount adds up the values of each bin in the order given. Sorting by
+        # z within each bin makes this the order of increasing z, as bin2d always did
+        order = np.argsort(zs)
+        # Stable sort by bin; numpy uses a (much faster) radix sort for 16 bit keys
+        key = flat[order].astype(np.uint16 if nbins <= 2**16 else np.int64)
+        order = order[np.argsort(key, kind='stable')]
+        sums = np.bincount(flat[order], weights=zs[order], minlength=nbins)
+        if 'sum' in binops:
+            out['sum'] = sums
+        if 'mean' in binops:
+            out['mean'] = np.full(nbins, np.nan)
+            out['mean'][occupied] = sums[occupied]/np.bincount(flat, minlength=nbins)[occupied]
+    return {op: a.reshape(nxbins,nybins) for op, a in out.items()}
+
+def credible_levels(binned,occupied=None):
+    """Replace the value of every occupied bin by the total probability of the bins at
+    least as high, i.e. the mass enclosed by the iso-probability-density contour on which
+    it sits (use this to compute smallest 68%, 95% Bayesian credible regions). Other bins
+    are set to 1. 'occupied' is a boolean array of the same shape (default: binned != 0).
+    """
+    flat = binned.ravel()
+    occupied = np.flatnonzero(flat if occupied is None else occupied.ravel())
+    out = np.ones(flat.shape)
+    order = occupied[np.argsort(-flat[occupied], kind='stable')] #sort bins by probability
+    out[order] = np.cumsum(flat[order])         #cumulative sum of probabilities
+    return out.reshape(binned.shape)
+
 def bin2d(data,nxbins,nybins,binop='min',doconts=False):
     """2d binning algorithm
     Args
@@ -199,60 +302,19 @@ def bin2d(data,nxbins,nybins,binop='min',doconts=False):
     binop - Operation to perform on bins. Available options:
         'min' - Returns the minimum z value for each bin
         'max' - Returns the maximum z value for each bin
+        'sum', 'mean', 'count', 'argmin' - see binstat2d
     nxbins - Number of bins to use in x direction
     nybins -    "      "              y   "
+    doconts - with binop='sum', also return the enclosed probability of each
+    bin (see credible_levels)
     """
-    x = data[:,0]
-    y = data[:,1]
-    #xbins = np.arange(min(x),
-    zvals = data[:,2]
-    eps = 1e-10     #shift for bin edge computation
-
-    xindexes = np.floor((1-eps)*(nxbins)*(x-min(x))/(max(x)-min(x)))
-    yindexes = np.floor((1-eps)*(nybins)*(y-min(y))/(max(y)-min(y)))
-    #print xindexes
-    #print yindexes
-    
-    outarray = np.zeros((nxbins,nybins))
-    #print outarray
-    
-    #grouped=[list(value) for key, value in groupby(sorted(zip(xindexes,yindexes,zvals)), key=itemgetter(0,1))]
-    grouped=[list(value) for key, value in groupby(sorted(zip(xindexes,yindexes,zvals)), key=itemgetter(0,1))]
-    bininds=[nybins*bin[0][0] + bin[0][1] for bin in grouped]  #these are the FLAT indices in the target array
-    #print("bininds:",bininds)
-    if binop=='min':
-        binvals=[min([el[2] for el in bin]) for bin in grouped]
-        #outarray[:,:] = 1e300
-        outarray[:,:] = np.nan
-    elif binop=='max':
-        binvals=[max([el[2] for el in bin]) for bin in grouped]
-        outarray[:,:] = 0
-    elif binop=='sum':
-        binvals=[sum([el[2] for el in bin]) for bin in grouped]
-        outarray[:,:] = 0
-    else:
+    if binop not in available_binops:
         raise ValueError('Invalid binop value ({0}) supplied to bin2d'.format(binop))
-
-    #print bininds
-    try:
-        outarray.flat[bininds] = binvals
-    except ValueError:
-        print("WARNING: nan's present in bin index lists, input data may\
-be degenerate in one or more dimensions.")
-        raise  
-    #Recompute the bins so that each one contains the total probability enclosed by the
-    #iso-probability-density contour on which it sits (use this to compute smallest 68%, 95% 
-    #Bayesian credible regions) (DESIGNED FOR USE WHEN BIN VALUE IS A PROBABILITY MASS)
     if binop=='sum' and doconts==True:
-        outarray2 = np.zeros((nxbins,nybins))
-        outarray2[:,:] = 1.
-        sb = np.array(sorted(zip(bininds,binvals), key=itemgetter(1), reverse=True)) #sort bins by probability
-        #print zip(sb[:,1],np.cumsum(sb[:,1]))[0:20]
-        #print zip(sb[:,1],np.cumsum(sb[:,1]))[-20:-1]
-        outarray2.flat[list(sb[:,0])] = list(np.cumsum(sb[:,1]))         #cumulative sum of probabilities
-        return outarray.transpose(), outarray2.transpose()
-        
-    return outarray.transpose()
+        binned = binstat2d(data[:,0],data[:,1],data[:,2],nxbins,nybins,('sum','count'))
+        outarray2 = credible_levels(binned['sum'], binned['count']>0)
+        return binned['sum'].transpose(), outarray2.transpose()
+    return binstat2d(data[:,0],data[:,1],data[:,2],nxbins,nybins,(binop,))[binop].transpose()
     
 def bin1d(data,nbins,binop='min'):
     """1d version of bin2d (in fact uses bin2d directly)
@@ -265,10 +327,9 @@ def bin1d(data,nbins,binop='min'):
     nbins - Number of bins to use 
     """
     x = data[:,0]
-    y = np.zeros(x.shape[0]) #"fake" y values to emulate the 2D binning
-    y[:x.shape[0]/2] = 1  #need at least two different y values so ymax - ymin != 0.
+    y = np.zeros(x.shape[0]) #"fake" y values, all in the one y bin
     z = data[:,1]
-    return bin2d(np.array(zip(x,y,z)),nbins,1,binop,doconts=False)[0]      #return 1d array of x vs binned values
+    return bin2d(np.column_stack((x,y,z)),nbins,1,binop,doconts=False)[0]      #return 1d array of x vs binned values
 
 def forceAspect(ax,aspect=1):
     extent = ax.get_window_extent().get_points()
@@ -299,6 +360,7 @@ def chi2scatplot(ax,data,title=None,labels=None,s=1):
         data[:,1] - y data
         data[:,2] - chi^2 data
     """
+    _init_plotting()
     data = data[data[:,2].argsort()[::-1]] #sort points by chi2 (want to plot lowest chi2 points last, achieved by reversing sorted indices via '::-1')
     plot = ax.scatter(data[:,0],data[:,1],c=np.sqrt(data[:,2]-min(data[:,2])),s=s,lw=0,cmap=chi2cmap, norm=colors.Normalize(vmin=mn,vmax=mx,clip=True))
     if title: ax.set_title(title)
@@ -312,6 +374,7 @@ def chi2scatplot(ax,data,title=None,labels=None,s=1):
 def chi2logscatplot(ax,data,title=None,labels=None):
     """Creates a scatter plot of the data, colored by Delta chi^2 value
     """
+    _init_plotting()
     data = data[data[:,2].argsort()[::-1]] #sort points by chi2 (want to plot lowest chi2 points last, achieved by reversing sorted indices via '::-1')
     plot = ax.scatter(data[:,0],data[:,1],c=np.sqrt(data[:,2]-min(data[:,2])),s=1,lw=0,cmap=chi2cmap, norm=colors.Normalize(vmin=mn,vmax=mx,clip=True))
     ax.set_yscale('log')
@@ -323,20 +386,27 @@ def chi2logscatplot(ax,data,title=None,labels=None):
     ax.grid(True)
     return plot
     
+def _drop_nan_xy(data):
+    """Rows of data without NaN in the x or y column (NaN z values are ignored by the binning)"""
+    keep = ~(np.isnan(data[:,0]) | np.isnan(data[:,1]))
+    return data if keep.all() else data[keep]
+
 def profplot(ax,data,title=None,labels=None,nybins=100,nxbins=None):
     """Creates a binned, profiled plot of the data, colored by Delta chi^2 value,
     i.e. profile likelihood.
     """
+    _init_plotting()
+    data = _drop_nan_xy(data)
     if nxbins is None:
         nxbins=np.floor(1.618*nybins)
     x = data[:,0]
     y = data[:,1]
-    wx= (max(x)-min(x))/nxbins
-    wy= (max(y)-min(y))/nybins
+    wx= (np.max(x)-np.min(x))/nxbins
+    wy= (np.max(y)-np.min(y))/nybins
     #print(min(x),max(x),wx)
     #print(min(y),max(y),wy)
-    xlist = np.arange(min(x),max(x)-wx*10e-3,wx)   #tiny shift to prevent nbins+1 bins in X and Y arrays
-    ylist = np.arange(min(y),max(y)-wy*10e-3,wy)
+    xlist = np.arange(np.min(x),np.max(x)-wx*10e-3,wx)   #tiny shift to prevent nbins+1 bins in X and Y arrays
+    ylist = np.arange(np.min(y),np.max(y)-wy*10e-3,wy)
     #print(len(xlist), len(ylist))
     
     outarray = bin2d(data,nxbins,nybins,binop='min')
@@ -354,7 +424,7 @@ def profplot(ax,data,title=None,labels=None,nybins=100,nxbins=None):
     #print masked_array[0:20,0:20]
     
     im = ax.imshow(masked_array, origin='lower', interpolation='nearest',
-                    extent=(min(xlist),max(xlist)+wx,min(ylist),max(ylist)+wy),
+                    extent=(np.min(xlist),np.max(xlist)+wx,np.min(ylist),np.max(ylist)+wy),
                     cmap=chi2cmap, norm=colors.Normalize(vmin=mn,vmax=mx,clip=True), aspect='auto')
     
     CS = ax.contour(X+wx/2, Y+wy/2, outarray - minchi2, levels=rellevels, lw=3) #colors=['g','y','r']
@@ -364,8 +434,8 @@ def profplot(ax,data,title=None,labels=None,nybins=100,nxbins=None):
     
     if labels: ax.set_xlabel(labels[0])
     if labels: ax.set_ylabel(labels[1])
-    ax.set_xlim(min(data[:,0]),max(data[:,0]))
-    ax.set_ylim(min(data[:,1]),max(data[:,1]))
+    ax.set_xlim(np.min(data[:,0]),np.max(data[:,0]))
+    ax.set_ylim(np.min(data[:,1]),np.max(data[:,1]))
     ax.grid(True)
     
     return im
@@ -374,21 +444,23 @@ def margplot(ax,data,nxbins=100,nybins=100,title=None,labels=None):
     """Creates a binned marginalised plot of the data, colored by marginalised posterior
     density.
     """
+    _init_plotting()
+    data = _drop_nan_xy(data)
     x = data[:,0]
     y = data[:,1]
-    wx= (max(x)-min(x))/nxbins
-    wy= (max(y)-min(y))/nybins
-    xlist = np.arange(min(x),max(x)-wx*10e-3,wx)    #tiny shift to prevent nbins+1 bins in X and Y arrays
-    ylist = np.arange(min(y),max(y)-wy*10e-3,wy)
+    wx= (np.max(x)-np.min(x))/nxbins
+    wy= (np.max(y)-np.min(y))/nybins
+    xlist = np.arange(np.min(x),np.max(x)-wx*10e-3,wx)    #tiny shift to prevent nbins+1 bins in X and Y arrays
+    ylist = np.arange(np.min(y),np.max(y)-wy*10e-3,wy)
     
     outarraydens, outarrayconts = bin2d(data,nxbins,nybins,binop='sum',doconts=True)
     X, Y = np.meshgrid(xlist,ylist)
-    maxpoint = max(outarraydens.flat)
+    maxpoint = np.max(outarraydens)
 
     #print(X.shape, Y.shape, outarraydens.shape, outarrayconts.shape, max(outarrayconts.flat))
     
     im = ax.imshow(outarraydens, origin='lower', interpolation='nearest',
-                    extent=(min(xlist),max(xlist)+wx,min(ylist),max(ylist)+wy),
+                    extent=(np.min(xlist),np.max(xlist)+wx,np.min(ylist),np.max(ylist)+wy),
                     cmap=margcmap, aspect='auto')
     
     CS = ax.contour(X+wx/2, Y+wy/2, outarrayconts, levels=margconts, lw=3, colors=[(0,1,0),(1,1,0)])    #(r,g,b)
@@ -398,12 +470,64 @@ def margplot(ax,data,nxbins=100,nybins=100,title=None,labels=None):
     
     if labels: ax.set_xlabel(labels[0])
     if labels: ax.set_ylabel(labels[1])
-    ax.set_xlim(min(data[:,0]),max(data[:,0]))
-    ax.set_ylim(min(data[:,1]),max(data[:,1]))
+    ax.set_xlim(np.min(data[:,0]),np.max(data[:,0]))
+    ax.set_ylim(np.min(data[:,1]),np.max(data[:,1]))
     ax.grid(True)
     
     return im
 
+def _gridimage(ax,grid,xedges,yedges,**kwargs):
+    """Draw a (ny, nx) grid of bins with the given edges, as imshow (for equal bins, as
+    profplot and margplot do) or pcolormesh"""
+    if np.allclose(np.diff(xedges), xedges[1]-xedges[0]) and np.allclose(np.diff(yedges), yedges[1]-yedges[0]):
+        return ax.imshow(grid, origin='lower', interpolation='nearest',
+                    extent=(xedges[0],xedges[-1],yedges[0],yedges[-1]), aspect='auto', **kwargs)
+    return ax.pcolormesh(xedges, yedges, grid, **kwargs)
+
+def _gridlabels(ax,xedges,yedges,title,labels):
+    if title: ax.set_title(title)
+    if labels: ax.set_xlabel(labels[0])
+    if labels: ax.set_ylabel(labels[1])
+    ax.set_xlim(xedges[0],xedges[-1])
+    ax.set_ylim(yedges[0],yedges[-1])
+    ax.grid(True)
+
+def profgrid(ax,chi2,xedges,yedges,title=None,labels=None):
+    """Profile likelihood plot, as profplot, of an already binned grid of minimum chi^2
+    values (shape (len(xedges)-1, len(yedges)-1), NaN for empty bins), e.g. from
+    reducers.ProfileLikelihood2D.
+    """
+    _init_plotting()
+    outarray = np.asarray(chi2).transpose()
+    X, Y = np.meshgrid(0.5*(xedges[1:]+xedges[:-1]), 0.5*(yedges[1:]+yedges[:-1]))
+    minchi2 = np.nanmin(outarray)  #get min ignoring nans
+    Dchi2 = np.sqrt(outarray - minchi2)
+    masked_array = np.ma.array(Dchi2, mask=np.isnan(Dchi2)) #masked values get a special color, see chi2cmap
+    im = _gridimage(ax, masked_array, xedges, yedges,
+                    cmap=chi2cmap, norm=colors.Normalize(vmin=mn,vmax=mx,clip=True))
+    ax.contour(X, Y, outarray - minchi2, levels=rellevels)
+    bfidx = np.nanargmin(outarray) #flat index of best fit point
+    ax.plot([X.flat[bfidx]], [Y.flat[bfidx]], "ko")
+    _gridlabels(ax,xedges,yedges,title,labels)
+    return im
+
+def marggrid(ax,mass,xedges,yedges,occupied=None,title=None,labels=None):
+    """Marginalised posterior plot, as margplot, of an already binned grid of posterior
+    masses (shape (len(xedges)-1, len(yedges)-1)), e.g. from reducers.MarginalPosterior2D.
+    'occupied' flags the bins that contain points (default: those with non-zero mass).
+    """
+    _init_plotting()
+    mass = np.asarray(mass)
+    outarraydens = mass.transpose()
+    outarrayconts = credible_levels(mass, occupied).transpose()
+    X, Y = np.meshgrid(0.5*(xedges[1:]+xedges[:-1]), 0.5*(yedges[1:]+yedges[:-1]))
+    im = _gridimage(ax, outarraydens, xedges, yedges, cmap=margcmap)
+    ax.contour(X, Y, outarrayconts, levels=margconts, colors=[(0,1,0),(1,1,0)])    #(r,g,b)
+    bfidx = np.argmax(outarraydens) #flat index of highest density bin
+    ax.plot([X.flat[bfidx]], [Y.flat[bfidx]], "ko")
+    _gridlabels(ax,xedges,yedges,title,labels)
+    return im
+
 def margplot1D(ax,data,title=None,labels=None,trim=True):
     """Creates a 1D binned marginalised plot of the data
     Args:
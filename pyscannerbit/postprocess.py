@@ -0,0 +1,292 @@
+"""Re-evaluate a new likelihood (or extra observables) over the points of an existing scan
+
+   postprocess() reads the parameter values of the valid points of a scan
+   output, chunk by chunk, evaluates a new function on them in parallel (a
+   local process pool, and/or MPI ranks), and writes the results back as new
+   columns in the ScannerBit layout, i.e. each '<name>' with a '<name>_isvalid'
+   twin, aligned with the existing rows. Anything the function sends to
+   scan.print() becomes a column too.
+
+   Progress is saved after every chunk, so an interrupted run picks up where
+   it stopped when postprocess() is called again with the same arguments.
+
+   Output goes either into the scan output itself, or into a 'sidecar' HDF5
+   file. The sidecar group also links (via HDF5 external links) to all the
+   original datasets, so that HDF5.fromFile(sidecar, group) sees old and new
+   columns together.
+"""
+
+import os
+import inspect
+import numpy as np
+
+from .hdf5_help import HDF5
+from .batch import BatchScanInterface
+from .scan import _CallAdapter, _mpi, SanityCheckException
+
+_CHECKPOINT = "postprocess_rows"
+
+class _PointScan:
+    """Stand-in for the ScannerBit object passed as 'scan' when re-evaluating single points"""
+    def __init__(self):
+        self._printed = {}
+
+    def print(self, name, value):
+        self._printed[name] = value
+
+    def _pop_printed(self):
+        printed = self._printed
+        self._printed = {}
+        return printed
+
+class _Evaluator:
+    """Evaluates the user function on a block of points, given as an (N, ndim) array"""
+    def __init__(self, function, keys, kwargs, par_format, vectorized):
+        self.function = function
+        self.keys = keys
+        self.kwargs = kwargs or {}
+        self.par_format = par_format
+        self.vectorized = vectorized
+        self._adapter = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_adapter"] = None
+        return state
+
+    def __call__(self, x):
+        if self.vectorized:
+            return self._evaluate_batch(x)
+        if self._adapter is None:
+            self._adapter = _CallAdapter(self.function, self.keys, self.kwargs, self.par_format).compile()
+        n = len(x)
+        values = np.empty(n)
+        printed = {}
+        scan = _PointScan()
+        for i, row in enumerate(x):
+            values[i] = self._adapter(scan, dict(zip(self.keys, row)))
+            for name, value in scan._pop_printed().items():
+                if name not in printed:
+                    printed[name] = np.full(n, np.nan)
+                printed[name][i] = value
+        return values, printed
+
+    def _evaluate_batch(self, x):
+        scan = BatchScanInterface()
+        if self.par_format == "array":
+            values = self.function(scan, x, **self.kwargs)
+        elif self.par_format == "tuple":
+            values = self.function(scan, tuple(x.T), **self.kwargs)
+        else:
+            values = self.function(scan, *x.T, **self.kwargs)
+        values = np.asarray(values, dtype=np.float64)
+        if values.shape != (len(x),):
+            msg = "Vectorized function returned an array of shape {0}, however it was given a batch of {1} points! It should return one value per point.".format(values.shape, len(x))
+            raise ValueError(msg)
+        return values, scan._pop_printed()
+
+# Evaluator of the current pool worker, inherited when the pool is forked
+_worker_evaluator = None
+
+def _init_worker(evaluator):
+    global _worker_evaluator
+    _worker_evaluator = evaluator
+
+def _evaluate_in_worker(x):
+    return _worker_evaluator(x)
+
+def _argument_names(function, fargs, par_format):
+    if fargs is not None:
+        return list(fargs)
+    if par_format != "args":
+        msg = "Parameter names cannot be inferred from the signature of the function when par_format='{0}'! Please supply them via the 'fargs' argument.".format(par_format)
+        raise SanityCheckException(msg)
+    par_names = list(inspect.signature(function).parameters.keys())
+    if par_names[0] != "scan":
+        raise SanityCheckException("The first argument of the post-processing function must be named 'scan', as for the likelihood function of Scan.")
+    return par_names[1:]
+
+def _open_source(source, writable):
+    """HDF5 object to read from, and the h5py.File to close afterwards (or None)"""
+    if isinstance(source, HDF5):
+        if writable and source.file.mode != "r+":
+            raise ValueError("The results in {0} are open read-only, so new columns cannot be added to them. Please pass the file name instead, or write to a 'sidecar' file.".format(source.file.filename))
+        return source, None
+    import h5py
+    from . import h5pool
+    filename, group = (source, "/") if isinstance(source, str) else source
+    if writable:
+        h5pool.evict(filename)
+    f = h5py.File(filename, "a" if writable else "r")
+    return HDF5(f[group].id), f
+
+def _output_group(h5, sidecar):
+    """Group to write the new columns to, and its file if it has to be closed afterwards"""
+    if sidecar is None:
+        return h5, None
+    import h5py
+    from . import h5pool
+    h5pool.evict(sidecar)
+    f = h5py.File(sidecar, "a")
+    g = f.require_group(h5.name)
+    target = os.path.relpath(os.path.abspath(h5.file.filename), os.path.dirname(os.path.abspath(sidecar)))
+    for k in h5.keys():
+        if k not in g:
+            g[k] = h5py.ExternalLink(target, "{0}/{1}".format(h5.name.rstrip("/"), k))
+    return g, f
+
+def _attrs(g, name):
+    """Attributes of dataset 'name', or {} for a link to the original output of a sidecar
+       (which must not be resolved, since the linked file is open read-only)"""
+    import h5py
+    if isinstance(g.get(name, getlink=True), h5py.ExternalLink):
+        return {}
+    return g[name].attrs
+
+def _require_column(g, name, nrows, dtype=np.float64):
+    if name not in g:
+        g.create_dataset(name, shape=(nrows,), dtype=dtype, chunks=True)
+        g.create_dataset("{0}_isvalid".format(name), shape=(nrows,), dtype=np.int8, chunks=True)
+        g[name].attrs["postprocessed"] = True
+    elif not _attrs(g, name).get("postprocessed", False):
+        raise ValueError("Column '{0}' printed by the post-processing function already exists in {1}!".format(name, g.name))
+    return g[name], g["{0}_isvalid".format(name)]
+
+def _start_row(g, name, overwrite):
+    """Row to (re)start from: 0 for a new column, the checkpoint of an interrupted run"""
+    if name not in g:
+        return 0
+    done = _attrs(g, name).get(_CHECKPOINT)
+    if done is None and not overwrite:
+        raise ValueError("Column '{0}' already exists in {1}! Please choose another name, or set overwrite=True.".format(name, g.name))
+    if done is None or overwrite:
+        del g[name]
+        del g["{0}_isvalid".format(name)]
+        return 0
+    return int(done)
+
+def _evaluate(evaluator, x, pool, nparts):
+    if len(x) == 0:
+        return np.empty(0), {}
+    if pool is None or len(x) < 2:
+        return evaluator(x)
+    results = pool.map(_evaluate_in_worker, np.array_split(x, nparts))
+    return _concatenate(results)
+
+def _concatenate(results):
+    """Join the (values, printed) results of consecutive blocks of points"""
+    values = np.concatenate([r[0] for r in results])
+    names = []
+    for r in results:
+        names += [n for n in r[1] if n not in names]
+    printed = {}
+    for n in names:
+        printed[n] = np.concatenate([np.asarray(r[1][n], dtype=np.float64) if n in r[1]
+                                     else np.full(len(r[0]), np.nan) for r in results])
+    return values, printed
+
+def postprocess(source, function, name, fargs=None, kwargs=None, par_format="args", vectorized=False,
+  sidecar=None, require=None, invalid_below=None, chunk_rows=2**16, processes=None, use_mpi=False, overwrite=False):
+    """Evaluate 'function' at every valid point of a scan output, and store the results as column 'name'
+
+       source - HDF5 object (opened writable, unless 'sidecar' is used), file name (group '/'),
+                or (file name, group) pair
+       function - Called like the likelihood function of Scan, i.e. function(scan, x, y, ...)
+                  with parameter names from its signature (or 'fargs'), 'kwargs', and
+                  'par_format'. With vectorized=True it receives whole arrays of points
+                  and must return an array, as for Scan(vectorized=True).
+       sidecar - Write the new columns to this HDF5 file instead of into 'source'
+       require - Columns that must be valid for a point to be evaluated, in addition to the
+                 parameters (default: the LogLike column)
+       invalid_below - Values below this (and non-finite values) are flagged invalid
+       chunk_rows - Points read, evaluated and checkpointed at a time
+       processes - Size of the local process pool to evaluate each chunk with (default: no pool)
+       use_mpi - Also split each chunk over the MPI ranks. Every rank must call postprocess(),
+                 only rank 0 reads and writes the file.
+       overwrite - Replace an existing column 'name' (or restart an interrupted run)
+
+       Returns the list of columns written (on MPI rank 0; None on the other ranks).
+    """
+    comm = _mpi().COMM_WORLD if use_mpi else None
+    rank = comm.Get_rank() if comm is not None else 0
+    nranks = comm.Get_size() if comm is not None else 1
+    argument_names = _argument_names(function, fargs, par_format)
+
+    f_in = f_out = None
+    pool = None
+    try:
+        if rank == 0:
+            h5, f_in = _open_source(source, writable=sidecar is None)
+            keys = [h5._resolve(n) for n in argument_names]
+            require = [h5.loglike] if require is None else list(require)
+            check = keys + [h5._resolve(c) for c in require]
+            nrows = min(h5[k].shape[0] for k in check)
+            out, f_out = _output_group(h5, sidecar)
+            start = _start_row(out, name, overwrite)
+            written = [name]
+            header = keys
+        else:
+            header = None
+        if comm is not None:
+            header = comm.bcast(header, root=0)
+        evaluator = _Evaluator(function, header, kwargs, par_format, vectorized)
+        if processes is not None and processes > 1:
+            import multiprocessing
+            pool = multiprocessing.get_context("fork").Pool(processes, initializer=_init_worker, initargs=(evaluator,))
+
+        while True:
+            if rank == 0:
+                if start >= nrows:
+                    block = None
+                else:
+                    stop = min(start + chunk_rows, nrows)
+                    valid = np.logical_and.reduce([np.array(h5["{}_isvalid".format(k)][start:stop], dtype=np.bool_) for k in check])
+                    x = np.column_stack([h5[k][start:stop] for k in keys])[valid]
+                    block = np.array_split(x, nranks)
+            else:
+                block = None
+            if comm is not None:
+                if comm.bcast(block is None, root=0):
+                    break
+                block = comm.scatter(block, root=0)
+            elif block is None:
+                break
+            else:
+                block = block[0]
+            result = _evaluate(evaluator, block, pool, processes)
+            if comm is not None:
+                results = comm.gather(result, root=0)
+                if rank != 0:
+                    continue
+                result = _concatenate(results)
+
+            # Write this chunk (rank 0), then record how far we got
+            values, printed = result
+            columns = dict(printed)
+            columns[name] = values
+            for n, v in columns.items():
+                v = np.asarray(v, dtype=np.float64)
+                ok = np.isfinite(v)
+                if n == name and invalid_below is not None:
+                    ok &= v >= invalid_below
+                d, dv = _require_column(out, n, nrows)
+                full = np.zeros(stop - start)
+                full_ok = np.zeros(stop - start, dtype=np.int8)
+                full[valid] = v
+                full_ok[valid] = ok
+                d[start:stop] = full
+                dv[start:stop] = full_ok
+                if n not in written:
+                    written.append(n)
+            out[name].attrs[_CHECKPOINT] = stop
+            out.file.flush()
+            start = stop
+        return written if rank == 0 else None
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if f_out is not None:
+            f_out.close()
+        if f_in is not None:
+            f_in.close()
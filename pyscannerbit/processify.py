@@ -5,10 +5,140 @@
 
 import os
 import sys
+import time
+import queue
 import signal
+import pickle
+import atexit
 import traceback
 from functools import wraps
-from multiprocessing import Process, Queue
+from multiprocessing import Process, Queue, Pipe
+
+# cloudpickle (optional) can also serialise closures and functions defined
+# interactively, which makes more tasks eligible for the warm worker pool
+try:
+    import cloudpickle as _task_pickle
+except ImportError:
+    _task_pickle = pickle
+
+class _Unpicklable:
+    """Marker sent back by a pool worker that could not unpickle its task.
+       It arrives as a new object, so test for it with isinstance()."""
+
+_UNPICKLABLE = _Unpicklable()
+
+class _ConnQueue:
+    """Minimal Queue look-alike on top of one end of a Pipe"""
+    def __init__(self, conn):
+        self.conn = conn
+
+    def put(self, obj):
+        self.conn.send(obj)
+
+def _pool_worker(conn, initializer):
+    """Body of a pool worker process: initialise, wait for exactly one task, run it, exit"""
+    init_error = None
+    if initializer is not None:
+        try:
+            initializer()
+        except Exception:
+            ex_type, ex_value, tb = sys.exc_info()
+            init_error = ex_type, ex_value, ''.join(traceback.format_tb(tb))
+    try:
+        payload = conn.recv_bytes()
+    except EOFError:
+        return # Pool was shut down before this worker was used
+    try:
+        process_func, args, kwargs = pickle.loads(payload)
+    except Exception:
+        conn.send(_UNPICKLABLE)
+        return
+    if init_error:
+        conn.send((None, init_error))
+        return
+    process_func(_ConnQueue(conn), *args, **kwargs)
+
+class WorkerPool:
+    """Pool of pre-started worker processes for processify'd functions.
+
+    Each worker runs 'initializer' (e.g. to import and dlopen expensive
+    libraries) as soon as it starts, and then waits for a single task.
+    Workers are thrown away after their task, since e.g. ScannerBit plugins
+    can only be run once per process.
+
+    size - maximum number of worker processes alive at once (busy or idle)
+    prefetch - number of idle, pre-initialised workers to keep ready
+    """
+    def __init__(self, size=1, prefetch=1, initializer=None):
+        if prefetch > size:
+            raise ValueError("WorkerPool prefetch ({0}) cannot exceed the pool size ({1})".format(prefetch, size))
+        self.size = size
+        self.prefetch = prefetch
+        self.initializer = initializer
+        self._idle = []
+        self._busy = 0
+        self._closed = False
+        atexit.register(self.close)
+
+    def _spawn(self):
+        parent_conn, child_conn = Pipe()
+        p = Process(target=_pool_worker, args=(child_conn, self.initializer))
+        p.daemon = True
+        p.start()
+        child_conn.close()
+        self._idle.append((p, parent_conn))
+
+    def fill(self):
+        """Start workers until 'prefetch' of them are idle (within the size limit)"""
+        while not self._closed and len(self._idle) < self.prefetch \
+          and len(self._idle) + self._busy < self.size:
+            self._spawn()
+
+    def _take(self):
+        if not self._idle:
+            if self._busy >= self.size:
+                raise RuntimeError("All {0} workers of the pool are busy!".format(self.size))
+            self._spawn()
+        worker = self._idle.pop(0)
+        self._busy += 1
+        return worker
+
+    def _release(self, p, conn):
+        conn.close()
+        p.join()
+        self._busy -= 1
+        self.fill()
+
+    def run(self, process_func, args, kwargs):
+        """Run a task in a warm worker. Returns the (ret, error) pair produced by
+           process_func, or _UNPICKLABLE if the task could not be sent to a worker."""
+        try:
+            payload = _task_pickle.dumps((process_func, list(args), kwargs))
+        except Exception:
+            return _UNPICKLABLE
+        p, conn = self._take()
+        try:
+            conn.send_bytes(payload)
+            result = conn.recv()
+        except KeyboardInterrupt:
+            print("CTRL-C detected, killing scan subprocess...")
+            os.kill(p.pid, signal.SIGKILL)
+            quit()
+        except EOFError:
+            result = (None, (RuntimeError, RuntimeError("Pool worker died without returning a result (exit code {0})".format(p.exitcode)), ''))
+        finally:
+            self._release(p, conn)
+        return result
+
+    def close(self):
+        """Shut down all idle workers"""
+        self._closed = True
+        for p, conn in self._idle:
+            conn.close()
+            p.join(timeout=1)
+            if p.is_alive():
+                p.terminate()
+        self._idle = []
 
 def processify(func):
     '''Decorator to run a function as a process.
@@ -33,10 +163,19 @@ def processify(func):
     # register original function with different name
     # in sys.modules so it is pickable
     process_func.__name__ = func.__name__ + 'processify_func'
+    process_func.__qualname__ = process_func.__name__
     setattr(sys.modules[__name__], process_func.__name__, process_func)
 
     @wraps(func)
     def wrapper(*args, **kwargs):
+        if wrapper.pool is not None:
+            result = wrapper.pool.run(process_func, args, kwargs)
+            if not isinstance(result, _Unpicklable):
+                ret, error = result
+                _reraise(error)
+                return ret
+            # Otherwise fall back to forking a fresh process, which needs no pickling
+
         q = Queue()
         p = Process(target=process_func, args=[q] + list(args), kwargs=kwargs)
         try:
@@ -49,14 +188,79 @@ def processify(func):
            os.kill(p.pid, signal.SIGKILL)
            quit()
 
-        if error:
-            ex_type, ex_value, tb_str = error
-            message = '%s (in subprocess)\n%s' % (ex_value.args, tb_str)
-            raise ex_type(message)
-
+        _reraise(error)
         return ret
+
+    def submit(*args, **kwargs):
+        """Start the function in a new process without waiting for it.
+        Returns a ProcessHandle."""
+        q = Queue()
+        p = Process(target=process_func, args=[q] + list(args), kwargs=kwargs)
+        p.start()
+        return ProcessHandle(p, q)
+
+    # Optional WorkerPool to take warm worker processes from, instead of
+    # forking a new process for every call
+    wrapper.pool = None
+    wrapper.submit = submit
     return wrapper
 
+class ProcessHandle:
+    """Handle on a processify'd function started with .submit()"""
+    def __init__(self, process, q):
+        self.process = process
+        self.q = q
+        self._outcome = None
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def done(self):
+        """True if the subprocess has finished (or died, or was cancelled)"""
+        if self._outcome is None:
+            try:
+                self._outcome = self.q.get_nowait()
+            except queue.Empty:
+                if self.process.is_alive():
+                    return False
+                # Result may still be in flight from a process that just exited
+                try:
+                    self._outcome = self.q.get(timeout=0.1)
+                except queue.Empty:
+                    msg = "Subprocess exited with code {0} without returning a result".format(self.process.exitcode)
+                    self._outcome = (None, (RuntimeError, RuntimeError(msg), ''))
+            self.process.join()
+        return True
+
+    def result(self, timeout=None, poll_interval=0.05):
+        """Wait for the subprocess and return its result, re-raising any exception"""
+        start = time.time()
+        while not self.done():
+            if timeout is not None and time.time() - start > timeout:
+                raise TimeoutError("Subprocess {0} did not finish within {1} s".format(self.pid, timeout))
+            time.sleep(poll_interval)
+        ret, error = self._outcome
+        _reraise(error)
+        return ret
+
+    def cancel(self):
+        """Kill the subprocess if it is still running. Returns True if it was killed."""
+        if self.done():
+            return False
+        self.process.terminate()
+        self.process.join()
+        msg = "Subprocess {0} was cancelled".format(self.pid)
+        self._outcome = (None, (RuntimeError, RuntimeError(msg), ''))
+        return True
+
+def _reraise(error):
+    """Re-raise an exception caught in a subprocess"""
+    if error:
+        ex_type, ex_value, tb_str = error
+        message = '%s (in subprocess)\n%s' % (ex_value.args, tb_str)
+        raise ex_type(message)
+
 
 @processify
 def test_function():
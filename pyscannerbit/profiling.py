@@ -0,0 +1,138 @@
+"""Profiling of the likelihood and prior callbacks inside the scan subprocess
+
+   Profiling Scan.scan() from the parent process only shows it waiting for the
+   scan subprocess, so the profiler has to run in the subprocess (or in every
+   MPI rank) itself. Two modes are available:
+
+     'cprofile' - deterministic profiling with cProfile, switched on only while
+                  the likelihood or prior callbacks run. Results are returned as
+                  a pstats.Stats object (merged over ranks).
+     'sampling' - the Python stack is sampled every 'interval' seconds of CPU
+                  time (via SIGPROF). Results are collapsed stacks, i.e. a dict of
+                  'root;frame;frame' -> count, which flamegraph tools can read.
+                  Samples taken outside the callbacks are counted under
+                  '[sampler]', and give the share of time spent in the scanner.
+"""
+
+import os
+import cProfile
+import pstats
+import signal
+from collections import Counter
+
+modes = ["cprofile", "sampling"]
+
+class _StatsHolder:
+    """Minimal stand-in for a cProfile.Profile, so that raw stats can be loaded by pstats"""
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+class ScanProfiler:
+    """Profiler configuration, sent to the process that runs the scan.
+
+    mode - 'cprofile' or 'sampling'
+    interval - sampling interval in seconds (sampling mode)
+    output - optional file to write the merged results to, in pstats format
+             (cprofile mode) or as collapsed stacks, one 'stack count' per line
+             (sampling mode)
+    """
+    def __init__(self, mode="cprofile", interval=0.001, output=None):
+        if mode not in modes:
+            raise ValueError("Unknown profiler mode '{0}'! Please choose one of {1}".format(mode, modes))
+        self.mode = mode
+        self.interval = interval
+        self.output = output
+        self._profile = None
+        self._stacks = None
+        self._active = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_profile"] = None
+        return state
+
+    def start(self):
+        """Start profiling. Called in the process that runs the scan."""
+        self._active = None
+        if self.mode == "cprofile":
+            self._profile = cProfile.Profile()
+        else:
+            self._stacks = Counter()
+            signal.signal(signal.SIGPROF, self._sample)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        if self.mode == "sampling":
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def wrap(self, callback, name):
+        """Profile calls of 'callback' (one of the functions ScannerBit calls), labelled 'name'"""
+        if self.mode == "cprofile":
+            profile = self._profile
+            def profiled(*args):
+                profile.enable()
+                try:
+                    return callback(*args)
+                finally:
+                    profile.disable()
+            return profiled
+
+        def profiled(*args):
+            self._active = name
+            try:
+                return callback(*args)
+            finally:
+                self._active = None
+        return profiled
+
+    def _sample(self, signum, frame):
+        if self._active is None:
+            # The interpreter only runs signal handlers between Python instructions,
+            # so a signal received while the scanner (C++) runs arrives here at the
+            # start of the next callback, before it is marked active.
+            self._stacks["[sampler]"] += 1
+            return
+        names = []
+        # Walk up to the frame of the 'profiled' wrapper of the active callback
+        while frame is not None and frame.f_code.co_name != "profiled":
+            code = frame.f_code
+            names.append("{0} ({1}:{2})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        self._stacks[";".join([self._active] + names[::-1])] += 1
+
+    def result(self):
+        """Picklable profiling results of this process"""
+        if self.mode == "cprofile":
+            self._profile.create_stats()
+            return {"mode": "cprofile", "stats": self._profile.stats}
+        return {"mode": "sampling", "stacks": dict(self._stacks)}
+
+    def merge(self, results):
+        """Combine the results from one or more processes (e.g. MPI ranks), and write
+           them to self.output if set. Returns a pstats.Stats or a dict of collapsed stacks."""
+        results = [r for r in results if r is not None]
+        if not results:
+            return None
+        if self.mode == "cprofile":
+            merged = pstats.Stats(_StatsHolder(results[0]["stats"]))
+            for r in results[1:]:
+                merged.add(_StatsHolder(r["stats"]))
+            if self.output is not None:
+                merged.dump_stats(self.output)
+            return merged
+        merged = Counter()
+        for r in results:
+            merged.update(r["stacks"])
+        if self.output is not None:
+            write_collapsed(merged, self.output)
+        return dict(merged)
+
+def write_collapsed(stacks, filename):
+    """Write collapsed stacks in the 'frame;frame;frame count' format read by flamegraph.pl"""
+    with open(filename, "w") as f:
+        for stack, count in sorted(stacks.items()):
+            f.write("{0} {1}\n".format(stack, count))
@@ -0,0 +1,311 @@
+"""Predicate queries over scan results, with zone-map pruning
+
+   A query is a numpy expression over the columns of a results group, e.g.
+
+     h5.query("LogLike > max(LogLike) - 5 and 0 < z < 2", columns=["x", "y"])
+
+   Column names are written as in HDF5.get_params (the model prefix may be
+   left out); names that are not valid identifiers can be given as
+   col("x+y+z"). 'and', 'or', 'not' and chained comparisons work elementwise,
+   and 'np' is available for numpy functions. max(c)/min(c) of a single column
+   are the largest/smallest valid value of that column. Other names are looked
+   up in the 'params' dict. A row is returned if the expression is true there
+   and all the columns involved are valid.
+
+   The rows are processed in zones of 'zone_rows' rows. For every column used in
+   a comparison with a constant, the minimum and maximum valid value in each
+   zone (the zone map) is kept in a sidecar file next to the results,
+   '<results file>.zonemap'. Zones whose ranges show that they cannot match are
+   never read. Zone maps are rebuilt when the results file changes.
+"""
+
+import os
+import ast
+import numpy as np
+
+ZONE_ROWS = 2**16
+
+class ZoneMap:
+    """Per-zone min/max of the valid values of columns of one results group,
+       persisted in a sidecar HDF5 file (if it can be written)"""
+    def __init__(self, h5, zone_rows=ZONE_ROWS, path=None):
+        self.h5 = h5
+        self.zone_rows = zone_rows
+        self.path = path if path is not None else "{0}.zonemap".format(h5.file.filename)
+        self.nrows = None
+        self._ranges = {}
+
+    def _stamp(self):
+        try:
+            mtime = os.stat(self.h5.file.filename).st_mtime_ns
+        except OSError:
+            mtime = 0
+        return mtime
+
+    def _key(self, full_name):
+        return "{0}/{1}/{2}".format(self.h5.name.strip("/") or "_root", self.zone_rows, full_name.replace("/", "|"))
+
+    def _load(self, full_name, nrows, stamp):
+        import h5py
+        try:
+            with h5py.File(self.path, "r") as f:
+                d = f.get(self._key(full_name))
+                if d is not None and d.attrs["mtime_ns"] == stamp and d.attrs["nrows"] == nrows:
+                    return d[()]
+        except (OSError, KeyError):
+            pass
+        return None
+
+    def _save(self, full_name, ranges, nrows, stamp):
+        import h5py
+        try:
+            with h5py.File(self.path, "a") as f:
+                key = self._key(full_name)
+                if key in f:
+                    del f[key]
+                d = f.create_dataset(key, data=ranges)
+                d.attrs["mtime_ns"] = stamp
+                d.attrs["nrows"] = nrows
+        except OSError:
+            pass # e.g. read-only directory; the zone map is then kept in memory only
+
+    def ranges(self, full_name, nrows):
+        """(nzones, 2) array of [min, max] of the valid values of a column in each zone
+           (NaN for zones without valid values)"""
+        stamp = self._stamp()
+        cached = self._ranges.get(full_name)
+        if cached is not None and cached[0] == (stamp, nrows):
+            return cached[1]
+        ranges = self._load(full_name, nrows, stamp)
+        if ranges is None:
+            ranges = self._build(full_name, nrows)
+            self._save(full_name, ranges, nrows, stamp)
+        self._ranges[full_name] = ((stamp, nrows), ranges)
+        return ranges
+
+    def _build(self, full_name, nrows):
+        d = self.h5[full_name]
+        v = self.h5["{}_isvalid".format(full_name)]
+        nzones = -(-nrows // self.zone_rows)
+        ranges = np.full((nzones, 2), np.nan)
+        step = self.zone_rows * max(1, 2**20 // self.zone_rows) # read ~1M rows at a time
+        for start in range(0, nrows, step):
+            stop = min(start + step, nrows)
+            values = np.asarray(d[start:stop], dtype=np.float64)
+            valid = np.array(v[start:stop], dtype=np.bool_)
+            for z0 in range(0, stop - start, self.zone_rows):
+                m = valid[z0:z0 + self.zone_rows]
+                if m.any():
+                    zv = values[z0:z0 + self.zone_rows][m]
+                    ranges[(start + z0) // self.zone_rows] = np.nanmin(zv), np.nanmax(zv)
+        return ranges
+
+_compare = {ast.Gt: np.greater, ast.GtE: np.greater_equal, ast.Lt: np.less, ast.LtE: np.less_equal,
+            ast.Eq: np.equal, ast.NotEq: np.not_equal}
+_flip = {ast.Gt: ast.Lt, ast.GtE: ast.LtE, ast.Lt: ast.Gt, ast.LtE: ast.GtE, ast.Eq: ast.Eq, ast.NotEq: ast.NotEq}
+_not_elementwise = {ast.In: "in", ast.NotIn: "not in", ast.Is: "is", ast.IsNot: "is not"}
+
+class _Rewrite(ast.NodeTransformer):
+    """Make the expression elementwise (and/or/not, chained comparisons), and replace
+       column references by the identifiers they are evaluated under"""
+    def __init__(self, query):
+        self.query = query
+
+    def visit_Call(self, node):
+        f = node.func
+        if isinstance(f, ast.Name) and len(node.args) == 1 and not node.keywords:
+            arg = node.args[0]
+            if f.id == "col" and isinstance(arg, ast.Constant) and isinstance(arg.value, str):
+                return ast.copy_location(ast.Name(id=self.query._column_id(arg.value), ctx=ast.Load()), node)
+            if f.id in ["max", "min"]:
+                column = self.query._column_of(arg)
+                if column is not None:
+                    return ast.copy_location(ast.Constant(value=self.query._extreme(column, f.id)), node)
+        return self.generic_visit(node)
+
+    def visit_Name(self, node):
+        return ast.copy_location(ast.Name(id=self.query._name_id(node.id), ctx=ast.Load()), node)
+
+    def visit_Attribute(self, node):
+        if isinstance(node.value, ast.Name) and node.value.id == "np":
+            return node
+        return self.generic_visit(node)
+
+    def visit_BoolOp(self, node):
+        op = ast.BitAnd() if isinstance(node.op, ast.And) else ast.BitOr()
+        values = [self.visit(v) for v in node.values]
+        out = values[0]
+        for v in values[1:]:
+            out = ast.BinOp(left=out, op=op, right=v)
+        return ast.copy_location(out, node)
+
+    def visit_UnaryOp(self, node):
+        if isinstance(node.op, ast.Not):
+            return ast.copy_location(ast.UnaryOp(op=ast.Invert(), operand=self.visit(node.operand)), node)
+        return self.generic_visit(node)
+
+    def visit_Compare(self, node):
+        for op in node.ops:
+            if type(op) in _not_elementwise:
+                msg = "Operator '{0}' cannot be used in queries, as it does not compare columns elementwise. Please use <, <=, >, >=, == or != (or e.g. np.isin).".format(_not_elementwise[type(op)])
+                raise ValueError(msg)
+        terms = [self.visit(node.left)] + [self.visit(c) for c in node.comparators]
+        pairs = [ast.Compare(left=a, ops=[op], comparators=[b]) for a, op, b in zip(terms[:-1], node.ops, terms[1:])]
+        out = pairs[0]
+        for p in pairs[1:]:
+            out = ast.BinOp(left=out, op=ast.BitAnd(), right=p)
+        return ast.copy_location(out, node)
+
+class Query:
+    """A compiled predicate over the columns of an HDF5 results object"""
+    def __init__(self, h5, expr, params=None, zonemap=None):
+        self.h5 = h5
+        self.expr = expr
+        self.params = dict(params or {})
+        self.zonemap = zonemap
+        self.ids = {} # identifier in the compiled expression -> full column name
+        self.nrows = None
+        tree = ast.parse(expr, mode="eval")
+        self._bounds_tree = tree
+        tree = _Rewrite(self).visit(ast.parse(expr, mode="eval"))
+        self.code = compile(ast.fix_missing_locations(tree), "<query>", "eval")
+
+    def _column_id(self, name):
+        full = self.h5._resolve(name)
+        for i, n in self.ids.items():
+            if n == full:
+                return i
+        i = "_c{0}".format(len(self.ids))
+        self.ids[i] = full
+        return i
+
+    def _name_id(self, name):
+        if name in ["np", "col"]:
+            return name
+        if name in self.params:
+            return "_p_{0}".format(name)
+        try:
+            return self._column_id(name)
+        except KeyError:
+            raise KeyError("Name '{0}' in the query is neither a column of {1} nor given in 'params'".format(name, self.h5.name))
+
+    def _column_of(self, node):
+        """Full column name if 'node' refers to a single column, else None"""
+        if isinstance(node, ast.Name) and node.id not in self.params:
+            try:
+                return self.h5._resolve(node.id)
+            except KeyError:
+                return None
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == "col" \
+          and len(node.args) == 1 and isinstance(node.args[0], ast.Constant):
+            return self.h5._resolve(node.args[0].value)
+        return None
+
+    def _extreme(self, full_name, which):
+        ranges = self.zonemap.ranges(full_name, self._nrows())
+        column = ranges[:, 1] if which == "max" else ranges[:, 0]
+        if np.all(np.isnan(column)):
+            raise ValueError("Column '{0}' has no valid values, so its {1}() is undefined".format(full_name, which))
+        return float(np.nanmax(column) if which == "max" else np.nanmin(column))
+
+    def _nrows(self):
+        if self.nrows is None:
+            self.nrows = min(self.h5[n].shape[0] for n in self.h5._key_index()
+                             if not n.endswith("_isvalid") and "{}_isvalid".format(n) in self.h5._key_index())
+        return self.nrows
+
+    def _constant(self, node):
+        """Value of a node that does not depend on the rows, or None"""
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+            return float(node.value)
+        if isinstance(node, ast.Name) and node.id in self.params and np.ndim(self.params[node.id]) == 0:
+            return float(self.params[node.id])
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in ["max", "min"] \
+          and len(node.args) == 1 and self._column_of(node.args[0]) is not None:
+            return self._extreme(self._column_of(node.args[0]), node.func.id)
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+            v = self._constant(node.operand)
+            return None if v is None else (-v if isinstance(node.op, ast.USub) else v)
+        if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Add, ast.Sub, ast.Mult, ast.Div)):
+            a, b = self._constant(node.left), self._constant(node.right)
+            if a is None or b is None:
+                return None
+            return {ast.Add: a + b, ast.Sub: a - b, ast.Mult: a * b, ast.Div: a / b if b else None}[type(node.op)]
+        return None
+
+    def possible(self, node=None):
+        """Boolean array over zones: False where the zone map shows that no row can match"""
+        if node is None:
+            node = self._bounds_tree.body
+        nzones = -(-self._nrows() // self.zonemap.zone_rows)
+        if isinstance(node, ast.BoolOp):
+            parts = [self.possible(v) for v in node.values]
+            return np.logical_and.reduce(parts) if isinstance(node.op, ast.And) else np.logical_or.reduce(parts)
+        if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.BitAnd, ast.BitOr)):
+            a, b = self.possible(node.left), self.possible(node.right)
+            return a & b if isinstance(node.op, ast.BitAnd) else a | b
+        if isinstance(node, ast.Compare):
+            out = np.ones(nzones, dtype=bool)
+            terms = [node.left] + node.comparators
+            for a, op, b in zip(terms[:-1], node.ops, terms[1:]):
+                if type(op) not in _flip:
+                    continue # no pruning for operators the zone map cannot bound
+                column, value = self._column_of(a), self._constant(b)
+                if column is None or value is None:
+                    column, value, op = self._column_of(b), self._constant(a), _flip[type(op)]()
+                if column is None or value is None:
+                    continue
+                lo, hi = self.zonemap.ranges(column, self._nrows()).T
+                with np.errstate(invalid="ignore"):
+                    if isinstance(op, ast.Gt):
+                        ok = hi > value
+                    elif isinstance(op, ast.GtE):
+                        ok = hi >= value
+                    elif isinstance(op, ast.Lt):
+                        ok = lo < value
+                    elif isinstance(op, ast.LtE):
+                        ok = lo <= value
+                    elif isinstance(op, ast.Eq):
+                        ok = (lo <= value) & (hi >= value)
+                    else:
+                        ok = ~np.isnan(lo)
+                out &= ok # NaN ranges (no valid values) compare False, as they should
+            return out
+        return np.ones(nzones, dtype=bool)
+
+    def evaluate(self, start, stop):
+        """Mask of the rows start..stop-1 that match (and have all query columns valid)"""
+        namespace = {"np": np}
+        namespace.update({"_p_{0}".format(k): v for k, v in self.params.items()})
+        valid = np.ones(stop - start, dtype=bool)
+        for i, full in self.ids.items():
+            namespace[i] = self.h5[full][start:stop]
+            valid &= np.array(self.h5["{}_isvalid".format(full)][start:stop], dtype=np.bool_)
+        with np.errstate(invalid="ignore"):
+            match = np.asarray(eval(self.code, {"__builtins__": {}}, namespace), dtype=bool)
+        return np.broadcast_to(match, valid.shape) & valid
+
+def query(h5, expr, columns, params=None, zone_rows=ZONE_ROWS, zonemap=None):
+    """Rows of 'columns' where 'expr' holds, and all of 'columns' are valid.
+       Returns {column: array}. See the module documentation for the syntax."""
+    if zonemap is None:
+        zonemap = ZoneMap(h5, zone_rows)
+    q = Query(h5, expr, params, zonemap)
+    full_names = [h5._resolve(c) for c in columns]
+    zones = np.flatnonzero(q.possible())
+    nrows = q._nrows()
+    out = {c: [] for c in columns}
+    # Read runs of consecutive candidate zones together
+    runs = np.split(zones, np.flatnonzero(np.diff(zones) != 1) + 1) if len(zones) else []
+    for run in runs:
+        for z0 in range(run[0], run[-1] + 1, max(1, 2**20 // zonemap.zone_rows)):
+            start = z0 * zonemap.zone_rows
+            stop = min((min(z0 + max(1, 2**20 // zonemap.zone_rows), run[-1] + 1)) * zonemap.zone_rows, nrows)
+            m = q.evaluate(start, stop)
+            for full in full_names:
+                m &= np.array(h5["{}_isvalid".format(full)][start:stop], dtype=np.bool_)
+            if not m.any():
+                continue
+            for c, full in zip(columns, full_names):
+                out[c].append(h5[full][start:stop][m])
+    return {c: np.concatenate(v) if v else h5[full][0:0] for (c, v), full in zip(out.items(), full_names)}
@@ -0,0 +1,301 @@
+"""Streaming reductions over scan output, for use with HDF5.reduce()
+
+   Each reducer names the columns it needs, is fed one chunk of rows at a time
+   via update(), and gives its answer with result(). Only the current chunk is
+   ever held in memory. Reducers of the same kind can be combined with merge(),
+   e.g. after reducing different files or different parts of one file.
+
+   Points are used only where all the columns a reducer needs are valid.
+
+   ProfileLikelihood2D and MarginalPosterior2D accumulate profile likelihood
+   and marginal posterior grids, and can also be fed directly with add() (e.g.
+   from a running scan), combined over MPI ranks with allreduce(), and drawn
+   like plottools.profplot/margplot with plot().
+"""
+
+import numpy as np
+
+def _valid_rows(chunk, names):
+    """Arrays for 'names' from a chunk {name: (values, valid)}, restricted to
+       the rows valid in all of them"""
+    m = chunk[names[0]][1]
+    for n in names[1:]:
+        m = m & chunk[n][1]
+    return [chunk[n][0][m] for n in names]
+
+class Reducer:
+    columns = []
+
+    def update(self, chunk):
+        raise NotImplementedError
+
+    def merge(self, other):
+        raise NotImplementedError
+
+    def result(self):
+        raise NotImplementedError
+
+class Count(Reducer):
+    """Number of points valid in all of 'columns'"""
+    def __init__(self, *columns):
+        self.columns = list(columns)
+        self.n = 0
+
+    def update(self, chunk):
+        self.n += len(_valid_rows(chunk, self.columns)[0])
+
+    def merge(self, other):
+        self.n += other.n
+
+    def result(self):
+        return self.n
+
+class ArgMax(Reducer):
+    """Maximum of 'column', and the values of the 'carry' columns at that point.
+       result() returns (max, {name: value}), or (None, {}) if no point was valid."""
+    _sign = 1
+
+    def __init__(self, column, carry=()):
+        self.column = column
+        self.carry = [c for c in carry if c != column]
+        self.columns = [column] + self.carry
+        self.best = None
+        self.at = {}
+
+    def _better(self, a, b):
+        return a > b
+
+    def update(self, chunk):
+        values = _valid_rows(chunk, self.columns)
+        if len(values[0]) == 0:
+            return
+        i = np.argmax(values[0]) if self._sign > 0 else np.argmin(values[0])
+        if self.best is None or self._better(values[0][i], self.best):
+            self.best = values[0][i]
+            self.at = {n: v[i] for n, v in zip(self.carry, values[1:])}
+
+    def merge(self, other):
+        if other.best is not None and (self.best is None or self._better(other.best, self.best)):
+            self.best, self.at = other.best, other.at
+
+    def result(self):
+        return self.best, dict(self.at)
+
+class ArgMin(ArgMax):
+    """Minimum of 'column', and the values of the 'carry' columns at that point"""
+    _sign = -1
+
+    def _better(self, a, b):
+        return a < b
+
+class Max(ArgMax):
+    """Maximum of 'column' (None if no point was valid)"""
+    def __init__(self, column):
+        super(Max, self).__init__(column)
+
+    def result(self):
+        return self.best
+
+class Min(ArgMin):
+    """Minimum of 'column' (None if no point was valid)"""
+    def __init__(self, column):
+        super(Min, self).__init__(column)
+
+    def result(self):
+        return self.best
+
+class WeightedSum(Reducer):
+    """Sum of weights*column over valid points, and the sum of weights.
+       result() returns (sum, sum of weights); their ratio is the weighted mean.
+       With weights=None every point has weight 1."""
+    def __init__(self, column, weights=None):
+        self.column = column
+        self.weights = weights
+        self.columns = [column] + ([weights] if weights is not None else [])
+        self.total = 0.
+        self.norm = 0.
+
+    def update(self, chunk):
+        values = _valid_rows(chunk, self.columns)
+        if self.weights is None:
+            self.total += np.sum(values[0])
+            self.norm += len(values[0])
+        else:
+            self.total += np.dot(values[0], values[1])
+            self.norm += np.sum(values[1])
+
+    def merge(self, other):
+        self.total += other.total
+        self.norm += other.norm
+
+    def result(self):
+        return self.total, self.norm
+
+class Histogram1D(Reducer):
+    """Histogram of 'column' with fixed bin edges (np.histogram conventions),
+       optionally weighted by the column 'weights'. result() returns (counts, edges)."""
+    def __init__(self, column, bins=100, range=None, weights=None):
+        self.column = column
+        self.weights = weights
+        self.columns = [column] + ([weights] if weights is not None else [])
+        if np.ndim(bins) == 0:
+            if range is None:
+                raise ValueError("Histogram1D needs either explicit bin edges or a 'range', since the data are only seen one chunk at a time")
+            bins = np.linspace(range[0], range[1], bins + 1)
+        self.edges = np.asarray(bins, dtype=np.float64)
+        self.counts = np.zeros(len(self.edges) - 1)
+
+    def update(self, chunk):
+        values = _valid_rows(chunk, self.columns)
+        w = values[1] if self.weights is not None else None
+        self.counts += np.histogram(values[0], bins=self.edges, weights=w)[0]
+
+    def merge(self, other):
+        self.counts += other.counts
+
+    def result(self):
+        return self.counts, self.edges
+
+def _edges2d(bins, range, name):
+    """Bin edges for x and y, from counts+range or explicit edges (np.histogram2d conventions)"""
+    if np.isscalar(bins):
+        bins = [bins, bins]
+    edges = []
+    for i, b in enumerate(bins):
+        if np.ndim(b) == 0:
+            if range is None:
+                raise ValueError("{0} needs either explicit bin edges or a 'range', since the data are only seen one chunk at a time".format(name))
+            b = np.linspace(range[i][0], range[i][1], b + 1)
+        edges.append(np.asarray(b, dtype=np.float64))
+    return edges
+
+class Histogram2D(Reducer):
+    """2D histogram of columns x, y with fixed bin edges (np.histogram2d conventions),
+       optionally weighted. result() returns (counts, xedges, yedges)."""
+    def __init__(self, x, y, bins=100, range=None, weights=None):
+        self.x, self.y = x, y
+        self.weights = weights
+        self.columns = [x, y] + ([weights] if weights is not None else [])
+        self.xedges, self.yedges = _edges2d(bins, range, "Histogram2D")
+        self.counts = np.zeros((len(self.xedges) - 1, len(self.yedges) - 1))
+
+    def update(self, chunk):
+        values = _valid_rows(chunk, self.columns)
+        w = values[2] if self.weights is not None else None
+        self.counts += np.histogram2d(values[0], values[1], bins=[self.xedges, self.yedges], weights=w)[0]
+
+    def merge(self, other):
+        self.counts += other.counts
+
+    def result(self):
+        return self.counts, self.xedges, self.yedges
+
+def _bin_index(values, edges):
+    """Bin of each value (the last bin includes its right edge), -1 outside the edges or for NaN"""
+    i = np.searchsorted(edges, values, side="right") - 1
+    i[values == edges[-1]] = len(edges) - 2
+    i[(i < 0) | (i > len(edges) - 2) | np.isnan(values)] = -1
+    return i
+
+class _Grid2D(Reducer):
+    """Common part of the 2D grid accumulators: fixed bin edges, and the flat bin index of points"""
+    def __init__(self, x, y, z, bins, range):
+        self.x, self.y, self.z = x, y, z
+        self.columns = [x, y] + ([z] if z is not None else [])
+        self.xedges, self.yedges = _edges2d(bins, range, type(self).__name__)
+        self.shape = (len(self.xedges) - 1, len(self.yedges) - 1)
+        self.counts = np.zeros(self.shape, dtype=np.int64)
+
+    def _flat(self, x, y):
+        ix = _bin_index(np.asarray(x, dtype=np.float64), self.xedges)
+        iy = _bin_index(np.asarray(y, dtype=np.float64), self.yedges)
+        inside = (ix >= 0) & (iy >= 0)
+        return ix[inside] * self.shape[1] + iy[inside], inside
+
+    def update(self, chunk):
+        values = _valid_rows(chunk, self.columns)
+        self.add(*values)
+
+    def _allreduce(self, comm, grid, op):
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD if comm is None else comm
+        comm.Allreduce(MPI.IN_PLACE, grid, op=getattr(MPI, op))
+        comm.Allreduce(MPI.IN_PLACE, self.counts, op=MPI.SUM)
+
+class ProfileLikelihood2D(_Grid2D):
+    """Running profile likelihood on a fixed grid: the minimum chi^2 = -2 lnL in each
+       (x, y) bin. Feed it via HDF5.reduce(), or add() e.g. the SampleBatches of a live
+       scan (Scan.iter_samples). Points outside the bin edges are ignored.
+
+       result() returns (min chi^2 grid of shape (nx, ny), NaN for empty bins, xedges, yedges)."""
+    def __init__(self, x, y, loglike="LogLike", bins=100, range=None):
+        super(ProfileLikelihood2D, self).__init__(x, y, loglike, bins, range)
+        self.chi2 = np.full(self.shape, np.inf)
+
+    def add(self, x, y, loglike, valid=None):
+        """Add points from arrays; 'valid' optionally flags the ones to use"""
+        if valid is not None:
+            x, y, loglike = x[valid], y[valid], loglike[valid]
+        chi2 = -2. * np.asarray(loglike, dtype=np.float64)
+        flat, inside = self._flat(x, y)
+        chi2 = chi2[inside]
+        keep = ~np.isnan(chi2)
+        np.minimum.at(self.chi2.reshape(-1), flat[keep], chi2[keep])
+        self.counts += np.bincount(flat[keep], minlength=self.chi2.size).reshape(self.shape)
+
+    def merge(self, other):
+        np.minimum(self.chi2, other.chi2, out=self.chi2)
+        self.counts += other.counts
+
+    def allreduce(self, comm=None):
+        """Combine the grids of all MPI ranks (in place, on every rank)"""
+        self._allreduce(comm, self.chi2, "MIN")
+
+    def result(self):
+        return np.where(self.counts > 0, self.chi2, np.nan), self.xedges, self.yedges
+
+    def plot(self, ax, labels=None):
+        """Draw as plottools.profplot does (Delta chi^2 colours, 68%/95% CL contours, best fit)"""
+        from .plottools import profgrid
+        return profgrid(ax, self.result()[0], self.xedges, self.yedges, labels=labels)
+
+class MarginalPosterior2D(_Grid2D):
+    """Running marginal posterior on a fixed grid: the total posterior mass (sum of
+       'weights') in each (x, y) bin. With weights=None every point counts once, as for
+       MCMC chains. Feed it as ProfileLikelihood2D.
+
+       result() returns (mass grid of shape (nx, ny), normalised to 1, xedges, yedges)."""
+    def __init__(self, x, y, weights="Posterior", bins=100, range=None):
+        super(MarginalPosterior2D, self).__init__(x, y, weights, bins, range)
+        self.mass = np.zeros(self.shape)
+
+    def add(self, x, y, weights=None, valid=None):
+        """Add points from arrays; 'valid' optionally flags the ones to use"""
+        if valid is not None:
+            x, y = x[valid], y[valid]
+            weights = weights[valid] if weights is not None else None
+        flat, inside = self._flat(x, y)
+        if weights is None:
+            w = np.ones(len(flat))
+        else:
+            w = np.asarray(weights, dtype=np.float64)[inside]
+        keep = ~np.isnan(w)
+        self.mass += np.bincount(flat[keep], weights=w[keep], minlength=self.mass.size).reshape(self.shape)
+        self.counts += np.bincount(flat[keep], minlength=self.mass.size).reshape(self.shape)
+
+    def merge(self, other):
+        self.mass += other.mass
+        self.counts += other.counts
+
+    def allreduce(self, comm=None):
+        """Combine the grids of all MPI ranks (in place, on every rank)"""
+        self._allreduce(comm, self.mass, "SUM")
+
+    def result(self):
+        total = self.mass.sum()
+        return (self.mass / total if total > 0 else self.mass.copy()), self.xedges, self.yedges
+
+    def plot(self, ax, labels=None):
+        """Draw as plottools.margplot does (posterior density, 68%/95% credible regions, peak)"""
+        from .plottools import marggrid
+        return marggrid(ax, self.result()[0], self.xedges, self.yedges, occupied=self.counts > 0, labels=labels)
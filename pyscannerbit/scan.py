@@ -10,18 +10,11 @@ import ctypes
 # sys.setdlopenflags(flags | ctypes.RTLD_GLOBAL)
 
 from functools import partial
+from operator import itemgetter
 import inspect
 import copy
-import h5py
-
-# Just doing this will initialise MPI, and it will automatically
-# call 'finalize' upon exit. So we need do nothing except import this.
-from mpi4py import MPI
-MPI_rank = MPI.COMM_WORLD.Get_rank()
-MPI_size = MPI.COMM_WORLD.Get_size()
-
-# DEBUG! Only used to check that YAML options looks reasonable
-import yaml
+import time
+import numpy as np
 
 # Need to tell ScannerBit where its config files are located
 # We do this via a special environment variable
@@ -31,10 +24,35 @@ import yaml
 # os.environ["GAMBIT_RUN_DIR"] = gambit_path
 
 # Other python helper tools
-from .defaults import _default_options
+from .defaults import _default_options, _default_batch_options
 from .utils import _merge
-from .hdf5_help import get_data, HDF5 
-from .processify import processify
+from .processify import processify, WorkerPool
+from .batch import run_batch_scan
+from .cache import LikelihoodCache, function_identity
+from .metrics import ScanMetrics, write_attributes
+from .profiling import ScanProfiler
+
+_MPI = None
+
+def _mpi():
+    """The mpi4py MPI module. Importing it initialises MPI (and it will automatically
+       call 'finalize' upon exit), so this is deferred until a scan actually runs,
+       and scripts that only read results never start MPI."""
+    global _MPI
+    if _MPI is None:
+        from mpi4py import MPI
+        _MPI = MPI
+    return _MPI
+
+def __getattr__(name):
+    # MPI, MPI_rank and MPI_size used to be set at import; keep them available, lazily
+    if name == "MPI":
+        return _mpi()
+    if name == "MPI_rank":
+        return _mpi().COMM_WORLD.Get_rank()
+    if name == "MPI_size":
+        return _mpi().COMM_WORLD.Get_size()
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
 
 class SanityCheckException(Exception):
     """Exception thrown by sanity checks of user-supplied input"""
@@ -52,6 +70,219 @@ def func_partial(func, *args, **kwargs):
        Can be used to construct methods."""
     return lambda *a, **kw: func(*(args + a), **dict(kwargs, **kw))
 
+class _CallAdapter:
+   """Picklable description of how ScannerBit's parameter dictionary is turned into
+      a call of the user likelihood function. The '<model>::<par>' keys are resolved
+      once, and compile() builds a closure specialised to the chosen call format:
+
+        'args'  - function(scan, x, y, ...)  (the default)
+        'tuple' - function(scan, (x, y, ...))
+        'array' - function(scan, params), with params a contiguous float64 array.
+                  This array is re-used between calls, so copy it if you need to keep it.
+
+      If a LikelihoodCache is given, values are looked up by parameter tuple
+      before the function is called, in the namespace 'cache_key' (default:
+      cache.function_identity of the function and kwargs). If a SampleRing is given, every evaluated
+      point is pushed into it. If a ScanMetrics is given, the user function and
+      the rest of the adapter are timed separately.
+   """
+   formats = ["args", "tuple", "array"]
+
+   def __init__(self, function, keys, kwargs=None, par_format="args", cache=None, stream=None, metrics=None, cache_key=None):
+       if par_format not in self.formats:
+           msg = "Unknown parameter format '{0}'! Please choose one of {1}".format(par_format, self.formats)
+           raise ValueError(msg)
+       self.function = function
+       self.keys = list(keys)
+       self.kwargs = kwargs
+       self.par_format = par_format
+       self.cache = cache
+       self.cache_key = cache_key
+       self.stream = stream
+       self.metrics = metrics
+
+   def compile(self):
+       adapter = self._compile()
+       if self.stream is not None:
+           getter = self._getter()
+           push = self.stream.push
+           inner = adapter
+           def adapter(scan, par_dict):
+               value = inner(scan, par_dict)
+               push(getter(par_dict), value)
+               return value
+       if self.metrics is not None:
+           adapter = self.metrics.timed_callback(adapter, "wrapper")
+       return adapter
+
+   def _getter(self):
+       if len(self.keys) == 1:
+           key = self.keys[0]
+           return lambda par_dict: (par_dict[key],)
+       return itemgetter(*self.keys)
+
+   def _compile(self):
+       function = self.function
+       if self.metrics is not None:
+           function = self.metrics.timed_user(function, "likelihood")
+       kwargs = dict(self.kwargs or {})
+       getter = self._getter()
+
+       if self.cache is not None:
+           # Cache namespace from the user function itself, not the timing wrapper
+           ns = self.cache_key if self.cache_key is not None else function_identity(self.function, kwargs)
+           return self._compile_cached(function, kwargs, getter, ns)
+
+       if self.par_format == "args":
+           if kwargs:
+               def adapter(scan, par_dict):
+                   return function(scan, *getter(par_dict), **kwargs)
+           else:
+               def adapter(scan, par_dict):
+                   return function(scan, *getter(par_dict))
+       elif self.par_format == "tuple":
+           def adapter(scan, par_dict):
+               return function(scan, getter(par_dict), **kwargs)
+       else:
+           buf = np.empty(len(self.keys), dtype=np.float64)
+           def adapter(scan, par_dict):
+               buf[:] = getter(par_dict)
+               return function(scan, buf, **kwargs)
+       return adapter
+
+   def _compile_cached(self, function, kwargs, getter, ns):
+       """Adapter that consults the cache (keyed on the parameter tuple) first"""
+       if self.par_format == "args":
+           call = lambda scan, params: function(scan, *params, **kwargs)
+       elif self.par_format == "tuple":
+           call = lambda scan, params: function(scan, params, **kwargs)
+       else:
+           call = lambda scan, params: function(scan, np.array(params, dtype=np.float64), **kwargs)
+       cached_call = self.cache.memoize(call, ns)
+       def adapter(scan, par_dict):
+           return cached_call(scan, getter(par_dict))
+       return adapter
+
+def _check_prior_options(checks, prior_format):
+   """Raise ValueError for 'prior_checks' or 'prior_format' values that _PriorAdapter cannot handle"""
+   if prior_format not in _PriorAdapter.formats:
+       msg = "Unknown prior format '{0}'! Please choose one of {1}".format(prior_format, _PriorAdapter.formats)
+       raise ValueError(msg)
+   if checks is not None and checks < 1:
+       # The fast path copies values using the key names found by a checked call
+       msg = "prior_checks must be at least 1 (or None to check every call), got {0}".format(checks)
+       raise ValueError(msg)
+
+class _PriorAdapter:
+   """Picklable description of a call into the user prior transformation function.
+      compile() builds the closure that ScannerBit calls at every point.
+
+      The first 'checks' calls go through the full sanity checks (SafeVec, and
+      consistency of the names set in 'map'). After that the closure switches to
+      a fast path that passes 'vec' straight through and copies the values into
+      'map' using the key names found during the checked calls. With checks=None
+      every call is checked.
+
+      prior_format='array' means the prior function is called as prior_func(vec, out),
+      with 'vec' the unit hypercube sample and 'out' a float64 array to be filled
+      with the parameter values (in the order of argument_names). Both arrays are
+      re-used between calls.
+
+      If a ScanMetrics is given, the prior function and the rest of the closure
+      are timed separately.
+   """
+   formats = ["dict", "array"]
+
+   def __init__(self, prior_func, model_name, argument_names, checks=None, prior_format="dict", metrics=None):
+       _check_prior_options(checks, prior_format)
+       self.prior_func = prior_func
+       self.model_name = model_name
+       self.argument_names = list(argument_names)
+       self.checks = checks
+       self.prior_format = prior_format
+       self.metrics = metrics
+
+   def _check_map(self, tmp_map):
+       """Check that the user added all the parameters to 'tmp_map', and return the
+          list of (user key, full key) pairs to be copied into ScannerBit's map"""
+       has_model_name=None
+       for p in self.argument_names:
+          if self.model_name+"::"+p not in tmp_map.keys() \
+            and p in tmp_map.keys():
+             if has_model_name is None: 
+                has_model_name=False
+             elif has_model_name is True:
+                msg="Error in user-supplied prior transformation function! Parameter names set in 'map' are inconsistent; some appear to have the model name prefix, while others do not. Please edit your prior function to use only one format or the other."  
+                raise SanityCheckException(msg)
+          elif p not in tmp_map.keys():
+                msg="Error in user-supplied prior transformation function! User must define parameters {0} or {1} in the 'map' argument, however parameter {2} was not found! Please fix your prior transformation function.".format(self.argument_names,[self.model_name+"::"+x for x in self.argument_names],p)
+                raise SanityCheckException(msg)
+          else:
+             if has_model_name is None: 
+                has_model_name=True
+             elif has_model_name is False:
+                msg="Error in user-supplied prior transformation function! Parameter names set in 'map' are inconsistent; some appear to have the model name prefix, while others do not. Please edit your prior function to use only one format or the other."
+                raise SanityCheckException(msg)
+       if not has_model_name:
+          # If they added them without the 'model' part of the name then add that automatically now
+          return [(k, self.model_name+"::"+k) for k in tmp_map.keys()]
+       else:
+          return [(k, k) for k in tmp_map.keys()]
+
+   def _check_array(self, out):
+       missing = [p for p, v in zip(self.argument_names, out) if v != v] # NaN check
+       if missing:
+          msg="Error in user-supplied prior transformation function! User must fill all entries of the 'out' array (in the order {0}), however the entries for {1} were not set! Please fix your prior transformation function.".format(self.argument_names, missing)
+          raise SanityCheckException(msg)
+
+   def compile(self):
+       wrapped_prior = self._compile()
+       if self.metrics is not None:
+           wrapped_prior = self.metrics.timed_callback(wrapped_prior, "prior_wrapper")
+       return wrapped_prior
+
+   def _compile(self):
+       prior_func = self.prior_func
+       if self.metrics is not None:
+           prior_func = self.metrics.timed_user(prior_func, "prior")
+       size = len(self.argument_names)
+       checks = self.checks
+       ncalls = 0
+       if self.prior_format == "array":
+          vec_buf = np.empty(size, dtype=np.float64)
+          out = np.empty(size, dtype=np.float64)
+          full_keys = [self.model_name+"::"+p for p in self.argument_names]
+          def wrapped_prior(scan,vec,map):
+             nonlocal ncalls
+             scan.ensure_size(vec,size)
+             vec_buf[:] = [vec[i] for i in range(size)]
+             if checks is None or ncalls < checks:
+                ncalls += 1
+                out[:] = np.nan
+                prior_func(vec_buf,out)
+                self._check_array(out)
+             else:
+                prior_func(vec_buf,out)
+             for k,v in zip(full_keys,out.tolist()):
+                map[k] = v
+          return wrapped_prior
+
+       key_pairs = None
+       def wrapped_prior(scan,vec,map):
+          nonlocal ncalls, key_pairs
+          #Tell ScannerBit the dimension of the parameter space
+          scan.ensure_size(vec,size)
+          tmp_map = {}
+          if checks is None or ncalls < checks:
+             ncalls += 1
+             prior_func(SafeVec(vec,size),tmp_map)
+             key_pairs = self._check_map(tmp_map)
+          else:
+             prior_func(vec,tmp_map)
+          for k,full_k in key_pairs:
+             map[full_k] = tmp_map[k]
+       return wrapped_prior
+
 class SafeVec:
    """A simple wrapper class for the 'vec' argument to user prior functions,
       with nicer error messages"""
@@ -80,26 +311,57 @@ class SafeVec:
        msg="Error setting item '{0}' to '{1}' in 'vec' argument of user-supplied prior function! 'vec' is read-only!".format(key,value) 
        raise SanityCheckException(msg)
 
+_worker_initialised = False
+
+def _init_scan_worker():
+   """Load the ScannerBit library (and thereby the scanner plugins) and check
+      that its HDF5 version matches h5py. Only needs doing once per process,
+      so pool workers do it before they are handed a scan."""
+   global _worker_initialised
+   if _worker_initialised:
+      return
+   # Import functions from the ScannerBit.so library
+   # Should also trigger the loading of the scanner plugin libraries
+   from . import ext_module as ext
+   # check if hdf5 libraries are the same
+   ext.sb.check_hdf5_version()
+   _worker_initialised = True
+
 @processify # Run this function in a separate process, so that scanner plugins can be re-loaded between scans
-def _run_scan(settings, loglike_func, prior_func):
+def _run_scan(settings, loglike_adapter, prior_adapter, profiler=None):
    """Perform a scan. This function is decorated in such a 
       way that it runs in a new process. This is important
       because the GAMBIT plugins can only run once per
       process, because the shared libraries need to be reloaded
       to perform a second scan.
+
+      The likelihood and prior are passed as (picklable) adapters,
+      and compiled into the functions that ScannerBit calls here.
+      If a profiling.ScanProfiler is given, these calls are profiled.
       """
-   # Import functions from the ScannerBit.so library
-   # Should also trigger the loading of the scanner plugin libraries
+   _init_scan_worker()
    from . import ext_module as ext
-   # check if hdf5 libraries are the same
-   ext.sb.check_hdf5_version()
+   import yaml
+   MPI = _mpi()
+   metrics = loglike_adapter.metrics
+   if metrics is not None:
+       metrics.start(MPI.COMM_WORLD.Get_rank())
    # Check that ScannerBit was compiled with MPI enabled if we are using more than one process
-   if MPI_size>1 and not ext.sb.WITH_MPI:
+   if MPI.COMM_WORLD.Get_size()>1 and not ext.sb.WITH_MPI:
        msg = "ScannerBit has not been compiled with MPI enabled! Please try again using only one process."
        raise RuntimeError(msg)
 
+   loglike_func = loglike_adapter.compile()
+   prior_func = prior_adapter.compile() if prior_adapter is not None else None
+   if profiler is not None:
+       profiler.start()
+       loglike_func = profiler.wrap(loglike_func, "likelihood")
+       if prior_func is not None:
+           prior_func = profiler.wrap(prior_func, "prior")
+
    print("prior_func:",prior_func)
-   print("prior_func:",inspect.signature(prior_func))
+   if prior_func is not None:
+       print("prior_func:",inspect.signature(prior_func))
 
    # Attach the ScannerBit object to the first argument of the wrapped likelihood and prior functions
    wrapped_loglike = func_partial(loglike_func,ext.sb)
@@ -120,7 +382,11 @@ def _run_scan(settings, loglike_func, prior_func):
    # run scan
    # 'inifile' can be the name of a YAML file, or a dict.
    #myscan.run(inifile=settings, lnlike={"LogLike": wrapped_loglike}, prior=prior_func, restart=True)
-   ret = myscan.run(inifile=settings, lnlike={"LogLike": wrapped_loglike}, prior=wrapped_prior, restart=True)
+   try:
+       ret = myscan.run(inifile=settings, lnlike={"LogLike": wrapped_loglike}, prior=wrapped_prior, restart=True)
+   finally:
+       if profiler is not None:
+           profiler.stop()
    
    if ret!=0:
       msg = "Fatal error encountered while running ScannerBit!"
@@ -130,12 +396,67 @@ def _run_scan(settings, loglike_func, prior_func):
    rank = MPI.COMM_WORLD.Get_rank()
    print("Rank {0} passed scan end barrier!".format(rank))
 
+   # Report run information back to the parent process
+   info = {}
+   if metrics is not None:
+       del myscan # release ScannerBit's hold on the output file
+       metrics.flush()
+       info["metrics"] = metrics.summary()
+       summaries = MPI.COMM_WORLD.gather(info["metrics"], root=0)
+       if rank == 0:
+           _write_metrics(settings, summaries)
+   if loglike_adapter.cache is not None:
+       loglike_adapter.cache.close()
+       info["cache"] = loglike_adapter.cache.stats()
+   if profiler is not None:
+       info["profile"] = profiler.result()
+   return info
+
+def _write_metrics(settings, summaries):
+   """Store the per-rank stage timings as attributes of the output HDF5 group"""
+   import h5py
+   printer = settings["Printer"]
+   if printer["printer"] != "hdf5":
+       return
+   fullpath = "{}/samples/{}".format(settings["KeyValues"]["default_output_path"], printer["options"]["output_file"])
+   try:
+       with h5py.File(fullpath, 'a') as f:
+           write_attributes(f[printer["options"]["group"]], summaries)
+   except (IOError, KeyError) as err:
+       print("Warning: could not write scan metrics to {0}: {1}".format(fullpath, err))
+
+@processify
+def _run_in_subprocess(target, args):
+   """Run a scan target (see Scan._scan_target) in its own process, without waiting for it
+      when started via _run_in_subprocess.submit()"""
+   return target(*args)
+
+def start_worker_pool(size=1, prefetch=1):
+   """Keep 'prefetch' worker processes (at most 'size' alive at once) warm for
+      upcoming scans. Each worker has already loaded ScannerBit and its plugins,
+      so Scan.scan() only pays for the scan itself. Workers are still used for
+      one scan only. Scans whose likelihood/prior cannot be pickled (install
+      'cloudpickle' to widen this) fall back to a freshly forked process.
+      """
+   stop_worker_pool()
+   _mpi() # workers must inherit this process' MPI state, as forked scan processes do
+   _run_scan.pool = WorkerPool(size=size, prefetch=prefetch, initializer=_init_scan_worker)
+   _run_scan.pool.fill()
+   return _run_scan.pool
+
+def stop_worker_pool():
+   """Shut down the warm worker pool, if any. Later scans fork fresh processes."""
+   if _run_scan.pool is not None:
+       _run_scan.pool.close()
+       _run_scan.pool = None
+
 class Scan:
     """Helper object for setting up and running a scan, and
        making some basic plots.
     """
     def __init__(self, function, prior_func=None, bounds=None, prior_types=None, kwargs=None, scanner=None,
-      scanner_options={}, model_name=None, output_path=None, fargs=None):
+      scanner_options={}, model_name=None, output_path=None, fargs=None, vectorized=False,
+      par_format="args", prior_checks=None, prior_format="dict", cache=None, metrics=None, cache_key=None):
         """
         function - Python function to be scanned
         prior_func - User-define prior transformation function (optional)
@@ -148,11 +469,43 @@ class Scan:
         scanner_options - Configuration options dictionary for chosen scanning algorithm
         f_args - List of names of function argments to use (if None these are
          inferred from the signature of 'function')
+        vectorized - If True, 'function' receives one numpy array per parameter and
+                     must return an array of log-likelihood values, and 'prior_func'
+                     (if given) is called as prior_func(vec, out) on (N, ndim) arrays.
+                     Scanning is then done by the pure-Python batch samplers in
+                     pyscannerbit.batch rather than by ScannerBit.
+        par_format - How parameter values are passed to 'function': 'args' (one argument
+                     per parameter), 'tuple' (a single tuple) or 'array' (a single float64
+                     array; (N, ndim) in vectorized mode). For 'tuple' and 'array' the
+                     parameter names must be given via 'fargs'.
+        prior_checks - Number of initial calls of 'prior_func' that are sanity checked
+                     (at least 1). After that a fast path without checks is used. None
+                     means every call is checked.
+        prior_format - 'dict' (prior_func(vec, map), the default) or 'array'
+                     (prior_func(vec, out), filling a float64 array in parameter order)
+        cache - Memoize likelihood values: a LikelihoodCache, or True for one with default
+                settings stored in 'likelihood_cache.sqlite' in the output path. Values
+                are keyed on the function, 'kwargs' and the parameter values.
+        cache_key - Namespace of this scan's values in 'cache', instead of one derived from
+                'function' and 'kwargs' (see cache.function_identity). Needed if those
+                refer to objects that cannot be pickled.
+        metrics - Time the stages of the scan (likelihood, prior, pyscannerbit's wrappers,
+                and the sampler): a ScanMetrics, or True for one that writes
+                'metrics_rank<r>.json' to the output path every 10 seconds. The
+                per-rank latency percentiles and call rates are also stored as
+                attributes of the output HDF5 group, and in 'run_metrics'.
         """
         self.function = function
         self.prior_func = prior_func
+        self.vectorized = vectorized
+        self.prior_checks = prior_checks
+        self.prior_format = prior_format
+        _check_prior_options(prior_checks, prior_format) # fail now, not at scan time
 
         # Determine parameter names, either automatically or from 'fargs' argument
+        if fargs is None and par_format != "args":
+            msg = "Parameter names cannot be inferred from the signature of the log-likelihood function when par_format='{0}'! Please supply them via the 'fargs' argument.".format(par_format)
+            raise SanityCheckException(msg)
         if fargs is None:
             signature = inspect.signature(self.function)
             print("signature:", signature.parameters.items())
@@ -170,19 +523,19 @@ class Scan:
         self.prior_types = prior_types if prior_types else ["flat"] * len(self._argument_names)
         self.scanner = scanner
 
-        if scanner not in _default_options["Scanner"]["scanners"].keys():
-            msg = "Unknown scanner '{0}' was selected! Please choose from the following available scanning algorithms:".format(scanner)
-            for s in _default_options["Scanner"]["scanners"].keys():
+        available_scanners = _default_batch_options if vectorized else _default_options["Scanner"]["scanners"]
+        if scanner not in available_scanners.keys():
+            msg = "Unknown scanner '{0}' was selected! Please choose from the following available {1}scanning algorithms:".format(scanner, "vectorized " if vectorized else "")
+            for s in available_scanners.keys():
                 msg += "\n   {0}".format(s)
             raise ValueError(msg)
 
-        if MPI_size>1 and scanner in ["random","toy_mcmc"]:
-            msg = "Scanner {0} selected, however MPI_size>1, and unfortunately this algorithm is not yet parallelised. Please either choose another sampling algorithm, or run this algorithm on one process only."
-            raise ValueError(msg)
-
         # Copy user-supplied scanner options into full scan settings dictionary
         self.settings = _add_default_options(copy.deepcopy({"Scanner": {"scanners": {scanner: scanner_options}}}))
+        if vectorized:
+            _merge(self.settings["Scanner"]["scanners"][scanner], _default_batch_options[scanner])
         self.kwargs = kwargs
+        self.par_format = par_format
 
         print("self._argument_names:", self._argument_names)
         print("self.bounds:", self.bounds)
@@ -197,13 +550,6 @@ class Scan:
         else:
            self._model_name = model_name
 
-        # Wrap user-supplied likelihood and prior functions with some extra sanity checking
-        self._wrapped_function = self._wrap_function()
-        if prior_func is not None:
-           self._wrapped_prior = self._wrap_prior()
-        else:
-           self._wrapped_prior = None
-
         self._scanned = False
 
         # Make up a name for the run, if user didn't provide one
@@ -212,6 +558,25 @@ class Scan:
         else:
             self.settings["KeyValues"]["default_output_path"] = output_path
 
+        if cache is True:
+            cache = LikelihoodCache(path=os.path.join(self.settings["KeyValues"]["default_output_path"], "likelihood_cache.sqlite"))
+        if cache and vectorized:
+            raise ValueError("Likelihood caching is not available for vectorized scans!")
+        self.cache = cache or None
+        self.cache_key = cache_key
+
+        if metrics is True:
+            metrics = ScanMetrics(path=self.settings["KeyValues"]["default_output_path"])
+        self.metrics = metrics or None
+        self.run_metrics = []
+
+        # Wrap user-supplied likelihood and prior functions with some extra sanity checking
+        self._wrapped_function = self._wrap_function()
+        if prior_func is not None:
+           self._wrapped_prior = self._wrap_prior()
+        else:
+           self._wrapped_prior = None
+
         self._process_settings()
         self.loglike_par = "LogLike"
         self.scanner = self.settings["Scanner"]["use_scanner"] # Might have been None and then filled by _process_settings with defaults
@@ -224,16 +589,17 @@ class Scan:
             self.posterior_par = None
 
     def _get_hdf5_group(self):
+        """The output group, and the pooled file handle to give back to h5pool
         """
-        """
+        from . import h5pool
         assert self.settings["Printer"]["printer"] == "hdf5"
-        file_name = self.settings["Printer"]["options"]["output_file"]
         group_name = self.settings["Printer"]["options"]["group"]
-        DIR = self.settings["KeyValues"]["default_output_path"]
-        fullpath = "{}/samples/{}".format(DIR, file_name)
-        f = h5py.File(fullpath,'r')
-        g = f[group_name]
-        return g
+        f = h5pool.acquire(self.output_file(),'r')
+        try:
+            return f[group_name], f
+        except KeyError:
+            h5pool.release(f)
+            raise
 
     def _process_settings(self):
         """Copy 'pythonic' options into the settings dictionary
@@ -263,60 +629,60 @@ class Scan:
             else:
                 raise ValueError("No prior settings found! These need to be either supplied in simplified form via the 'bounds' and 'prior_types' arguments, or else supplied in long form (following the GAMBIT YAML format) in the 'settings' dictionary under the 'Priors' key (or under the 'Parameters' key in the short-cut format)")
         #print(self.settings)
+        import yaml
         print("Scan settings in:")
         print("==============")
         print(yaml.dump(self.settings, default_flow_style=False))
 
+    def _call_adapter(self, stream=None):
+        """Describe how ScannerBit's parameter dictionary maps onto the arguments
+           of the user-supplied likelihood function"""
+        keys = ["{0}::{1}".format(self._model_name, n) for n in self._argument_names]
+        return _CallAdapter(self.function, keys, self.kwargs, self.par_format, self.cache, stream, self.metrics, self.cache_key)
+
     def _wrap_function(self):
+        """Compile the adapter that ScannerBit calls at every point
         """
-        """
-        def wrapped_function(scan,par_dict):
-            """
-            """
-            arguments = [par_dict["{0}::{1}".format(self._model_name, n)]
-              for n in self._argument_names]
-            return self.function(scan, *arguments, **(self.kwargs or {}))
+        return self._call_adapter().compile()
 
-        return wrapped_function
+    def _prior_adapter(self):
+        """Describe how the user-supplied prior function fills ScannerBit's parameter map"""
+        return _PriorAdapter(self.prior_func, self._model_name, self._argument_names,
+                             self.prior_checks, self.prior_format, self.metrics)
 
     def _wrap_prior(self):
        """Wrap the user-supplied prior transformation function so that we can
           do some sanity checking on it"""
-       def wrapped_prior(scan,vec,map):
-          #Tell ScannerBit the dimension of the parameter space
-          size=len(self._argument_names)
-          scan.ensure_size(vec,size)
-          tmp_map = {}
-          self.prior_func(SafeVec(vec,size),tmp_map)
-          # Check that user added all the parameters
-          has_model_name=None
-          for p in self._argument_names:
-             if self._model_name+"::"+p not in tmp_map.keys() \
-               and p in tmp_map.keys():
-                if has_model_name is None: 
-                   has_model_name=False
-                elif has_model_name is True:
-                   msg="Error in user-supplied prior transformation function! Parameter names set in 'map' are inconsistent; some appear to have the model name prefix, while others do not. Please edit your prior function to use only one format or the other."  
-                   raise SanityCheckException(msg)
-             elif p not in tmp_map.keys():
-                   msg="Error in user-supplied prior transformation function! User must define parameters {0} or {1} in the 'map' argument, however parameter {2} was not found! Please fix your prior transformation function.".format(self._argument_names,[self._model_name+"::"+x for x in self._argument_names],p)
-                   raise SanityCheckException(msg)
-             else:
-                if has_model_name is None: 
-                   has_model_name=True
-                elif has_model_name is False:
-                   msg="Error in user-supplied prior transformation function! Parameter names set in 'map' are inconsistent; some appear to have the model name prefix, while others do not. Please edit your prior function to use only one format or the other."
-                   raise SanityCheckException(msg)
-          if not has_model_name:
-             # If they added them without the 'model' part of the name then add that automatically now
-             for k,v in tmp_map.items():
-                 map[self._model_name+"::"+k] = v
-          else:
-             for k,v in tmp_map.items():
-                 map[k] = v
-       return wrapped_prior
+       return self._prior_adapter().compile()
+
+    def _scan_target(self, stream=None, profiler=None):
+        """The function, and its arguments, that perform this scan in the current process.
+           Adapters are built fresh in case e.g. self.kwargs was changed since construction."""
+        from . import h5pool
+        self._check_mpi()
+        self.run_metrics = []
+        h5pool.evict(self.output_file()) # the scan will write to it
+        if self.vectorized:
+            return run_batch_scan, (self.settings, self.function, self.prior_func, self._argument_names,
+              self._model_name, self.bounds, self.prior_types, self.kwargs, self.par_format, stream, self.metrics)
+        prior_adapter = self._prior_adapter() if self.prior_func is not None else None
+        return _run_scan.__wrapped__, (self.settings, self._call_adapter(stream), prior_adapter, profiler)
+
+    def _check_mpi(self):
+        """Initialise MPI (in this process, before the scan subprocess is forked), and check
+           that the chosen scanner can run on this many processes"""
+        MPI_size = _mpi().COMM_WORLD.Get_size()
+        if MPI_size>1 and (self.vectorized or self.scanner in ["random","toy_mcmc"]):
+            msg = "Scanner {0} selected, however MPI_size>1, and unfortunately this algorithm is not yet parallelised. Please either choose another sampling algorithm, or run this algorithm on one process only.".format(self.scanner)
+            raise ValueError(msg)
 
-    def scan(self):
+    def output_file(self):
+        """Full path of the HDF5 file that this scan writes to"""
+        file_name = self.settings["Printer"]["options"]["output_file"]
+        DIR = self.settings["KeyValues"]["default_output_path"]
+        return "{}/samples/{}".format(DIR, file_name)
+
+    def scan(self, nprocs=None, callback=None, profile=None):
        """Perform a scan. This runs a function that is decorated in such a 
        way that it runs in a new process. This is important
        because the GAMBIT plugins can only run once per
@@ -324,9 +690,72 @@ class Scan:
        to perform a second scan.
 
        Downside is that all arguments must be pickle-able.
+
+       nprocs - If given, launch the scan on this many local MPI processes
+                (via mpiexec, see pyscannerbit.mpirun), and return here once
+                they have all finished. Not needed if this script was itself
+                launched with mpiexec.
+
+       callback - If given, called with a SampleBatch of newly evaluated points
+                  while the scan is running (see iter_samples). If it returns
+                  True the scan is stopped early.
+
+       profile - Profile the likelihood and prior calls inside the scan process(es):
+                 'cprofile', 'sampling', or a profiling.ScanProfiler for more
+                 options. The results, merged over MPI ranks, are stored in
+                 'profile_stats' (a pstats.Stats, or a dict of collapsed stacks).
+
+       Vectorized scans do not use ScannerBit, so they are run directly in
+       this process.
        """
+       if callback is not None:
+           if nprocs is not None or profile is not None:
+               raise ValueError("Live sample streaming is only available for scans on a single process, without profiling!")
+           for batch in self.iter_samples():
+               if callback(batch) is True:
+                   break
+           return
+
+       profiler = ScanProfiler(profile) if isinstance(profile, str) else profile
+       self.profile_stats = None
+       target, args = self._scan_target(profiler=profiler)
+       if self.vectorized:
+           if nprocs is not None and nprocs > 1:
+               raise ValueError("Vectorized scans are not MPI parallelised, they cannot be run with nprocs>1!")
+           if profiler is not None:
+               profiler.start()
+               target = profiler.wrap(target, "batch_scan")
+           try:
+               target(*args)
+           finally:
+               if profiler is not None:
+                   profiler.stop()
+           if profiler is not None:
+               self.profile_stats = profiler.merge([profiler.result()])
+           if self.metrics is not None:
+               self.run_metrics.append(self.metrics.summary())
+           self._scanned = True
+           return
+
+       if nprocs is not None:
+           MPI_size = _mpi().COMM_WORLD.Get_size()
+           if MPI_size > 1:
+               msg = "Scan.scan(nprocs={0}) was called in a script already running under MPI (MPI_size={1})! Please either launch the script on one process, or don't use 'nprocs'.".format(nprocs, MPI_size)
+               raise ValueError(msg)
+           if nprocs > 1 and self.scanner in ["random","toy_mcmc"]:
+               msg = "Scanner {0} selected, however nprocs>1, and unfortunately this algorithm is not yet parallelised. Please either choose another sampling algorithm, or run this algorithm on one process only.".format(self.scanner)
+               raise ValueError(msg)
+           from .mpirun import launch
+           infos = launch(nprocs, *args)
+           for info in infos:
+               self._collect_run_info(info)
+           if profiler is not None:
+               self.profile_stats = profiler.merge([info.get("profile") for info in infos])
+           self._scanned = True
+           return
+
        try:
-           _run_scan(self.settings, self._wrapped_function, self._wrapped_prior)
+           info = _run_scan(*args)
        except RuntimeError as err:
            # Error messages thrown in the subprocess get kind of mangled, need to
            # help it print correctly
@@ -334,23 +763,78 @@ class Scan:
            print(err.args[0].replace('\\n', '\n')) # Newlines appear to be weirdly escaped. Fix them. 
            exit()
 
+       self._collect_run_info(info)
+       if profiler is not None:
+           self.profile_stats = profiler.merge([info.get("profile")])
        self._scanned = True
 
+    def iter_samples(self, capacity=65536, overflow="drop", poll_interval=0.05):
+        """Run the scan in the background and yield SampleBatch objects with the
+           points evaluated so far, while it runs. Parameter columns follow the
+           order of the likelihood arguments.
+
+           capacity - size (in points) of the shared memory ring buffer
+           overflow - 'drop' points when the buffer is full (counted in the
+                      'dropped_samples' attribute), or 'block' the scan until
+                      they have been read
+           Stopping the iteration early (e.g. 'break') terminates the scan.
+        """
+        from .stream import SampleRing
+        threshold = self.settings["KeyValues"]["likelihood"]["model_invalid_for_lnlike_below"]
+        ring = SampleRing(len(self._argument_names), capacity, threshold, overflow)
+        handle = None
+        try:
+            target, args = self._scan_target(stream=ring)
+            handle = _run_in_subprocess.submit(target, args)
+            while not handle.done():
+                batch = ring.pop()
+                if len(batch.loglike) > 0:
+                    yield batch
+                else:
+                    time.sleep(poll_interval)
+            batch = ring.pop()
+            if len(batch.loglike) > 0:
+                yield batch
+            info = handle.result()
+            self._collect_run_info(info)
+            self._scanned = True
+        finally:
+            if handle is not None and handle.cancel():
+                print("Sample iteration stopped, scan subprocess terminated.")
+            self.dropped_samples = ring.dropped
+            ring.close()
+
+    def _collect_run_info(self, info):
+        """Pick up the run information reported back by the scan subprocess"""
+        if not isinstance(info, dict):
+            return # e.g. vectorized scans report just the number of points
+        if "cache" in info and self.cache is not None:
+            self.cache.add_stats(info["cache"])
+        if "metrics" in info:
+            self.run_metrics.append(info["metrics"])
+
     def get_hdf5(self):
+        from . import h5pool
+        from .hdf5_help import HDF5
         try:
-            g = HDF5(self._get_hdf5_group().id,model=self._model_name,
-                loglike=self.loglike_par, posterior=self.posterior_par)
-        except:
+            group, f = self._get_hdf5_group()
+        except (IOError, KeyError):
             if(self._scanned):
                 raise IOError("Failed to open HDF5 output of scan!")
             else:
                 raise IOError("Failed to open HDF5 output of scan, however we did not perform a scan just now. The output will only exist if you have previously run this scan. Please check that you did this!")
+        try:
+            g = HDF5(group.id,model=self._model_name,
+                loglike=self.loglike_par, posterior=self.posterior_par, h5file=f)
+        except Exception:
+            h5pool.release(f)
+            raise
         return g
 
     def rm_samples(self):
-        file_name = self.settings["Printer"]["options"]["output_file"]
-        DIR = self.settings["KeyValues"]["default_output_path"]
-        fullpath = "{}/samples/{}".format(DIR, file_name)
+        from . import h5pool
+        fullpath = self.output_file()
+        h5pool.evict(fullpath)
         try:
             os.remove(fullpath)
         except:
@@ -0,0 +1,119 @@
+"""Live streaming of evaluated points from the scan subprocess to the parent
+
+   The scan subprocess pushes every evaluated point into a ring buffer in
+   shared memory, from which the parent process can read them while the
+   scan is still running (see Scan.iter_samples).
+"""
+
+import time
+from collections import namedtuple
+from multiprocessing import shared_memory
+import numpy as np
+
+SampleBatch = namedtuple("SampleBatch", ["params", "loglike", "valid"])
+SampleBatch.__doc__ = """Points read from a SampleRing. 'params' has shape (n, ndim), with
+columns in the order of the scan parameters; 'loglike' and 'valid' have shape (n,)."""
+
+class SampleRing:
+    """Single-producer, single-consumer ring buffer of samples in shared memory.
+
+    Each record holds the parameter values, the log-likelihood, and a validity
+    flag. When the buffer is full, new points are dropped (and counted) if
+    overflow='drop', or the producer waits for the consumer if overflow='block'.
+    """
+    _HEADER = 3 # write count, read count, dropped count
+
+    def __init__(self, ndim, capacity=65536, threshold=-np.inf, overflow="drop"):
+        if overflow not in ["drop", "block"]:
+            raise ValueError("Unknown overflow policy '{0}'! Please choose 'drop' or 'block'.".format(overflow))
+        self.ndim = ndim
+        self.capacity = capacity
+        self.threshold = threshold
+        self.overflow = overflow
+        nbytes = 8 * (self._HEADER + capacity * (ndim + 2))
+        self._shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        self._owner = True
+        self._attach()
+        self._header[:] = 0
+
+    def _attach(self):
+        self._header = np.ndarray((self._HEADER,), dtype=np.int64, buffer=self._shm.buf)
+        self._records = np.ndarray((self.capacity, self.ndim + 2), dtype=np.float64,
+          buffer=self._shm.buf, offset=8 * self._HEADER)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_name"] = self._shm.name
+        for k in ["_shm", "_header", "_records"]:
+            del state[k]
+        state["_owner"] = False
+        return state
+
+    def __setstate__(self, state):
+        name = state.pop("_name")
+        self.__dict__.update(state)
+        try:
+            self._shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Python < 3.13. Worker processes share the resource tracker of the
+            # process that created the buffer, so registering again is harmless.
+            self._shm = shared_memory.SharedMemory(name=name)
+        self._attach()
+
+    @property
+    def dropped(self):
+        """Number of points that did not fit into the buffer"""
+        return int(self._header[2])
+
+    def _reserve(self, n):
+        """Number of the next n points that can be written"""
+        while True:
+            free = self.capacity - (self._header[0] - self._header[1])
+            if free >= n or self.overflow == "drop":
+                return min(n, free)
+            time.sleep(0.001)
+
+    def push(self, params, loglike):
+        """Producer side: add one point"""
+        if self._reserve(1) == 0:
+            self._header[2] += 1
+            return
+        w = self._header[0]
+        rec = self._records[w % self.capacity]
+        rec[:self.ndim] = params
+        rec[self.ndim] = loglike
+        rec[self.ndim + 1] = loglike == loglike and abs(loglike) != np.inf and loglike >= self.threshold
+        self._header[0] = w + 1 # publish only once the record is complete
+
+    def push_many(self, params, loglike, valid):
+        """Producer side: add a batch of points"""
+        for start in range(0, len(loglike), self.capacity):
+            stop = start + self.capacity
+            self._push_chunk(params[start:stop], loglike[start:stop], valid[start:stop])
+
+    def _push_chunk(self, params, loglike, valid):
+        n = len(loglike)
+        m = self._reserve(n)
+        self._header[2] += n - m
+        w = self._header[0]
+        idx = (w + np.arange(m)) % self.capacity
+        self._records[idx, :self.ndim] = params[:m]
+        self._records[idx, self.ndim] = loglike[:m]
+        self._records[idx, self.ndim + 1] = valid[:m]
+        self._header[0] = w + m
+
+    def pop(self):
+        """Consumer side: remove and return all points currently in the buffer as a SampleBatch"""
+        r = self._header[1]
+        w = self._header[0]
+        idx = np.arange(r, w) % self.capacity
+        data = self._records[idx]
+        self._header[1] = w
+        return SampleBatch(data[:, :self.ndim], data[:, self.ndim], data[:, self.ndim + 1].astype(np.bool_))
+
+    def close(self):
+        """Release the shared memory (and remove it, if this is the creating process)"""
+        self._header = self._records = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
@@ -0,0 +1,151 @@
+"""Follow the HDF5 output of a running scan
+
+   TailReader returns, at each poll(), only the rows appended since the
+   previous poll, so a monitor (e.g. of the best fit so far) does work in
+   proportion to the new rows rather than re-reading the whole file.
+
+   Two ways of reading a growing file are supported:
+
+     swmr=True  - HDF5 single-writer/multiple-reader mode. The file stays open,
+                  and the writer must have switched the file to SWMR mode. For
+                  vectorized scans set Scan.settings["Printer"]["options"]["swmr"]
+                  = True (see batch.BatchWriter).
+     swmr=False - The file is opened, read and closed at every poll, without
+                  HDF5 file locking, for writers that do not use SWMR (such as
+                  the ScannerBit hdf5 printer, which writes its buffers to the
+                  file from time to time). A poll that catches the file in an
+                  inconsistent state returns no rows, and the same rows are
+                  tried again next time.
+
+   Rows are taken up to the length of the shortest '_isvalid' dataset of the
+   requested columns. If the file shrinks (e.g. a new scan overwrote it),
+   reading restarts from the first row and 'restarts' is incremented.
+"""
+
+import time
+import numpy as np
+
+from .hdf5_help import HDF5
+
+class TailReader:
+    """Incremental reader of a group of a growing ScannerBit HDF5 file
+
+    columns - columns to return (names as for HDF5.get_params). Default: all
+              columns present at the first successful poll.
+    apply_common_mask - if True, poll() returns {name: array} for the new rows valid
+              in all columns, otherwise {name: (values, valid)} for all new rows
+              (the format taken by the reducers, see update())
+    """
+    def __init__(self, filename, group="/", columns=None, swmr=True, apply_common_mask=True,
+      model=None, loglike="LogLike", posterior="Posterior"):
+        self.filename = filename
+        self.group = group
+        self.columns = list(columns) if columns is not None else None
+        self.swmr = swmr
+        self.apply_common_mask = apply_common_mask
+        self.model = model
+        self.loglike = loglike
+        self.posterior = posterior
+        self.position = 0 # rows read so far
+        self.restarts = 0
+        self._f = None
+
+    def _open(self):
+        import h5py
+        if self.swmr:
+            f = h5py.File(self.filename, "r", libver="latest", swmr=True)
+        else:
+            f = h5py.File(self.filename, "r", locking=False)
+        try:
+            return f, HDF5(f[self.group].id, self.model, self.loglike, self.posterior, cache_bytes=0)
+        except Exception:
+            f.close()
+            raise
+
+    def _read(self, h5):
+        """New rows since self.position, or None if there are none (yet)"""
+        if self.columns is None:
+            from .export import default_columns
+            self.columns = default_columns(h5)
+        dsets = [(h5[n], h5["{}_isvalid".format(n)]) for n in [h5._resolve(c) for c in self.columns]]
+        if self.swmr:
+            for d, v in dsets:
+                v.refresh()
+                d.refresh()
+        nrows = min(v.shape[0] for d, v in dsets)
+        if nrows < self.position:
+            self.position = 0
+            self.restarts += 1
+        if nrows == self.position:
+            return None
+        start, stop = self.position, nrows
+        chunk = {}
+        for c, (d, v) in zip(self.columns, dsets):
+            valid = np.array(v[start:stop], dtype=np.bool_)
+            chunk[c] = (d[start:stop], valid)
+        self.position = stop
+        return chunk
+
+    def poll(self):
+        """Rows appended since the last poll (see apply_common_mask), or None if there are none"""
+        if self.swmr:
+            if self._f is None:
+                try:
+                    self._f, self._h5 = self._open()
+                except (OSError, KeyError):
+                    return None # not created yet, or not in SWMR mode yet
+            chunk = self._read(self._h5)
+        else:
+            try:
+                f, h5 = self._open()
+            except (OSError, KeyError):
+                return None
+            try:
+                chunk = self._read(h5)
+            except (OSError, KeyError, ValueError):
+                chunk = None # caught the writer half-way through; retry at the next poll
+            finally:
+                f.close()
+        if chunk is None or not self.apply_common_mask:
+            return chunk
+        m = np.logical_and.reduce([valid for values, valid in chunk.values()])
+        return {c: values[m] for c, (values, valid) in chunk.items()}
+
+    def update(self, *reducers):
+        """Feed the new rows to 'reducers' (see pyscannerbit.reducers), which must only use
+           columns read by this reader. Returns the number of new rows (0 if none)."""
+        apply_common_mask, self.apply_common_mask = self.apply_common_mask, False
+        try:
+            chunk = self.poll()
+        finally:
+            self.apply_common_mask = apply_common_mask
+        if chunk is None:
+            return 0
+        for r in reducers:
+            r.update(chunk)
+        return len(next(iter(chunk.values()))[0])
+
+    def follow(self, interval=1., timeout=None):
+        """Generator of the batches of new rows, polling every 'interval' seconds.
+           Stops after 'timeout' seconds without new rows (None: never)."""
+        last = time.time()
+        while True:
+            chunk = self.poll()
+            if chunk is not None:
+                last = time.time()
+                yield chunk
+            elif timeout is not None and time.time() - last > timeout:
+                return
+            else:
+                time.sleep(interval)
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
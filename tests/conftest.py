@@ -0,0 +1,43 @@
+"""Shared fixtures: small results files in the layout of the ScannerBit hdf5 printer"""
+
+import numpy as np
+import pytest
+
+def write_scan(filename, group="/", n=5000, seed=0, rank=0, mode="w", **layout):
+    """Write n points with parameters 'model::x', 'model::y', LogLike, Posterior,
+       MPIrank and pointID to 'group'. About 10% of the values of each column
+       (and a few LogLike values more) are flagged invalid. Returns {name: (values, valid)}.
+       Dataset creation options (e.g. chunks=True) can be given as keywords."""
+    import h5py
+    rng = np.random.default_rng(seed)
+    x = rng.normal(size=n)
+    y = rng.uniform(-3, 3, size=n)
+    loglike = -0.5*(x**2 + y**2)
+    columns = {
+        "model::x": (x, rng.random(n) > 0.1),
+        "model::y": (y, rng.random(n) > 0.1),
+        "LogLike": (loglike, (rng.random(n) > 0.1) & (loglike > -4.)),
+        "Posterior": (rng.random(n), rng.random(n) > 0.1),
+        "MPIrank": (np.full(n, rank, dtype=np.int32), np.ones(n, dtype=bool)),
+        "pointID": (np.arange(n, dtype=np.int64), np.ones(n, dtype=bool)),
+    }
+    with h5py.File(filename, mode) as f:
+        g = f.require_group(group)
+        for name, (values, valid) in columns.items():
+            g.create_dataset(name, data=values, **layout)
+            g.create_dataset("{}_isvalid".format(name), data=valid.astype(np.int8), **layout)
+    return columns
+
+@pytest.fixture
+def scan_file(tmp_path):
+    """(filename, {name: (values, valid)}) of a results file with the data in '/'"""
+    pytest.importorskip("h5py")
+    filename = str(tmp_path / "scan.hdf5")
+    return filename, write_scan(filename)
+
+@pytest.fixture
+def h5(scan_file):
+    """HDF5 object for scan_file"""
+    from pyscannerbit.hdf5_help import HDF5
+    with HDF5.fromFile(scan_file[0], "/") as h:
+        yield h
@@ -0,0 +1,73 @@
+"""Pure-Python batch samplers and vectorized scans (no ScannerBit library needed)"""
+
+import numpy as np
+import pytest
+
+pytest.importorskip("h5py")
+pytest.importorskip("mpi4py")
+
+from pyscannerbit.batch import random_batches, grid_batches, halton_batches, transform_unit, BatchWriter
+from pyscannerbit.scan import Scan
+
+def test_random_batches():
+    batches = list(random_batches(3, {"point_number": 250, "batch_size": 100, "seed": 1}))
+    assert [b.shape for b in batches] == [(100, 3), (100, 3), (50, 3)]
+    again = np.concatenate(list(random_batches(3, {"point_number": 250, "batch_size": 250, "seed": 1})))
+    np.testing.assert_array_equal(np.concatenate(batches), again)
+    assert ((again >= 0) & (again < 1)).all()
+
+def test_grid_batches():
+    u = np.concatenate(list(grid_batches(2, {"grid_pts": [3, 2], "batch_size": 4})))
+    assert u.shape == (6, 2)
+    assert sorted(map(tuple, u)) == [(a, b) for a in [0., 0.5, 1.] for b in [0., 1.]]
+    with pytest.raises(ValueError):
+        list(grid_batches(2, {"grid_pts": [3, 2, 2], "batch_size": 4}))
+
+def test_halton_batches():
+    u = np.concatenate(list(halton_batches(2, {"point_number": 7, "batch_size": 3, "skip": 0})))
+    np.testing.assert_allclose(u[:4, 0], [1/2., 1/4., 3/4., 1/8.])
+    np.testing.assert_allclose(u[:4, 1], [1/3., 2/3., 1/9., 4/9.])
+    skipped = np.concatenate(list(halton_batches(2, {"point_number": 3, "batch_size": 10, "skip": 4})))
+    np.testing.assert_array_equal(skipped, u[4:])
+
+def test_transform_unit():
+    u = np.array([[0., 0.5], [1., 1.]])
+    x = transform_unit(u, [(-1, 3), (1, 100)], ["flat", "log"])
+    np.testing.assert_allclose(x, [[-1, 10], [3, 100]])
+    with pytest.raises(ValueError):
+        transform_unit(u, [(0, 1), (0, 1)], ["flat", "log"])
+    with pytest.raises(ValueError):
+        transform_unit(u, [(0, 1), (1, 2)], ["flat", "triangular"])
+
+def test_batch_writer_pads_missing_columns(tmp_path):
+    import h5py
+    filename = str(tmp_path / "out.hdf5")
+    w = BatchWriter(filename, "/g")
+    w.append({"a": (np.arange(3.), 1)})
+    w.append({"a": (np.arange(2.), [1, 0]), "b": (np.ones(2), 1)})
+    w.close()
+    with h5py.File(filename, "r") as f:
+        np.testing.assert_array_equal(f["g/a_isvalid"][()], [1, 1, 1, 1, 0])
+        np.testing.assert_array_equal(f["g/b_isvalid"][()], [0, 0, 0, 1, 1])
+        np.testing.assert_array_equal(f["g/b"][3:], [1., 1.])
+
+def loglike(scan, x, y):
+    scan.print("r", np.hypot(x, y))
+    return np.where(x > 1.5, -1e10, -0.5*(x**2 + y**2))
+
+def test_vectorized_scan(tmp_path):
+    s = Scan(loglike, bounds=[(-2, 2), (-3, 3)], scanner="halton", vectorized=True,
+             scanner_options={"point_number": 1000, "batch_size": 300}, output_path=str(tmp_path / "out"))
+    s.scan()
+    with s.get_hdf5() as h:
+        assert h["LogLike"].shape == (1000,)
+        x, y, r, l = h.get_params(["x", "y", "r", "LogLike"])
+        assert len(x) == np.sum(h["default::x"][()] <= 1.5) # points below the invalid threshold are flagged
+        np.testing.assert_allclose(r, np.hypot(x, y))
+        assert abs(h.get_best_fit("x")) < 0.1 and abs(h.get_best_fit("y")) < 0.2
+
+def test_vectorized_scan_checks_output_shape(tmp_path):
+    s = Scan(lambda scan, x: np.zeros(2), fargs=["x"], par_format="args", bounds=[(0, 1)], scanner="random",
+             vectorized=True, scanner_options={"point_number": 10, "batch_size": 5}, output_path=str(tmp_path / "out"))
+    with pytest.raises(ValueError):
+        s.scan()
@@ -0,0 +1,64 @@
+"""Top-k best-fit points (HDF5.get_best_fit_point)"""
+
+import numpy as np
+import pytest
+
+from conftest import write_scan
+
+pytest.importorskip("h5py")
+
+from pyscannerbit.hdf5_help import HDF5
+
+def _ranked(data):
+    """Rows in order of decreasing valid LogLike"""
+    loglike, valid = data["LogLike"]
+    rows = np.flatnonzero(valid)
+    return rows[np.argsort(-loglike[rows], kind="stable")]
+
+def _value(data, name, row):
+    values, valid = data[name]
+    return values[row] if valid[row] else np.nan
+
+def test_single_point(h5, scan_file):
+    data = scan_file[1]
+    best = h5.get_best_fit_point(chunk_rows=333)
+    row = _ranked(data)[0]
+    assert list(best) == ["LogLike", "x", "y"]
+    assert best["LogLike"] == data["LogLike"][0][row]
+    np.testing.assert_equal(best["x"], _value(data, "model::x", row))
+    np.testing.assert_equal(best["y"], _value(data, "model::y", row))
+
+@pytest.mark.parametrize("chunk_rows", [7, 1000, 2**20])
+def test_top_k(h5, scan_file, chunk_rows):
+    data = scan_file[1]
+    rows = _ranked(data)[:50]
+    top = h5.get_best_fit_point(k=50, columns=["x", "pointID"], chunk_rows=chunk_rows)
+    assert list(top) == ["LogLike", "x", "pointID"]
+    np.testing.assert_array_equal(top["pointID"], rows)
+    np.testing.assert_array_equal(top["LogLike"], data["LogLike"][0][rows])
+    x = [_value(data, "model::x", r) for r in rows]
+    assert np.isnan(x).any() # invalid values are NaN
+    np.testing.assert_array_equal(top["x"], x)
+
+def test_records(h5, scan_file):
+    records = h5.get_best_fit_point(k=3, columns=["x", "y"], as_records=True)
+    assert records.dtype.names == ("LogLike", "x", "y")
+    np.testing.assert_array_equal(records.LogLike, scan_file[1]["LogLike"][0][_ranked(scan_file[1])[:3]])
+
+def test_fewer_points_than_k(tmp_path):
+    filename = str(tmp_path / "small.hdf5")
+    data = write_scan(filename, n=20)
+    with HDF5.fromFile(filename, "/") as h:
+        top = h.get_best_fit_point(k=100, chunk_rows=6)
+        assert len(top["LogLike"]) == np.sum(data["LogLike"][1])
+        np.testing.assert_array_equal(top["LogLike"], data["LogLike"][0][_ranked(data)])
+    empty = str(tmp_path / "empty.hdf5")
+    write_scan(empty, n=0)
+    with HDF5.fromFile(empty, "/") as h:
+        top = h.get_best_fit_point()
+        assert len(top["LogLike"]) == 0 and len(top["x"]) == 0
+
+def test_k_must_be_positive(h5):
+    for k in [0, -1]:
+        with pytest.raises(ValueError):
+            h5.get_best_fit_point(k=k)
@@ -0,0 +1,110 @@
+"""Vectorized 2d binning of plottools against reference loops"""
+
+from itertools import groupby
+from operator import itemgetter
+
+import numpy as np
+import pytest
+
+from pyscannerbit.plottools import bin2d, bin1d, binstat2d, bin_index2d, credible_levels
+
+def reference_bin2d(data, nxbins, nybins, binop='min', doconts=False):
+    """bin2d as it was before it was vectorized (groupby over the sorted points)"""
+    x, y, zvals = data[:,0], data[:,1], data[:,2]
+    eps = 1e-10
+    xindexes = np.floor((1-eps)*(nxbins)*(x-min(x))/(max(x)-min(x)))
+    yindexes = np.floor((1-eps)*(nybins)*(y-min(y))/(max(y)-min(y)))
+    outarray = np.zeros((nxbins,nybins))
+    grouped = [list(value) for key, value in groupby(sorted(zip(xindexes,yindexes,zvals)), key=itemgetter(0,1))]
+    bininds = [int(nybins*bin[0][0] + bin[0][1]) for bin in grouped]
+    if binop == 'min':
+        binvals = [min([el[2] for el in bin]) for bin in grouped]
+        outarray[:,:] = np.nan
+    elif binop == 'max':
+        binvals = [max([el[2] for el in bin]) for bin in grouped]
+    else:
+        binvals = [sum([el[2] for el in bin]) for bin in grouped]
+    outarray.flat[bininds] = binvals
+    if binop == 'sum' and doconts:
+        outarray2 = np.ones((nxbins,nybins))
+        sb = sorted(zip(bininds,binvals), key=itemgetter(1), reverse=True)
+        outarray2.flat[[b for b, v in sb]] = list(np.cumsum([v for b, v in sb]))
+        return outarray.transpose(), outarray2.transpose()
+    return outarray.transpose()
+
+def _points(n, seed=0, clustered=False):
+    rng = np.random.default_rng(seed)
+    x, y = rng.normal(size=n), rng.uniform(0, 5, size=n)
+    if clustered: # leaves many bins empty
+        x, y = np.round(x, 1), np.round(y)
+    return np.column_stack((x, y, rng.exponential(size=n)))
+
+@pytest.mark.parametrize("binop", ["min", "max", "sum"])
+@pytest.mark.parametrize("clustered", [False, True])
+def test_bin2d_matches_reference(binop, clustered):
+    data = _points(3000, clustered=clustered)
+    np.testing.assert_array_equal(bin2d(data, 20, 15, binop), reference_bin2d(data, 20, 15, binop))
+
+@pytest.mark.parametrize("clustered", [False, True])
+def test_doconts_matches_reference(clustered):
+    data = _points(3000, seed=1, clustered=clustered)
+    data[:,2] /= data[:,2].sum()
+    for out, expected in zip(bin2d(data, 30, 25, 'sum', doconts=True), reference_bin2d(data, 30, 25, 'sum', doconts=True)):
+        np.testing.assert_array_equal(out, expected)
+
+def _loop_stats(x, y, z, nxbins, nybins):
+    """Per-bin statistics by looping over the bins, for points with finite x, y"""
+    ok = ~(np.isnan(x) | np.isnan(y))
+    flat = np.full(len(x), -1)
+    flat[ok] = bin_index2d(x[ok], y[ok], nxbins, nybins)
+    out = {k: np.empty(nxbins*nybins) for k in ["min", "max", "sum", "mean", "count", "argmin"]}
+    for b in range(nxbins*nybins):
+        members = np.flatnonzero(flat == b)
+        out["count"][b] = len(members)
+        members = members[~np.isnan(z[members])]
+        if len(members) == 0:
+            out["min"][b], out["max"][b], out["sum"][b], out["mean"][b], out["argmin"][b] = np.nan, 0., 0., np.nan, -1
+            continue
+        zs = z[members]
+        out["min"][b], out["max"][b] = zs.min(), zs.max()
+        out["sum"][b] = zs.sum()
+        out["mean"][b] = zs.sum() / len(zs)
+        out["argmin"][b] = members[np.argmin(zs)]
+    return {k: v.reshape(nxbins, nybins) for k, v in out.items()}
+
+def test_binstat2d_with_nans_and_empty_bins():
+    data = _points(2000, seed=2, clustered=True)
+    x, y, z = data.T.copy()
+    x[::17] = np.nan
+    y[5::23] = np.nan
+    z[3::11] = np.nan
+    z[7::13] = z[6::13][:len(z[7::13])] # ties, for argmin
+    out = binstat2d(x, y, z, 12, 10, binops=("min", "max", "sum", "mean", "count", "argmin"))
+    expected = _loop_stats(x, y, z, 12, 10)
+    assert (expected["count"] == 0).any()
+    for op in ["min", "max", "count", "argmin"]:
+        np.testing.assert_array_equal(out[op], expected[op], err_msg=op)
+    for op in ["sum", "mean"]:
+        np.testing.assert_allclose(out[op], expected[op], rtol=1e-12, err_msg=op)
+
+def test_degenerate_axis_and_no_points():
+    out = binstat2d(np.ones(5), np.arange(5.), np.arange(5.), 3, 5, ("count",))["count"]
+    np.testing.assert_array_equal(out[0], np.ones(5))
+    assert out[1:].sum() == 0
+    nan = np.full(3, np.nan)
+    out = binstat2d(nan, nan, nan, 2, 2, ("min", "count", "argmin"))
+    assert np.isnan(out["min"]).all() and (out["count"] == 0).all() and (out["argmin"] == -1).all()
+    with pytest.raises(ValueError):
+        binstat2d(nan, nan, nan, 2, 2, ("median",))
+
+def test_bin1d():
+    data = _points(500, seed=3)[:, [0, 2]]
+    out = bin1d(data, 10, 'max')
+    index = bin_index2d(data[:,0], np.zeros(len(data)), 10, 1)
+    for i in range(10):
+        m = index == i
+        assert out[i] == (data[m,1].max() if m.any() else 0.)
+
+def test_credible_levels():
+    binned = np.array([[0.5, 0.], [0.2, 0.3]])
+    np.testing.assert_allclose(credible_levels(binned), [[0.5, 1.], [1., 0.8]])
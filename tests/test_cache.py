@@ -0,0 +1,129 @@
+"""Likelihood memoization (pyscannerbit.cache)"""
+
+import os
+import sys
+import sqlite3
+import subprocess
+import pytest
+
+from pyscannerbit.cache import LikelihoodCache, function_identity
+
+def test_hit_and_miss():
+    cache = LikelihoodCache()
+    calls = []
+    def call(scan, params):
+        calls.append(params)
+        return sum(params)
+    cached = cache.memoize(call, "ns")
+    assert cached(None, (1., 2.)) == 3.
+    assert cached(None, (1., 2.)) == 3.
+    assert cached(None, (1., 3.)) == 4.
+    assert calls == [(1., 2.), (1., 3.)]
+    assert cache.stats() == {"hits_memory": 1, "hits_disk": 0, "misses": 2}
+    assert cache.get("other", (1., 2.)) is None
+
+def test_quantize():
+    cache = LikelihoodCache(quantize=1e-3)
+    cache.put("ns", (0.1,), 5.)
+    assert cache.get("ns", (0.1 + 1e-5,)) == 5.
+    assert cache.get("ns", (0.102,)) is None
+
+def test_memory_lru():
+    cache = LikelihoodCache(maxsize=2)
+    for x in [1., 2., 3.]:
+        cache.put("ns", (x,), x)
+    assert cache.get("ns", (1.,)) is None
+    assert cache.get("ns", (3.,)) == 3.
+
+def test_persistent_round_trip(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = LikelihoodCache(path=path, flush_every=2)
+    for x in range(5):
+        cache.put("ns", (float(x),), x * 10.)
+    cache.close()
+    cache = LikelihoodCache(path=path)
+    assert [cache.get("ns", (float(x),)) for x in range(5)] == [0., 10., 20., 30., 40.]
+    assert cache.stats()["hits_disk"] == 5
+    assert cache.get("ns", (5.,)) is None
+    cache.close()
+
+def test_disk_eviction(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = LikelihoodCache(path=path, maxsize=1, disk_maxsize=10, flush_every=1)
+    for x in range(25):
+        cache.put("ns", (float(x),), float(x))
+    cache.close()
+    db = sqlite3.connect(path)
+    kept = sorted(k for k, in db.execute("SELECT value FROM loglike"))
+    assert 0 < len(kept) <= 10
+    assert kept == list(range(25 - len(kept), 25)) # least recently used went first
+    assert db.execute("SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='loglike'"
+                      " AND sql LIKE '%atime%'").fetchone() is not None
+    db.close()
+
+def loglike(scan, x, y):
+    return -sum([p**2 for p in (x, y)])
+
+def test_identity_is_stable_across_processes():
+    # repr() of a nested code object includes its address, which differs between processes
+    code = "import sys; sys.path.insert(0, {0!r}); import test_cache, pyscannerbit.cache as c;" \
+           " print(c.function_identity(test_cache.loglike, {{'a': 1}}))".format(os.path.dirname(os.path.abspath(__file__)))
+    ids = {subprocess.check_output([sys.executable, "-c", code]).decode().strip() for i in range(2)}
+    assert len(ids) == 1
+
+def test_identity_depends_on_code_and_kwargs():
+    def f(scan, x):
+        return -sum([p for p in (x,)])
+    def g(scan, x):
+        return -sum([p**2 for p in (x,)])
+    g.__qualname__ = f.__qualname__
+    assert function_identity(f) != function_identity(g)
+    assert function_identity(f, {"a": 1}) != function_identity(f, {"a": 2})
+    assert function_identity(f, {"a": 1}) == function_identity(f, {"a": 1})
+
+def make_like(sigma):
+    def like(scan, x):
+        return -0.5*(x/sigma)**2
+    return like
+
+def with_default(scan, x, sigma=1.):
+    return -x/sigma
+
+SCALE = 2.
+
+def reads_global(scan, x):
+    return -x*SCALE
+
+def test_identity_depends_on_closure_defaults_and_globals(monkeypatch):
+    assert function_identity(make_like(1.)) != function_identity(make_like(2.))
+    assert function_identity(make_like(1.)) == function_identity(make_like(1.))
+    before = function_identity(with_default)
+    monkeypatch.setattr(with_default, "__defaults__", (2.,))
+    assert function_identity(with_default) != before
+    before = function_identity(reads_global)
+    monkeypatch.setattr(sys.modules[__name__], "SCALE", 3.)
+    assert function_identity(reads_global) != before
+
+def test_identity_of_partial():
+    import functools
+    a = functools.partial(with_default, sigma=1.)
+    assert function_identity(a) == function_identity(functools.partial(with_default, sigma=1.))
+    assert function_identity(a) != function_identity(functools.partial(with_default, sigma=2.))
+    assert function_identity(a) != function_identity(functools.partial(make_like(1.)))
+
+def test_identity_needs_picklable_state():
+    import threading
+    lock = threading.Lock()
+    def locked(scan, x):
+        with lock:
+            return x
+    with pytest.raises(ValueError, match="cache_key"):
+        function_identity(locked)
+
+def test_numpy_values_are_stored(tmp_path):
+    import numpy as np
+    path = str(tmp_path / "cache.sqlite")
+    cache = LikelihoodCache(path=path, flush_every=1)
+    cache.put("ns", (1.,), np.float32(-1.5))
+    cache.close()
+    assert LikelihoodCache(path=path).get("ns", (1.,)) == -1.5
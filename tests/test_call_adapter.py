@@ -0,0 +1,82 @@
+"""Likelihood and prior adapters of pyscannerbit.scan (no ScannerBit library needed)"""
+
+import pytest
+
+from pyscannerbit.scan import Scan, _CallAdapter, _PriorAdapter, SanityCheckException
+from pyscannerbit.cache import LikelihoodCache
+from pyscannerbit.metrics import ScanMetrics
+
+KEYS = ["model::x", "model::y"]
+
+def f1(scan, x, y):
+    return 1.
+
+def f2(scan, x, y):
+    return 2.
+
+def test_cache_namespace_with_metrics():
+    cache = LikelihoodCache()
+    point = {"model::x": 0.5, "model::y": 0.25}
+    for f, expected in [(f1, 1.), (f2, 2.)]:
+        metrics = ScanMetrics()
+        metrics.start()
+        adapter = _CallAdapter(f, KEYS, cache=cache, metrics=metrics).compile()
+        assert adapter(None, point) == expected
+    assert cache.stats()["misses"] == 2
+
+def test_explicit_cache_key():
+    cache = LikelihoodCache()
+    point = {"model::x": 0.5, "model::y": 0.25}
+    assert _CallAdapter(f1, KEYS, cache=cache, cache_key="k").compile()(None, point) == 1.
+    assert _CallAdapter(f2, KEYS, cache=cache, cache_key="k").compile()(None, point) == 1. # same namespace
+    assert cache.get("k", (0.5, 0.25)) == 1.
+
+def test_par_formats():
+    point = {"model::x": 1., "model::y": 2.}
+    args = _CallAdapter(lambda scan, x, y, c=0: x + 10*y + c, KEYS, {"c": 100}).compile()
+    tup = _CallAdapter(lambda scan, p: p[0] - p[1], KEYS, par_format="tuple").compile()
+    arr = _CallAdapter(lambda scan, p: p.sum(), KEYS, par_format="array").compile()
+    assert args(None, point) == 121.
+    assert tup(None, point) == -1.
+    assert arr(None, point) == 3.
+
+class FakeScan:
+    def ensure_size(self, vec, size):
+        pass
+
+def prior(vec, map):
+    map["x"] = 2*vec[0]
+    map["y"] = 3*vec[1]
+
+def test_prior_fast_path():
+    scan = FakeScan()
+    wrapped = _PriorAdapter(prior, "model", ["x", "y"], checks=2).compile()
+    for i in range(4): # checked calls, then the fast path
+        out = {}
+        wrapped(scan, [0.5, float(i)], out)
+        assert out == {"model::x": 1., "model::y": 3.*i}
+
+def test_prior_array_format():
+    def prior_array(vec, out):
+        out[:] = vec[0], 10*vec[1]
+    wrapped = _PriorAdapter(prior_array, "model", ["x", "y"], checks=1, prior_format="array").compile()
+    for i in range(2):
+        out = {}
+        wrapped(FakeScan(), [1., 2.], out)
+        assert out == {"model::x": 1., "model::y": 20.}
+
+def test_prior_checks_must_be_positive():
+    with pytest.raises(ValueError):
+        _PriorAdapter(prior, "model", ["x", "y"], checks=0)
+
+@pytest.mark.parametrize("options", [{"prior_checks": 0}, {"prior_format": "tuple"}])
+def test_scan_checks_prior_options(tmp_path, options):
+    with pytest.raises(ValueError):
+        Scan(lambda scan, x, y: 0., prior_func=prior, scanner="random", output_path=str(tmp_path), **options)
+
+def test_prior_missing_parameter():
+    def bad_prior(vec, map):
+        map["x"] = vec[0]
+    wrapped = _PriorAdapter(bad_prior, "model", ["x", "y"], checks=1).compile()
+    with pytest.raises(SanityCheckException):
+        wrapped(FakeScan(), [0.5, 0.5], {})
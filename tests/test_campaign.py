@@ -0,0 +1,38 @@
+"""Launch policy of ScanCampaign (no scans are run)"""
+
+import time
+import pytest
+
+pytest.importorskip("mpi4py")
+
+from pyscannerbit import campaign
+
+GB = 2**30
+
+@pytest.fixture
+def memory(monkeypatch):
+    free = {"bytes": 10*GB}
+    monkeypatch.setattr(campaign, "_available_memory", lambda: free["bytes"])
+    return free
+
+def _started(ages):
+    now = time.time()
+    return {i: (None, now - age) for i, age in enumerate(ages)}
+
+def test_max_workers():
+    c = campaign.ScanCampaign([], max_workers=2)
+    assert c._can_start(_started([]))
+    assert c._can_start(_started([100.]))
+    assert not c._can_start(_started([100., 100.]))
+
+def test_memory_of_new_scans_is_reserved(memory):
+    c = campaign.ScanCampaign([], max_workers=8, mem_per_scan=3*GB, reserve_mem=GB)
+    # Just-started scans have not allocated anything yet: 9 GB usable covers two more
+    assert c._can_start(_started([0.]))
+    assert c._can_start(_started([0., 0.]))
+    assert not c._can_start(_started([0., 0., 0.]))
+    # Older scans are already accounted for in the available memory
+    assert c._can_start(_started([100., 100., 100.]))
+    memory["bytes"] = 3*GB
+    assert not c._can_start(_started([100.]))
+    assert c._can_start(_started([])) # one scan is always allowed
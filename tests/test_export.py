@@ -0,0 +1,73 @@
+"""Columnar export of valid points (pyscannerbit.export)"""
+
+import numpy as np
+import pytest
+
+from conftest import write_scan
+
+pytest.importorskip("h5py")
+
+from pyscannerbit.hdf5_help import HDF5
+from pyscannerbit.export import export, load, main
+
+COLUMNS = ["x", "LogLike", "pointID"]
+
+def _expected(data):
+    names = ["model::x", "LogLike", "pointID"]
+    m = np.logical_and.reduce([data[n][1] for n in names])
+    return {c: data[n][0][m] for c, n in zip(COLUMNS, names)}
+
+FORMATS = ["npz", "parquet", "arrow"]
+
+def _needs(ext):
+    if ext != "npz":
+        pytest.importorskip("pyarrow")
+
+@pytest.mark.parametrize("ext", FORMATS)
+def test_round_trip(h5, scan_file, tmp_path, ext):
+    _needs(ext)
+    path = str(tmp_path / "out.{0}".format(ext))
+    export(h5, path, COLUMNS, chunk_rows=777)
+    columns, meta = load(path)
+    expected = _expected(scan_file[1])
+    assert list(columns) == COLUMNS
+    for c in COLUMNS:
+        np.testing.assert_array_equal(columns[c], expected[c])
+        assert columns[c].dtype == expected[c].dtype
+    assert meta["model"] == "model" and meta["loglike"] == "LogLike"
+
+@pytest.mark.parametrize("ext", FORMATS)
+def test_float32(h5, tmp_path, ext):
+    _needs(ext)
+    path = str(tmp_path / "out.{0}".format(ext))
+    h5.export(path, ["x", "pointID"], float32=True, compression=None)
+    columns, meta = load(path)
+    assert columns["x"].dtype == np.float32 and columns["pointID"].dtype == np.int64
+
+@pytest.mark.parametrize("ext", FORMATS)
+def test_empty_source(tmp_path, ext):
+    _needs(ext)
+    source = str(tmp_path / "empty.hdf5")
+    write_scan(source, n=0)
+    path = str(tmp_path / "out.{0}".format(ext))
+    with HDF5.fromFile(source, "/") as h:
+        export(h, path, COLUMNS)
+    columns, meta = load(path)
+    assert list(columns) == COLUMNS
+    assert [len(v) for v in columns.values()] == [0, 0, 0]
+    assert columns["pointID"].dtype == np.int64
+
+def test_parquet_row_groups(h5, tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    export(h5, str(tmp_path / "out.parquet"), COLUMNS, chunk_rows=1000)
+    assert pq.ParquetFile(str(tmp_path / "out.parquet")).num_row_groups > 1
+
+def test_unknown_format(h5, tmp_path):
+    with pytest.raises(ValueError):
+        export(h5, str(tmp_path / "out.csv"))
+
+def test_cli(scan_file, tmp_path):
+    path = str(tmp_path / "cli.npz")
+    main([scan_file[0], path, "--columns", "x", "LogLike", "pointID"])
+    columns, meta = load(path)
+    np.testing.assert_array_equal(columns["pointID"], _expected(scan_file[1])["pointID"])
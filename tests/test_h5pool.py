@@ -0,0 +1,94 @@
+"""Reference-counted HDF5 file handles of pyscannerbit.h5pool"""
+
+import os
+import pytest
+
+h5py = pytest.importorskip("h5py")
+
+from pyscannerbit.h5pool import HandlePool
+
+@pytest.fixture
+def filename(tmp_path):
+    name = str(tmp_path / "test.hdf5")
+    with h5py.File(name, "w") as f:
+        f["x"] = [1., 2., 3.]
+    return name
+
+def test_handles_are_shared(filename):
+    pool = HandlePool()
+    f1 = pool.acquire(filename)
+    f2 = pool.acquire(filename)
+    assert f1 is f2
+    assert list(pool.stats().values()) == [2]
+    pool.release(f1)
+    pool.release(f2)
+    assert list(pool.stats().values()) == [0]
+    assert f1.id.valid # idle, but kept open
+    pool.close_idle()
+    assert not f1.id.valid
+
+def test_max_idle(tmp_path):
+    pool = HandlePool(max_idle=1)
+    files = []
+    for i in range(3):
+        name = str(tmp_path / "{0}.hdf5".format(i))
+        h5py.File(name, "w").close()
+        files.append(pool.acquire(name))
+    for f in files:
+        pool.release(f)
+    assert [f.id.valid for f in files] == [0, 0, 1]
+
+def test_release_after_evict(filename):
+    pool = HandlePool()
+    h1 = pool.acquire(filename)
+    pool.evict(filename)
+    h2 = pool.acquire(filename)
+    assert h2 is not h1
+    pool.release(h1) # must not touch the new handle
+    assert not h1.id.valid
+    pool.close_idle()
+    assert h2.id.valid
+    assert h2["x"][0] == 1.
+    pool.release(h2)
+    pool.close_idle()
+    assert not h2.id.valid
+    assert pool.stats() == {}
+
+def test_replaced_file_is_reopened(filename):
+    pool = HandlePool()
+    with pool.opened(filename) as f1:
+        pass
+    with h5py.File(filename + ".new", "w") as f:
+        f["y"] = [0.]
+    os.replace(filename + ".new", filename)
+    with pool.opened(filename) as f2:
+        assert f2 is not f1 and "y" in f2
+    assert not f1.id.valid
+
+def test_hdf5_close(filename):
+    from pyscannerbit import h5pool
+    from pyscannerbit.hdf5_help import HDF5
+    with h5py.File(filename, "a") as f:
+        f["x_isvalid"] = [1, 1, 0]
+        f["LogLike"] = [0., 1., 2.]
+        f["LogLike_isvalid"] = [1, 1, 1]
+    h = HDF5.fromFile(filename, "/", model="m")
+    f = h.h5file
+    h.close()
+    h5pool.close_idle()
+    assert not f.id.valid
+
+def test_get_hdf5_releases_on_error(tmp_path, monkeypatch):
+    from pyscannerbit import h5pool, hdf5_help
+    from pyscannerbit.scan import Scan
+    s = Scan(lambda scan, x: -x**2, fargs=["x"], bounds=[(-1, 1)], scanner="random", vectorized=True,
+             scanner_options={"point_number": 10, "batch_size": 5}, output_path=str(tmp_path / "out"))
+    with pytest.raises(IOError):
+        s.get_hdf5() # not scanned yet
+    s.scan()
+    def broken(*args, **kwargs):
+        raise ValueError("broken")
+    monkeypatch.setattr(hdf5_help, "HDF5", broken)
+    with pytest.raises(ValueError):
+        s.get_hdf5()
+    assert h5pool.pool.stats()[(os.path.abspath(s.output_file()), "r")] == 0
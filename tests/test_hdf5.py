@@ -0,0 +1,88 @@
+"""Column cache of the HDF5 results class and masked reads (pyscannerbit.hdf5_help)"""
+
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip("h5py")
+
+from pyscannerbit.hdf5_help import HDF5, ColumnCache
+
+def test_column_cache_lru():
+    cache = ColumnCache(max_bytes=3*800)
+    for i in range(3):
+        cache.put(i, np.zeros(100))
+    cache.get(0)
+    cache.put(3, np.zeros(100))
+    assert cache.get(1) is None and cache.get(0) is not None
+    assert cache.nbytes == 3*800
+    cache.put("big", np.zeros(1000)) # larger than the whole cache: not kept
+    assert cache.get("big") is None and cache.get(0) is not None
+    cache.clear()
+    assert cache.nbytes == 0 and cache.get(0) is None
+
+def test_repeated_reads_are_cached(h5, scan_file):
+    data = scan_file[1]
+    x1, l1 = h5.get_params(["x", "LogLike"])
+    x2, l2 = h5.get_params(["x", "LogLike"])
+    assert x1 is not x2 # masked copies...
+    assert h5._column("model::x") is h5._column("model::x") # ...of the same cached column
+    assert h5._mask(["LogLike", "model::x"]) is h5._mask(["model::x", "LogLike"])
+    m = data["model::x"][1] & data["LogLike"][1]
+    np.testing.assert_array_equal(x1, data["model::x"][0][m])
+    assert h5.get_param_names() == ["x", "y"]
+
+def test_no_cache(scan_file):
+    with HDF5.fromFile(scan_file[0], "/", cache_bytes=0) as h:
+        assert h._column("model::x") is not h._column("model::x")
+        np.testing.assert_array_equal(h.get_param("x"), h.get_params(["x"])[0])
+
+def test_modified_file_is_reread(tmp_path):
+    import h5py
+    from conftest import write_scan
+    filename = str(tmp_path / "scan.hdf5")
+    write_scan(filename, n=100)
+    with h5py.File(filename, "a") as f:
+        h = HDF5(f["/"].id)
+        before = h.get_param("pointID")
+        f["pointID"][...] = np.arange(100, 200)
+        f.flush()
+        st = os.stat(filename)
+        os.utime(filename, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        np.testing.assert_array_equal(h.get_param("pointID"), np.arange(100, 200))
+        assert not np.array_equal(before, np.arange(100, 200))
+        f.create_dataset("model::z", data=np.ones(100))
+        f.create_dataset("model::z_isvalid", data=np.ones(100, dtype=np.int8))
+        os.utime(filename, ns=(st.st_atime_ns, st.st_mtime_ns + 2*10**9))
+        assert h.get_param_names() == ["x", "y", "z"] # the key index is rebuilt too
+
+def test_unknown_column(h5):
+    with pytest.raises(KeyError):
+        h5.get_param("nonexistent")
+
+@pytest.mark.parametrize("layout", [{}, {"chunks": (64,)}])
+@pytest.mark.parametrize("block_rows", [None, 100, 999])
+def test_read_masked(tmp_path, layout, block_rows):
+    import h5py
+    from pyscannerbit.hdf5_help import read_masked
+    rng = np.random.default_rng(4)
+    values = rng.normal(size=5000)
+    masks = [rng.random(5000) > 0.5, np.zeros(5000, dtype=bool), np.ones(5000, dtype=bool)]
+    sparse = np.zeros(5000, dtype=bool)
+    sparse[[3, 2500, 4999]] = True
+    with h5py.File(str(tmp_path / "d.hdf5"), "w") as f:
+        d = f.create_dataset("d", data=values, **layout)
+        for m in masks + [sparse]:
+            np.testing.assert_array_equal(read_masked(d, m, block_rows), values[m])
+
+@pytest.mark.parametrize("threads", [1, 3])
+def test_get_data(h5, scan_file, threads):
+    from pyscannerbit.hdf5_help import get_data
+    data = scan_file[1]
+    x, y, loglike = get_data(h5, ["x", "y", "LogLike"], model="model", threads=threads)
+    m = data["model::x"][1] & data["model::y"][1] & data["LogLike"][1]
+    np.testing.assert_array_equal(x, data["model::x"][0][m])
+    np.testing.assert_array_equal(y, data["model::y"][0][m])
+    np.testing.assert_array_equal(loglike, data["LogLike"][0][m])
+    pair, = get_data(h5, ["x"], apply_common_mask=False, model="model")
+    np.testing.assert_array_equal(pair.validdata(), data["model::x"][0][data["model::x"][1]])
@@ -0,0 +1,45 @@
+"""Import-time budget: importing pyscannerbit for post-processing must not
+   initialise MPI, load the ScannerBit extension, or pull in matplotlib/scipy.
+
+   Run with pytest, or directly:  python tests/test_import_time.py
+"""
+
+import sys
+import json
+import subprocess
+
+# Seconds allowed for importing the pyscannerbit modules themselves (numpy is
+# imported beforehand, as every user of the package needs it anyway)
+BUDGET = 0.5
+
+HEAVY = ["mpi4py", "matplotlib", "scipy", "yaml", "pyscannerbit.ext_module", "pyscannerbit.ScannerBit"]
+
+def _import_in_fresh_interpreter(modules):
+    code = """
+import sys, time, json
+import numpy
+t0 = time.perf_counter()
+for m in {0!r}:
+    __import__(m)
+dt = time.perf_counter() - t0
+print(json.dumps({{"time": dt, "loaded": sorted(sys.modules)}}))
+""".format(modules)
+    out = subprocess.check_output([sys.executable, "-c", code])
+    return json.loads(out.decode().strip().splitlines()[-1])
+
+def test_scan_import_is_lazy():
+    result = _import_in_fresh_interpreter(["pyscannerbit", "pyscannerbit.scan"])
+    loaded = [m for m in HEAVY + ["h5py"] if m in result["loaded"]]
+    assert loaded == [], "importing pyscannerbit.scan loaded {0}".format(loaded)
+    assert result["time"] < BUDGET, "importing pyscannerbit.scan took {0:.3f} s".format(result["time"])
+
+def test_results_import_is_lazy():
+    result = _import_in_fresh_interpreter(["pyscannerbit.hdf5_help", "pyscannerbit.plottools"])
+    loaded = [m for m in HEAVY if m in result["loaded"]]
+    assert loaded == [], "importing pyscannerbit.hdf5_help loaded {0}".format(loaded)
+    assert result["time"] < BUDGET, "importing pyscannerbit.hdf5_help took {0:.3f} s".format(result["time"])
+
+if __name__ == "__main__":
+    test_scan_import_is_lazy()
+    test_results_import_is_lazy()
+    print("Import time budget OK")
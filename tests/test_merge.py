@@ -0,0 +1,89 @@
+"""Merging of result groups, and lookup by (MPIrank, pointID)"""
+
+import numpy as np
+import pytest
+
+from conftest import write_scan
+
+h5py = pytest.importorskip("h5py")
+
+from pyscannerbit import h5pool
+from pyscannerbit.hdf5_help import HDF5
+from pyscannerbit.merge import merge, join, point_keys, PointIndex
+
+@pytest.fixture
+def runs(tmp_path):
+    """Two runs of rank 0 sharing pointIDs 500..999, and one of rank 1"""
+    a, b, c = [str(tmp_path / "{0}.hdf5".format(n)) for n in "abc"]
+    write_scan(a, n=1000, seed=1)
+    data_b = write_scan(b, n=1000, seed=2)
+    with h5py.File(b, "a") as f:
+        f["pointID"][:] = np.arange(500, 1500)
+    write_scan(c, n=300, seed=3, rank=1)
+    return a, b, c, data_b
+
+@pytest.mark.parametrize("keep", ["first", "last"])
+def test_merge(runs, tmp_path, keep):
+    a, b, c, data_b = runs
+    out = str(tmp_path / "merged.hdf5")
+    with merge([a, b, (c, "/")], out, keep=keep, chunk_rows=128) as m:
+        assert m["pointID"].shape[0] == 1500 + 300
+        keys = point_keys(m["MPIrank"][()], m["pointID"][()])
+        assert len(np.unique(keys)) == len(keys)
+        row = m.point_index().find(0, 700)
+        x_b, valid_b = data_b["model::x"][0][200], data_b["model::x"][1][200]
+        if keep == "last":
+            assert m["model::x"][row] == x_b and m["model::x_isvalid"][row] == valid_b
+        else:
+            assert m["model::x"][row] != x_b
+        assert PointIndex.load(m) is not None
+        assert m.get_point(1, 299)["pointID"] == 299
+        with pytest.raises(KeyError):
+            m.get_point(1, 300)
+    h5pool.close_idle()
+    assert sum(h5pool.pool.stats().values()) == 0 # sources opened by merge were given back
+
+def test_point_index_find():
+    index = PointIndex(point_keys([0, 0, 2], [1, 5, 3]), np.array([2, 0, 1]))
+    np.testing.assert_array_equal(index.find([0, 0, 2, 1], [5, 2, 3, 1]), [0, -1, 1, -1])
+    assert PointIndex(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)).find(0, 1) == -1
+    with pytest.raises(ValueError):
+        point_keys(-1, 0)
+
+def test_join(runs):
+    a, b, c, data_b = runs
+    with HDF5.fromFile(a, "/") as left, HDF5.fromFile(b, "/") as right:
+        out = join(left, right, ["x", "LogLike"], chunk_rows=64)
+    pid = np.arange(1000)
+    in_b = pid >= 500
+    for c, name in [("x", "model::x"), ("LogLike", "LogLike")]:
+        values, valid = out[c]
+        expected_valid = np.zeros(1000, dtype=bool)
+        expected_valid[in_b] = data_b[name][1][pid[in_b] - 500]
+        np.testing.assert_array_equal(valid, expected_valid)
+        np.testing.assert_array_equal(values[valid], data_b[name][0][pid[valid] - 500])
+
+def test_join_unordered(tmp_path):
+    left, right = str(tmp_path / "left.hdf5"), str(tmp_path / "right.hdf5")
+    write_scan(left, n=200, seed=1)
+    data = write_scan(right, n=200, seed=2)
+    perm = np.random.default_rng(0).permutation(200)
+    with h5py.File(right, "a") as f:
+        f["pointID"][:] = perm
+    with HDF5.fromFile(left, "/") as l, HDF5.fromFile(right, "/") as r:
+        values, valid = join(l, r, ["y"], chunk_rows=16)["y"]
+    src = np.argsort(perm) # row of 'right' holding pointID i
+    np.testing.assert_array_equal(valid, data["model::y"][1][src])
+    np.testing.assert_array_equal(values, data["model::y"][0][src])
+
+def test_merge_releases_sources_on_error(runs, tmp_path):
+    a = runs[0]
+    bad = str(tmp_path / "bad.hdf5")
+    with h5py.File(bad, "w") as f:
+        f["model::x"] = [0.]
+        f["model::x_isvalid"] = [1]
+    with pytest.raises(KeyError) as err: # no pointID
+        merge([a, bad], str(tmp_path / "merged.hdf5"))
+    # The traceback still references merge's frame; the handles must be back anyway
+    assert all(users == 0 for (path, mode), users in h5pool.pool.stats().items() if path in [a, bad])
+    del err
@@ -0,0 +1,66 @@
+"""Stage timers of pyscannerbit.metrics"""
+
+import json
+import time
+import pytest
+
+from pyscannerbit.metrics import LatencyHistogram, ScanMetrics
+
+def test_histogram_percentiles():
+    h = LatencyHistogram()
+    for ns in [100]*90 + [10**6]*10:
+        h.add(ns)
+    assert h.count == 100 and h.total_ns == 90*100 + 10*10**6
+    # Bucket centres are within a factor 10**(1/per_decade) of the value
+    assert 100 / 1.13 < h.percentile(50) < 100 * 1.13
+    assert 10**6 / 1.13 < h.percentile(99) < 10**6 * 1.13
+    assert LatencyHistogram().percentile(50) is None
+
+def test_histogram_merge():
+    a, b = LatencyHistogram(), LatencyHistogram()
+    a.add(10)
+    b.add(10**4)
+    b.add(0)
+    a.merge(b)
+    assert a.count == 3 and a.total_ns == 10 + 10**4
+    assert a.summary(wall_s=2.)["calls_per_s"] == 1.5
+
+def test_callback_and_user_function_are_separated(tmp_path):
+    m = ScanMetrics(path=str(tmp_path), flush_interval=1000.)
+    m.start(rank=3)
+    def user(x):
+        time.sleep(0.002)
+        return x
+    wrapped_user = m.timed_user(user, "likelihood")
+    def callback(x):
+        return wrapped_user(x) + 1
+    timed = m.timed_callback(callback, "wrapper")
+    for i in range(5):
+        assert timed(i) == i + 1
+    stages = m.summary()["stages"]
+    assert stages["likelihood"]["count"] == 5 and stages["wrapper"]["count"] == 5
+    assert stages["sampler"]["count"] == 4 # between consecutive callbacks
+    assert stages["likelihood"]["mean_ns"] > 2e6 > stages["wrapper"]["mean_ns"]
+    m.flush()
+    with open(str(tmp_path / "metrics_rank3.json")) as f:
+        assert json.load(f)["stages"]["likelihood"]["count"] == 5
+
+def test_vectorized_scan_metrics(tmp_path):
+    pytest.importorskip("h5py")
+    pytest.importorskip("mpi4py")
+    from pyscannerbit.scan import Scan
+    s = Scan(lambda scan, x: -x**2, fargs=["x"], bounds=[(-1, 1)], scanner="random", vectorized=True,
+             scanner_options={"point_number": 500, "batch_size": 100}, output_path=str(tmp_path / "out"), metrics=True)
+    s.scan()
+    assert s.run_metrics[-1]["stages"]["likelihood"]["count"] == 5
+    with s.get_hdf5() as h:
+        assert h.attrs["metrics_rank0_likelihood_count"] == 5
+    assert (tmp_path / "out" / "metrics_rank0.json").exists()
+
+def test_wrapped_function_before_start(tmp_path):
+    pytest.importorskip("mpi4py")
+    from pyscannerbit.scan import Scan
+    s = Scan(lambda scan, x: -x**2, fargs=["x"], bounds=[(-1, 1)], scanner="random",
+             output_path=str(tmp_path / "out"), metrics=True)
+    assert s._wrapped_function(None, {"default::x": 0.5}) == -0.25
+    assert not (tmp_path / "out" / "metrics_rank0.json").exists()
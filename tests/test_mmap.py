@@ -0,0 +1,44 @@
+"""Memory-mapped column access (hdf5_help.memmap_dataset, MappedColumns, get_params(mmap=True))"""
+
+import numpy as np
+import pytest
+
+from conftest import write_scan
+
+pytest.importorskip("h5py")
+
+from pyscannerbit.hdf5_help import HDF5, MappedColumns, memmap_dataset
+
+def test_contiguous_columns_are_mapped(h5, scan_file):
+    data = scan_file[1]
+    view = memmap_dataset(h5["model::x"])
+    assert isinstance(view, np.memmap) and not view.flags.writeable
+    np.testing.assert_array_equal(view, data["model::x"][0])
+    cols = MappedColumns(h5, "model")
+    assert cols.is_mapped("x") and cols.is_mapped("LogLike")
+    assert cols["x"] is cols["x"] # views are kept
+    np.testing.assert_array_equal(cols.valid("x"), data["model::x"][1])
+
+def test_chunked_columns_are_read(tmp_path):
+    filename = str(tmp_path / "chunked.hdf5")
+    data = write_scan(filename, n=1000, chunks=True, compression="gzip")
+    with HDF5.fromFile(filename, "/") as h:
+        assert memmap_dataset(h["model::x"]) is None
+        cols = h.mapped()
+        assert not cols.is_mapped("x")
+        np.testing.assert_array_equal(cols["x"], data["model::x"][0])
+
+def test_empty_dataset_is_not_mapped(tmp_path):
+    filename = str(tmp_path / "empty.hdf5")
+    write_scan(filename, n=0)
+    with HDF5.fromFile(filename, "/") as h:
+        assert memmap_dataset(h["model::x"]) is None
+
+def test_get_params_mmap(h5):
+    expected = h5.get_params(["x", "y", "LogLike"])
+    for got, want in zip(h5.get_params(["x", "y", "LogLike"], mmap=True), expected):
+        np.testing.assert_array_equal(got, want)
+    # With no invalid points the map itself is returned
+    pointid = h5.get_param("pointID", mmap=True)
+    assert isinstance(pointid, np.memmap)
+    np.testing.assert_array_equal(pointid, np.arange(5000))
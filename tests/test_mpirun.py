@@ -0,0 +1,106 @@
+"""Launching scans on local MPI processes (pyscannerbit.mpirun)"""
+
+import os
+import sys
+import shutil
+import tempfile
+import pytest
+
+pytest.importorskip("mpi4py")
+
+from pyscannerbit import mpirun
+from pyscannerbit.scan import _CallAdapter
+
+# Stand-in for mpiexec: writes a result for every rank without running anything
+STUB = """
+import sys, pickle
+args = sys.argv[1:]
+n = int(args[args.index("-n") + 1])
+for rank in range(n):
+    with open("{0}.{1}".format(args[-1], rank), "wb") as f:
+        pickle.dump(({"rank": rank, "cmd": args}, None), f)
+"""
+
+def loglike(scan, x):
+    return -x**2
+
+@pytest.fixture
+def tmpdir_root(tmp_path, monkeypatch):
+    """Directory in which launch() makes its temporary directory"""
+    root = tmp_path / "tmp"
+    root.mkdir()
+    monkeypatch.setattr(tempfile, "tempdir", str(root))
+    return root
+
+@pytest.fixture
+def stub(tmp_path, monkeypatch):
+    path = tmp_path / "stub_mpiexec.py"
+    path.write_text(STUB)
+    monkeypatch.setenv("PYSCANNERBIT_MPIEXEC", "{0} {1}".format(sys.executable, path))
+    return path
+
+def test_mpiexec_command(monkeypatch):
+    monkeypatch.delenv("PYSCANNERBIT_MPIEXEC", raising=False)
+    assert mpirun.mpiexec_command() == ["mpiexec"]
+    monkeypatch.setenv("PYSCANNERBIT_MPIEXEC", "srun --mpi=pmix")
+    assert mpirun.mpiexec_command() == ["srun", "--mpi=pmix"]
+
+def test_launch_collects_results(stub, tmpdir_root):
+    results = mpirun.launch(3, {}, _CallAdapter(loglike, ["model::x"]), None)
+    assert [r["rank"] for r in results] == [0, 1, 2]
+    assert results[0]["cmd"][:4] == ["-n", "3", sys.executable, "-m"]
+    assert os.listdir(str(tmpdir_root)) == [] # temporary files are removed
+
+def test_launch_failing_command(tmpdir_root, monkeypatch):
+    monkeypatch.setenv("PYSCANNERBIT_MPIEXEC", "false")
+    with pytest.raises(RuntimeError, match="exit code 1"):
+        mpirun.launch(2, {}, _CallAdapter(loglike, ["model::x"]), None)
+
+def _refuse_unpickling():
+    raise ValueError("payload cannot be unpickled")
+
+class Unpicklable:
+    """Pickles fine, but cannot be unpickled (in the ranks)"""
+    def __reduce__(self):
+        return (_refuse_unpickling, ())
+
+@pytest.mark.skipif(shutil.which("mpiexec") is None, reason="needs mpiexec")
+def test_error_of_rank_is_reraised(tmpdir_root, monkeypatch):
+    cmd = "mpiexec --allow-run-as-root" if os.geteuid() == 0 else "mpiexec"
+    monkeypatch.setenv("PYSCANNERBIT_MPIEXEC", cmd)
+    with pytest.raises(ValueError, match="cannot be unpickled"):
+        mpirun.launch(1, Unpicklable(), _CallAdapter(loglike, ["model::x"]), None)
+    assert os.listdir(str(tmpdir_root)) == []
+
+def test_truncated_result(tmp_path, tmpdir_root, monkeypatch):
+    path = tmp_path / "truncating_mpiexec.py"
+    path.write_text("import sys\nopen(sys.argv[-1] + '.0', 'wb').write(b'\\x80')\n")
+    monkeypatch.setenv("PYSCANNERBIT_MPIEXEC", "{0} {1}".format(sys.executable, path))
+    with pytest.raises(RuntimeError, match="exit code 0"):
+        mpirun.launch(1, {}, _CallAdapter(loglike, ["model::x"]), None)
+    assert os.listdir(str(tmpdir_root)) == []
+
+def test_missing_mpiexec(tmpdir_root, monkeypatch):
+    monkeypatch.setenv("PYSCANNERBIT_MPIEXEC", "no-such-mpiexec-command")
+    with pytest.raises(OSError):
+        mpirun.launch(1, {}, _CallAdapter(loglike, ["model::x"]), None)
+    assert os.listdir(str(tmpdir_root)) == []
+
+class InterruptedProcess:
+    """Popen whose first wait() is interrupted by CTRL-C"""
+    def __init__(self, *args, **kwargs):
+        self.killed = False
+
+    def wait(self):
+        if not self.killed:
+            raise KeyboardInterrupt
+        return -9
+
+    def kill(self):
+        self.killed = True
+
+def test_interrupted(tmpdir_root, monkeypatch):
+    monkeypatch.setattr(mpirun.subprocess, "Popen", InterruptedProcess)
+    with pytest.raises(KeyboardInterrupt):
+        mpirun.launch(1, {}, _CallAdapter(loglike, ["model::x"]), None)
+    assert os.listdir(str(tmpdir_root)) == []
@@ -0,0 +1,90 @@
+"""Re-evaluating new functions over existing scan output (pyscannerbit.postprocess)"""
+
+import shutil
+import numpy as np
+import pytest
+
+pytest.importorskip("h5py")
+pytest.importorskip("mpi4py")
+
+from pyscannerbit.hdf5_help import HDF5
+from pyscannerbit.postprocess import postprocess
+
+def newlike(scan, x, y):
+    scan.print("r", np.hypot(x, y))
+    return -x**2
+
+def _expected(data):
+    m = data["model::x"][1] & data["model::y"][1] & data["LogLike"][1]
+    x, y = data["model::x"][0], data["model::y"][0]
+    return m, np.where(m, -x**2, 0.), np.where(m, np.hypot(x, y), 0.)
+
+def _check(h, data, name="newlike"):
+    m, values, r = _expected(data)
+    np.testing.assert_array_equal(h[name + "_isvalid"][()], m)
+    np.testing.assert_allclose(h[name][()], values)
+    np.testing.assert_allclose(h["r"][()], r)
+
+@pytest.fixture
+def copy(scan_file, tmp_path):
+    filename = str(tmp_path / "copy.hdf5")
+    shutil.copy(scan_file[0], filename)
+    return filename
+
+@pytest.mark.parametrize("vectorized", [False, True])
+def test_new_columns(copy, scan_file, vectorized):
+    written = postprocess(copy, newlike, "newlike", vectorized=vectorized, chunk_rows=1500)
+    assert written == ["newlike", "r"]
+    with HDF5.fromFile(copy, "/") as h:
+        _check(h, scan_file[1])
+        m, values, r = _expected(scan_file[1])
+        np.testing.assert_allclose(h.get_param("newlike"), values[m]) # new columns are picked up
+    with pytest.raises(ValueError):
+        postprocess(copy, newlike, "LogLike")
+
+def test_sidecar(scan_file, tmp_path):
+    sidecar = str(tmp_path / "sidecar.hdf5")
+    with HDF5.fromFile(scan_file[0], "/") as h:
+        postprocess(h, newlike, "newlike", vectorized=True, sidecar=sidecar)
+        assert "newlike" not in h
+    with HDF5.fromFile(sidecar, "/") as h:
+        _check(h, scan_file[1])
+        np.testing.assert_array_equal(h["pointID"][()], scan_file[1]["pointID"][0]) # linked from the original
+
+def test_read_only_source(h5):
+    with pytest.raises(ValueError):
+        postprocess(h5, newlike, "newlike")
+
+calls = []
+interrupt_at = [3]
+
+def interrupted(scan, x, y):
+    calls.append(len(x))
+    if len(calls) == interrupt_at[0]:
+        raise RuntimeError("interrupted")
+    return newlike(scan, x, y)
+
+def test_resume(copy, scan_file):
+    del calls[:]
+    interrupt_at[0] = 3
+    with pytest.raises(RuntimeError):
+        postprocess(copy, interrupted, "newlike", vectorized=True, chunk_rows=1000)
+    evaluated = sum(calls[:2])
+    del calls[:]
+    interrupt_at[0] = None
+    postprocess(copy, interrupted, "newlike", vectorized=True, chunk_rows=1000)
+    assert len(calls) == 3 # the remaining chunks only
+    with HDF5.fromFile(copy, "/") as h:
+        _check(h, scan_file[1])
+        assert h["newlike"].attrs["postprocess_rows"] == 5000
+    assert evaluated + sum(calls) == np.sum(_expected(scan_file[1])[0])
+    del calls[:]
+    postprocess(copy, interrupted, "newlike", vectorized=True, chunk_rows=1000)
+    assert calls == [] # already complete
+    postprocess(copy, interrupted, "newlike", vectorized=True, chunk_rows=1000, overwrite=True)
+    assert len(calls) == 5
+
+def test_process_pool(copy, scan_file):
+    postprocess(copy, newlike, "newlike", chunk_rows=2000, processes=2)
+    with HDF5.fromFile(copy, "/") as h:
+        _check(h, scan_file[1])
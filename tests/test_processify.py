@@ -0,0 +1,54 @@
+"""processify and its warm WorkerPool"""
+
+import os
+import pytest
+
+from pyscannerbit.processify import processify, WorkerPool
+
+@processify
+def _pid_and_value(value):
+    return os.getpid(), value
+
+@processify
+def _pid_and_type(value):
+    return os.getpid(), type(value).__name__
+
+@processify
+def _fail():
+    raise RuntimeError("xyz")
+
+def _refuse_unpickling():
+    raise RuntimeError("this object cannot be unpickled")
+
+class Unpicklable:
+    """Pickles fine, but cannot be unpickled (in the worker)"""
+    def __reduce__(self):
+        return (_refuse_unpickling, ())
+
+@pytest.fixture
+def pool():
+    pool = WorkerPool(size=1, prefetch=1)
+    _pid_and_value.pool = _pid_and_type.pool = pool
+    yield pool
+    pool.close()
+    _pid_and_value.pool = _pid_and_type.pool = None
+
+def test_runs_in_subprocess():
+    pid, value = _pid_and_value(3)
+    assert pid != os.getpid() and value == 3
+
+def test_exception_is_reraised():
+    with pytest.raises(RuntimeError, match="xyz"):
+        _fail()
+
+def test_pool(pool):
+    pid, value = _pid_and_value([1, 2])
+    assert pid != os.getpid() and value == [1, 2]
+
+def test_pool_falls_back_to_fork_for_unpicklable_task(pool):
+    pid, name = _pid_and_type(Unpicklable())
+    assert pid != os.getpid() and name == "Unpicklable"
+
+def test_submit():
+    handle = _pid_and_value.submit("a")
+    assert handle.result(timeout=30)[1] == "a"
@@ -0,0 +1,72 @@
+"""Profiling of the scan callbacks (pyscannerbit.profiling and Scan.scan(profile=...))"""
+
+import pstats
+import numpy as np
+import pytest
+
+from pyscannerbit.profiling import ScanProfiler, write_collapsed
+
+def busy(n):
+    total = 0.
+    for i in range(n):
+        total += i**0.5
+    return total
+
+def _run(profiler, n=200000, calls=5):
+    profiler.start()
+    try:
+        wrapped = profiler.wrap(busy, "likelihood")
+        for i in range(calls):
+            wrapped(n)
+    finally:
+        profiler.stop()
+    return profiler.result()
+
+def _functions(stats):
+    return {func for (filename, line, func) in stats.stats}
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        ScanProfiler("perf")
+
+def test_cprofile(tmp_path):
+    output = str(tmp_path / "scan.prof")
+    profiler = ScanProfiler("cprofile", output=output)
+    results = [_run(profiler, n=100), _run(profiler, n=100)] # e.g. two ranks
+    merged = profiler.merge(results + [None])
+    calls = {func: cc for (filename, line, func), (cc, nc, tt, ct, callers) in merged.stats.items()}
+    assert calls["busy"] == 10
+    assert "busy" in _functions(pstats.Stats(output))
+
+def test_sampling(tmp_path):
+    output = str(tmp_path / "scan.folded")
+    profiler = ScanProfiler("sampling", interval=0.001, output=output)
+    stacks = profiler.merge([_run(profiler)])
+    assert stacks and all(s == "[sampler]" or s.startswith("likelihood;busy (test_profiling.py:") for s in stacks)
+    with open(output) as f:
+        lines = f.read().splitlines()
+    assert sum(int(l.rsplit(" ", 1)[1]) for l in lines) == sum(stacks.values())
+
+def test_write_collapsed(tmp_path):
+    write_collapsed({"a;b": 3, "a": 1}, str(tmp_path / "out"))
+    assert (tmp_path / "out").read_text() == "a 1\na;b 3\n"
+
+def loglike(scan, x):
+    return np.array([-busy(2000) * v**2 for v in x])
+
+@pytest.mark.parametrize("mode", ["cprofile", "sampling"])
+def test_vectorized_scan(tmp_path, mode):
+    pytest.importorskip("h5py")
+    pytest.importorskip("mpi4py")
+    from pyscannerbit.scan import Scan
+    output = str(tmp_path / "profile.out")
+    s = Scan(loglike, bounds=[(-1, 1)], scanner="random", vectorized=True,
+             scanner_options={"point_number": 200, "batch_size": 50}, output_path=str(tmp_path / "out"))
+    s.scan(profile=ScanProfiler(mode, interval=0.001, output=output))
+    if mode == "cprofile":
+        assert {"loglike", "busy"} <= _functions(s.profile_stats)
+        assert {"loglike", "busy"} <= _functions(pstats.Stats(output))
+    else:
+        assert any("loglike (test_profiling.py:" in stack and "busy (test_profiling.py:" in stack for stack in s.profile_stats)
+        with open(output) as f:
+            assert "loglike (test_profiling.py:" in f.read()
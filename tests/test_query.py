@@ -0,0 +1,50 @@
+"""HDF5.query against plain numpy masks"""
+
+import numpy as np
+import pytest
+
+def _reference(data, mask_of, used, columns):
+    valid = np.logical_and.reduce([data[c][1] for c in used + columns])
+    values = {c: data[c][0] for c in data}
+    m = mask_of(values) & valid
+    return {c: values[c][m] for c in columns}
+
+CASES = [
+    ("LogLike > max(LogLike) - 1", lambda v: v["LogLike"] > v["LogLike"][np.isfinite(v["LogLike"])].max() - 1, ["LogLike"]),
+    ("x > 0 and y < 1", lambda v: (v["model::x"] > 0) & (v["model::y"] < 1), ["model::x", "model::y"]),
+    ("x > 1 or y < -2", lambda v: (v["model::x"] > 1) | (v["model::y"] < -2), ["model::x", "model::y"]),
+    ("not (x > 0)", lambda v: ~(v["model::x"] > 0), ["model::x"]),
+    ("-1 < x <= 0.5", lambda v: (-1 < v["model::x"]) & (v["model::x"] <= 0.5), ["model::x"]),
+    ("0 < x and not (y > 0 or x > 1)", lambda v: (0 < v["model::x"]) & ~((v["model::y"] > 0) | (v["model::x"] > 1)), ["model::x", "model::y"]),
+    ("np.abs(x) < a", lambda v: np.abs(v["model::x"]) < 0.3, ["model::x"]),
+    ("pointID == 17", lambda v: v["pointID"] == 17, ["pointID"]),
+    ("x > 100", lambda v: v["model::x"] > 100, ["model::x"]),
+]
+
+@pytest.mark.parametrize("expr, mask_of, used", CASES, ids=[c[0] for c in CASES])
+@pytest.mark.parametrize("zone_rows", [64, 2**16])
+def test_query_matches_numpy(h5, scan_file, expr, mask_of, used, zone_rows):
+    data = scan_file[1]
+    # max(LogLike) is over the valid values only
+    data = dict(data, LogLike=(np.where(data["LogLike"][1], data["LogLike"][0], np.nan), data["LogLike"][1]))
+    out = h5.query(expr, ["pointID", "LogLike"], params={"a": 0.3}, zone_rows=zone_rows)
+    expected = _reference(data, mask_of, used, ["pointID", "LogLike"])
+    np.testing.assert_array_equal(out["pointID"], expected["pointID"])
+    np.testing.assert_array_equal(out["LogLike"], expected["LogLike"])
+
+def test_zone_map_prunes(h5):
+    from pyscannerbit.query import Query, ZoneMap
+    q = Query(h5, "pointID < 100", zonemap=ZoneMap(h5, 64))
+    possible = q.possible()
+    assert possible[:2].all() and not possible[2:].any()
+
+def test_col_and_unknown_names(h5):
+    out = h5.query("col('model::y') > 2.5", ["y"])
+    assert len(out["y"]) > 0 and (out["y"] > 2.5).all()
+    with pytest.raises(KeyError):
+        h5.query("z > 0", ["x"])
+
+@pytest.mark.parametrize("expr", ["x in y", "x not in y", "x is y", "x is not y"])
+def test_operators_that_are_not_elementwise(h5, expr):
+    with pytest.raises(ValueError):
+        h5.query(expr, ["x"])
@@ -0,0 +1,148 @@
+"""Streaming reducers (pyscannerbit.reducers) against in-memory numpy"""
+
+import numpy as np
+import pytest
+
+from conftest import write_scan
+
+pytest.importorskip("h5py")
+
+from pyscannerbit.hdf5_help import HDF5
+from pyscannerbit.reducers import (Count, ArgMax, ArgMin, Max, Min, WeightedSum, Histogram1D,
+                                  Histogram2D, ProfileLikelihood2D, MarginalPosterior2D)
+
+def _valid(data, names):
+    m = np.logical_and.reduce([data[n][1] for n in names])
+    return [data[n][0][m] for n in names]
+
+RANGE = [(-2, 2), (-3, 3)]
+
+@pytest.mark.parametrize("apply_common_mask", [True, False])
+def test_iter_chunks(h5, scan_file, apply_common_mask):
+    data = scan_file[1]
+    chunks = list(h5.iter_chunks(["x", "LogLike"], chunk_rows=1234, apply_common_mask=apply_common_mask))
+    assert len(chunks) == 5
+    if apply_common_mask:
+        x, loglike = _valid(data, ["model::x", "LogLike"])
+        np.testing.assert_array_equal(np.concatenate([c["x"] for c in chunks]), x)
+        np.testing.assert_array_equal(np.concatenate([c["LogLike"] for c in chunks]), loglike)
+    else:
+        np.testing.assert_array_equal(np.concatenate([c["x"][0] for c in chunks]), data["model::x"][0])
+        np.testing.assert_array_equal(np.concatenate([c["x"][1] for c in chunks]), data["model::x"][1])
+
+def test_scalar_reducers(h5, scan_file):
+    data = scan_file[1]
+    x, loglike, w = _valid(data, ["model::x", "LogLike", "Posterior"])
+    count, argmax, argmin, high, low, wsum, total = h5.reduce(
+        Count("x", "LogLike", "Posterior"), ArgMax("LogLike", carry=["x", "Posterior"]),
+        ArgMin("LogLike", carry=["x"]), Max("LogLike"), Min("x"),
+        WeightedSum("x", weights="Posterior"), WeightedSum("x"), chunk_rows=700)
+    assert count == len(x)
+    # Max/Min and WeightedSum("x") only need their own columns to be valid
+    x_only, = _valid(data, ["model::x"])
+    loglike_only, = _valid(data, ["LogLike"])
+    assert high == loglike_only.max() and low == x_only.min()
+    best, at = argmax
+    xl, ll, wl = _valid(data, ["model::x", "LogLike", "Posterior"])
+    assert best == ll.max() and at == {"x": xl[np.argmax(ll)], "Posterior": wl[np.argmax(ll)]}
+    xl, ll = _valid(data, ["model::x", "LogLike"])
+    assert argmin == (ll.min(), {"x": xl[np.argmin(ll)]})
+    xw, ww = _valid(data, ["model::x", "Posterior"])
+    np.testing.assert_allclose(wsum, (np.dot(xw, ww), ww.sum()))
+    np.testing.assert_allclose(total, (x_only.sum(), len(x_only)))
+
+def test_argmax_merge_and_empty():
+    a, b = ArgMax("l", carry=["x"]), ArgMax("l", carry=["x"])
+    a.update({"l": (np.array([1., 5.]), np.array([True, False])), "x": (np.array([10., 50.]), np.ones(2, dtype=bool))})
+    assert a.result() == (1., {"x": 10.})
+    assert b.result() == (None, {})
+    b.merge(a)
+    assert b.result() == (1., {"x": 10.})
+    a.merge(ArgMax("l", carry=["x"]))
+    assert a.result() == (1., {"x": 10.})
+
+def test_histogram1d(h5, scan_file):
+    (counts, edges), (mass, _) = h5.reduce(Histogram1D("x", bins=20, range=(-3, 3)),
+                                           Histogram1D("x", bins=20, range=(-3, 3), weights="Posterior"), chunk_rows=999)
+    x, = _valid(scan_file[1], ["model::x"])
+    np.testing.assert_array_equal(counts, np.histogram(x, bins=20, range=(-3, 3))[0])
+    xw, w = _valid(scan_file[1], ["model::x", "Posterior"])
+    np.testing.assert_allclose(mass, np.histogram(xw, bins=edges, weights=w)[0])
+    with pytest.raises(ValueError):
+        Histogram1D("x", bins=20)
+
+def test_streamed_best_fit(h5):
+    for chunk_rows in [100, 4096, 10**6]:
+        assert h5.get_best_fit("x", chunk_rows=chunk_rows) == h5.get_best_fit("x")
+        assert h5.get_best_fit("LogLike", chunk_rows=chunk_rows) == h5.get_best_fit("LogLike")
+        assert h5.get_min_chi_squared(chunk_rows=chunk_rows) == h5.get_min_chi_squared()
+
+def _profile(x, y, loglike, xedges, yedges):
+    """Brute-force minimum chi^2 per bin"""
+    out = np.full((len(xedges) - 1, len(yedges) - 1), np.nan)
+    ix = np.digitize(x, xedges) - 1
+    iy = np.digitize(y, yedges) - 1
+    ix[x == xedges[-1]] -= 1
+    iy[y == yedges[-1]] -= 1
+    for i in range(out.shape[0]):
+        for j in range(out.shape[1]):
+            m = (ix == i) & (iy == j)
+            if m.any():
+                out[i, j] = np.min(-2. * loglike[m])
+    return out
+
+def test_histogram2d(h5, scan_file):
+    counts, xedges, yedges = h5.reduce(Histogram2D("x", "y", bins=[8, 6], range=RANGE), chunk_rows=333)[0]
+    x, y = _valid(scan_file[1], ["model::x", "model::y"])
+    np.testing.assert_array_equal(counts, np.histogram2d(x, y, bins=[8, 6], range=RANGE)[0])
+    with pytest.raises(ValueError):
+        Histogram2D("x", "y", bins=10)
+
+def test_profile_likelihood(h5, scan_file):
+    chi2, xedges, yedges = h5.reduce(ProfileLikelihood2D("x", "y", bins=[10, 12], range=RANGE), chunk_rows=500)[0]
+    x, y, loglike = _valid(scan_file[1], ["model::x", "model::y", "LogLike"])
+    np.testing.assert_array_equal(chi2, _profile(x, y, loglike, xedges, yedges))
+
+def test_marginal_posterior(h5, scan_file):
+    mass, xedges, yedges = h5.reduce(MarginalPosterior2D("x", "y", bins=[10, 12], range=RANGE), chunk_rows=500)[0]
+    x, y, w = _valid(scan_file[1], ["model::x", "model::y", "Posterior"])
+    expected = np.histogram2d(x, y, bins=[xedges, yedges], weights=w)[0]
+    np.testing.assert_allclose(mass, expected / expected.sum())
+
+@pytest.mark.parametrize("cls", [ProfileLikelihood2D, MarginalPosterior2D])
+def test_merge_of_halves(scan_file, cls):
+    data = scan_file[1]
+    x, y, z = data["model::x"][0], data["model::y"][0], data["LogLike" if cls is ProfileLikelihood2D else "Posterior"][0]
+    valid = data["model::x"][1] & data["model::y"][1]
+    whole = cls("x", "y", bins=[7, 9], range=RANGE)
+    whole.add(x, y, z, valid=valid)
+    a, b = cls("x", "y", bins=[7, 9], range=RANGE), cls("x", "y", bins=[7, 9], range=RANGE)
+    a.add(x[:2000], y[:2000], z[:2000], valid=valid[:2000])
+    b.add(x[2000:], y[2000:], z[2000:], valid=valid[2000:])
+    a.merge(b)
+    np.testing.assert_allclose(a.result()[0], whole.result()[0], rtol=1e-12) # sums in another order
+    np.testing.assert_array_equal(a.counts, whole.counts)
+
+def test_explicit_edges_and_outside_points():
+    grid = ProfileLikelihood2D("x", "y", bins=[[0, 1, 3], [0, 2]])
+    grid.add(np.array([0.5, 3., 2., -1., np.nan]), np.array([1., 2., 0.5, 1., 1.]), np.array([-1., -2., -3., -4., -5.]))
+    chi2 = grid.result()[0]
+    np.testing.assert_array_equal(chi2, [[2.], [4.]]) # right edges are included, as in np.histogram2d
+
+def test_allreduce_single_rank():
+    MPI = pytest.importorskip("mpi4py.MPI")
+    grid = MarginalPosterior2D("x", "y", weights=None, bins=4, range=[(0, 1), (0, 1)])
+    grid.add(np.array([0.1, 0.9]), np.array([0.1, 0.1]))
+    before = grid.mass.copy()
+    grid.allreduce(MPI.COMM_SELF)
+    np.testing.assert_array_equal(grid.mass, before)
+
+def test_best_fit_without_valid_points(tmp_path):
+    filename = str(tmp_path / "empty.hdf5")
+    write_scan(filename, n=0)
+    with HDF5.fromFile(filename, "/") as h:
+        for chunk_rows in [None, 100]:
+            with pytest.raises(ValueError, match="No point"):
+                h.get_min_chi_squared(chunk_rows=chunk_rows)
+            with pytest.raises(ValueError, match="No point"):
+                h.get_best_fit("x", chunk_rows=chunk_rows)
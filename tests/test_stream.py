@@ -0,0 +1,77 @@
+"""Shared-memory sample ring (pyscannerbit.stream) and Scan.iter_samples"""
+
+import multiprocessing
+import numpy as np
+import pytest
+
+from pyscannerbit.stream import SampleRing
+
+@pytest.fixture
+def ring():
+    r = SampleRing(2, capacity=8, threshold=-10.)
+    yield r
+    r.close()
+
+def test_push_and_pop(ring):
+    ring.push((1., 2.), -1.)
+    ring.push((3., 4.), -20.) # below the threshold
+    ring.push((5., 6.), np.nan)
+    batch = ring.pop()
+    np.testing.assert_array_equal(batch.params, [[1., 2.], [3., 4.], [5., 6.]])
+    np.testing.assert_array_equal(batch.valid, [True, False, False])
+    assert len(ring.pop().loglike) == 0
+
+def test_wrap_around_and_drop(ring):
+    for i in range(6):
+        ring.push((i, i), -i)
+    assert len(ring.pop().loglike) == 6
+    x = np.arange(12.)
+    ring.push_many(np.column_stack((x, x)), -x, np.ones(12, dtype=bool))
+    batch = ring.pop()
+    np.testing.assert_array_equal(batch.loglike, -x[:8]) # in order, across the end of the buffer
+    assert ring.dropped == 4
+
+def _produce(ring, n):
+    for i in range(n):
+        ring.push((i, -i), float(i))
+
+def test_other_process_block():
+    ring = SampleRing(2, capacity=16, overflow="block")
+    try:
+        p = multiprocessing.get_context("fork").Process(target=_produce, args=(ring, 1000))
+        p.start()
+        got = []
+        while sum(len(g) for g in got) < 1000:
+            got.append(ring.pop().loglike) # the producer waits while the buffer is full
+        p.join()
+        np.testing.assert_array_equal(np.concatenate(got), np.arange(1000.))
+        assert ring.dropped == 0
+    finally:
+        ring.close()
+
+def test_pickled_ring_shares_memory(ring):
+    import pickle
+    copy = pickle.loads(pickle.dumps(ring)) # as in a spawned or pool worker
+    copy.push((7., 8.), -2.)
+    copy.close() # must not remove the buffer, which it did not create
+    np.testing.assert_array_equal(ring.pop().params, [[7., 8.]])
+
+def test_unknown_overflow_policy():
+    with pytest.raises(ValueError):
+        SampleRing(1, overflow="wait")
+
+def loglike(scan, x, y):
+    return -0.5*(x**2 + y**2)
+
+def test_iter_samples(tmp_path):
+    pytest.importorskip("h5py")
+    pytest.importorskip("mpi4py")
+    from pyscannerbit.scan import Scan
+    s = Scan(loglike, bounds=[(-1, 1), (-1, 1)], scanner="random", vectorized=True,
+             scanner_options={"point_number": 2000, "batch_size": 100, "seed": 3}, output_path=str(tmp_path / "out"))
+    batches = list(s.iter_samples(capacity=4096))
+    params = np.concatenate([b.params for b in batches])
+    assert len(params) == 2000 and s.dropped_samples == 0
+    with s.get_hdf5() as h:
+        np.testing.assert_array_equal(params[:, 0], h["default::x"][()])
+        np.testing.assert_array_equal(np.concatenate([b.loglike for b in batches]), h["LogLike"][()])
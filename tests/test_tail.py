@@ -0,0 +1,77 @@
+"""Following a growing scan output (pyscannerbit.tail)"""
+
+import multiprocessing
+import numpy as np
+import pytest
+
+from conftest import write_scan
+
+pytest.importorskip("h5py")
+
+from pyscannerbit.batch import BatchWriter
+from pyscannerbit.tail import TailReader
+from pyscannerbit.reducers import Count, Max
+
+def _batch(start, n):
+    x = np.arange(start, start + n, dtype=np.float64)
+    valid = x % 3 != 0
+    return {"model::x": (x, valid), "LogLike": (-x, np.ones(n, dtype=bool))}
+
+def _write(filename, batches, swmr, ready, go):
+    """Writer process: appends one batch each time 'go' is set"""
+    w = BatchWriter(filename, "/", swmr=swmr)
+    try:
+        for b in batches:
+            go.wait()
+            go.clear()
+            w.append(b)
+            w.f.flush()
+            ready.set()
+    finally:
+        w.close()
+
+@pytest.mark.parametrize("swmr", [True, False])
+def test_poll_new_rows(tmp_path, swmr):
+    filename = str(tmp_path / "growing.hdf5")
+    ctx = multiprocessing.get_context("fork")
+    ready, go = ctx.Event(), ctx.Event()
+    batches = [_batch(0, 10), _batch(10, 5), _batch(15, 7)]
+    reader = TailReader(filename, columns=["x", "LogLike"], swmr=swmr, model="model")
+    p = ctx.Process(target=_write, args=(filename, batches, swmr, ready, go))
+    p.start()
+    try:
+        assert reader.poll() is None # no file yet
+        for b in batches:
+            go.set()
+            assert ready.wait(10)
+            ready.clear()
+            chunk = reader.poll()
+            m = b["model::x"][1]
+            np.testing.assert_array_equal(chunk["x"], b["model::x"][0][m])
+            np.testing.assert_array_equal(chunk["LogLike"], b["LogLike"][0][m])
+            assert reader.poll() is None
+        assert reader.position == 22 and reader.restarts == 0
+    finally:
+        go.set()
+        p.join(10)
+        reader.close()
+
+def test_update_with_reducers(scan_file):
+    data = scan_file[1]
+    with TailReader(scan_file[0], columns=["x", "LogLike"], swmr=False) as reader:
+        count, high = Count("x", "LogLike"), Max("LogLike")
+        assert reader.update(count, high) == 5000
+        assert reader.update(count, high) == 0
+    assert count.result() == np.sum(data["model::x"][1] & data["LogLike"][1])
+    assert high.result() == data["LogLike"][0][data["LogLike"][1]].max()
+
+def test_restart_when_file_shrinks(tmp_path):
+    filename = str(tmp_path / "scan.hdf5")
+    write_scan(filename, n=300)
+    reader = TailReader(filename, columns=["x"], swmr=False, apply_common_mask=False)
+    assert len(reader.poll()["x"][0]) == 300
+    data = write_scan(filename, n=100, seed=1) # a new scan overwrote the output
+    chunk = reader.poll()
+    assert reader.restarts == 1 and reader.position == 100
+    np.testing.assert_array_equal(chunk["x"][0], data["model::x"][0])
+    np.testing.assert_array_equal(chunk["x"][1], data["model::x"][1])